@@ -7,66 +7,75 @@ Noms et numéros étudiants:
 """
 
 import argparse
-import json
-import socket
 import sys
 import re
 from getpass import getpass
 
-import glosocket
+import gloclient
+import glocodec
 import gloutils
 
 
 class Client:
-    """Client pour le serveur mail @glo2000.ca."""
+    """
+    Client interactif pour le serveur mail @glo2000.ca.
 
-    def __init__(self, destination: str) -> None:
-        """
-        Prépare et connecte le socket du client `_socket`.
+    Les échanges avec le serveur passent par gloclient.MailClient; cette
+    classe ne fait que demander les informations à l'utilisateur et
+    afficher les réponses.
+    """
 
-        Prépare un attribut `_username` pour stocker le nom d'utilisateur
-        courant. Laissé vide quand l'utilisateur n'est pas connecté.
+    def __init__(self, destination: str, encoding: str = glocodec.BinaryCodec.name,
+                 compress: bool = True, stream: bool = True) -> None:
         """
-        self._socket = self._make_client_socket(destination, gloutils.APP_PORT)
-        self._username = None
+        Prépare et connecte le client `_client` du serveur.
 
-    @staticmethod
-    def _make_client_socket(destination: str, port: int) -> socket.socket:
-        """ setup for the client socket """
+        Si `encoding` n'est pas JSON ou si `compress` ou `stream` est
+        vrai, le client les propose au serveur avec l'entête `HELLO`.
+
+        Une fois connecté, le client s'abonne aux avis de nouveaux
+        courriels, affichés dès qu'ils sont reçus.
+        """
         try:
-            client_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_soc.connect((destination, port))
-            return client_soc
-        except glosocket.GLOSocketError:
+            self._client = gloclient.MailClient(destination, encoding=encoding, compress=compress,
+                                                stream=stream, on_new_mail=self._show_new_mail)
+        except OSError:
             sys.exit(-1)
 
+    @staticmethod
+    def _show_new_mail(payload: gloutils.NewMailPayload) -> None:
+        print(f"\n{gloutils.NEW_MAIL_DISPLAY.format(**payload)}")
+
     def _register(self) -> None:
         """
         Demande un nom d'utilisateur et un mot de passe et les transmet au
         serveur avec l'entête `AUTH_REGISTER`.
 
-        Si la création du compte s'est effectuée avec succès, l'attribut
-        `_username` est mis à jour, sinon l'erreur est affichée.
+        Si la création du compte s'est effectuée avec succès, le client
+        s'abonne aux avis de nouveaux courriels, sinon l'erreur est
+        affichée.
         """
         payload: gloutils.AuthPayload = self._get_credentials()
-        response = self._send_receive(gloutils.Headers.AUTH_REGISTER, payload)
-
-        if self._is_response_ok(response):
-            self._username = payload["username"]
+        try:
+            self._client.register(payload["username"], payload["password"])
+            self._client.subscribe()
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
 
     def _login(self) -> None:
         """
         Demande un nom d'utilisateur et un mot de passe et les transmet au
         serveur avec l'entête `AUTH_LOGIN`.
 
-        Si la connexion est effectuée avec succès, l'attribut `_username`
-        est mis à jour, sinon l'erreur est affichée.
+        Si la connexion est effectuée avec succès, le client s'abonne aux
+        avis de nouveaux courriels, sinon l'erreur est affichée.
         """
         payload: gloutils.AuthPayload = self._get_credentials()
-        response = self._send_receive(gloutils.Headers.AUTH_LOGIN, payload)
-
-        if self._is_response_ok(response):
-            self._username = payload["username"]
+        try:
+            self._client.login(payload["username"], payload["password"])
+            self._client.subscribe()
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
 
     @staticmethod
     def _get_credentials() -> gloutils.AuthPayload:
@@ -77,79 +86,133 @@ class Client:
 
     def _quit(self) -> None:
         """
-        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
-        socket du client.
+        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme la
+        connexion du client.
         """
-        message = gloutils.GloMessage(header=gloutils.Headers.BYE)
-        glosocket.send_msg(self._socket, json.dumps(message))
-        self._socket.close()
+        self._client.close()
 
     def _read_email(self) -> None:
         """
         Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        `INBOX_READING_REQUEST`, une page de `INBOX_PAGE_SIZE` à la fois.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche la page courante puis transmet le choix de l'utilisateur
+        avec l'entête `INBOX_READING_CHOICE`, ou demande la page suivante
+        ou précédente.
 
         Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
-        response = self._send_receive(gloutils.Headers.INBOX_READING_REQUEST)
-        if self._is_response_ok(response):
-            emails = self._get_email_list_from_payload(response)
-            if emails:
-                self._selected_email(emails)
-
-    @staticmethod
-    def _get_email_list_from_payload(response: dict) -> list[str]:
-        response_payload = response["payload"]
-        emails = response_payload["email_list"]
-
-        if len(emails) == 0:
-            print("\nthere is no emails in your inbox")
-            return None
-
-        return emails
+        offset = 0
+        while True:
+            try:
+                page = self._client.list_inbox(offset, gloutils.INBOX_PAGE_SIZE)
+            except gloclient.MailClientError as ex:
+                _print_error(ex)
+                return
+
+            if page["total"] == 0:
+                print("\nthere is no emails in your inbox")
+                return
+
+            choice = self._get_inbox_reading_choice(page)
+            match choice:
+                case "n":
+                    offset += gloutils.INBOX_PAGE_SIZE
+                case "p":
+                    offset -= gloutils.INBOX_PAGE_SIZE
+                case _:
+                    self._selected_email(choice)
+                    return
+
+    def _search_emails(self) -> None:
+        """
+        Demande des mots à rechercher et les transmet au serveur avec
+        l'entête `SEARCH_REQUEST`.
 
-    def _selected_email(self, emails: list[str]) -> None:
+        Affiche les courriels trouvés, du plus pertinent au moins
+        pertinent, puis affiche celui choisi par l'utilisateur.
+        """
+        query = input("Mots à rechercher : ")
+        try:
+            results = self._client.search(query, gloutils.INBOX_PAGE_SIZE)
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
+            return
+
+        if not results["email_list"]:
+            print("\nno email matches your search")
+            return
+
+        print(f"\n{results['total']} email(s) found")
+        for email in results["email_list"]:
+            print(email)
+        choice = input("enter the number of the email you would like to consult (empty to go back)\n")
+        if choice.isdigit():
+            self._selected_email(int(choice))
+
+    def _selected_email(self, email_id: int) -> None:
         """
         get the selected email from the server and displays it
         """
-        email_id = self._get_inbox_reading_choice(emails)
-
-        payload = gloutils.EmailChoicePayload(choice=email_id)
-        response = self._send_receive(gloutils.Headers.INBOX_READING_CHOICE, payload)
-
-        if self._is_response_ok(response):
-            print(f"\n{_payload_to_email(response['payload'])}")
+        try:
+            email, stream = self._client.fetch_streamed(email_id)
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
+            return
+        if stream is None:
+            print(f"\n{_payload_to_email(email)}")
+            return
+        # Le contenu reçu en morceaux est affiché à partir du disque, après
+        # les entêtes du gabarit (dont le contenu est vide).
+        try:
+            print(f"\n{_payload_to_email(email)[:-1]}", end="")
+            stream.copy_to(sys.stdout)
+            print("\n")
+        finally:
+            stream.close()
 
-    def _get_inbox_reading_choice(self, emails: list[str]) -> int:
+    def _get_inbox_reading_choice(self, page: gloutils.EmailListPayload) -> int | str:
         """
-        shows the list of emails to the user and asks them what email they want to read
+        shows the current page of emails to the user and asks them what email
+        they want to read, or if they want to see another page
         """
+        emails = page["email_list"]
+        total = page["total"]
+        has_next = page["offset"] + len(emails) < total
+        has_previous = page["offset"] > 0
+
         print("\nEmails in inbox")
         for email in emails:
             print(f"{email}")
+        print(gloutils.INBOX_PAGE_DISPLAY.format(
+            first=page["offset"] + 1,
+            last=page["offset"] + len(emails),
+            total=total
+        ))
 
         choice = input("enter the number of the email you would like to consult\n")
 
-        if re.search(r"[^0-9]", choice) is not None:
+        if choice == "n" and has_next or choice == "p" and has_previous:
+            return choice
+
+        if re.search(r"[^0-9]", choice) is not None or not choice:
             print(f"\n'{choice}' n'est pas un nombre.")
-            return self._get_inbox_reading_choice(emails)
+            return self._get_inbox_reading_choice(page)
 
-        if int(choice) not in range(1, len(emails) + 1):
+        if int(choice) not in range(1, total + 1):
             print(f"\n'{choice}' ne correspond pas au numéro d'un courriel listé.")
-            return self._get_inbox_reading_choice(emails)
+            return self._get_inbox_reading_choice(page)
 
-        return choice
+        return int(choice)
 
     def _send_email(self) -> None:
         """
         Demande à l'utilisateur respectivement:
-        - l'adresse email du destinataire,
+        - l'adresse email du destinataire, ou plusieurs adresses séparées
+        par des virgules,
         - le sujet du message,
         - le corps du message.
 
@@ -158,29 +221,28 @@ class Client:
         Transmet ces informations avec l'entête `EMAIL_SENDING`.
         """
 
-        payload = self._make_email_content_payload()
-        response = self._send_receive(gloutils.Headers.EMAIL_SENDING, payload)
-
-        if self._is_response_ok(response):
-            print("\nemail was sent sucessfully")
-
-    def _make_email_content_payload(self) -> gloutils.EmailContentPayload:
         dest, sub, body = self._get_email_infos()
+        try:
+            result = self._client.send(dest, sub, body)
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
+            return
 
-        return gloutils.EmailContentPayload(
-            sender=f"{self._username}@{gloutils.SERVER_DOMAIN}",
-            destination=dest,
-            subject=sub,
-            date=gloutils.get_current_utc_time(),
-            content=body
-        )
+        if result is None:
+            print("\nemail was sent sucessfully")
+        elif "recipients" in result:
+            print()
+            for status in result["recipients"]:
+                print(f"{status['address']} : {status['status']} {status.get('error', '')}")
+        else:
+            print(f"\nemail was queued for delivery (id {result['id']})")
 
     @staticmethod
     def _get_email_infos() -> (str, str, str):
         """
         asks the user for the informations necessary for the email
         """
-        dest: str = input("Adresse email du destinataire : ")
+        dest: str = input("Adresse email du destinataire (plusieurs adresses séparées par des virgules) : ")
         subject: str = input("Sujet du message : ")
 
         # Insert body here
@@ -188,17 +250,11 @@ class Client:
         lines = []
         while True:
             line = input()
-            if len(line) == 0:
-                lines.append("")
-            elif line[len(line) - 1] != ".":
-                lines.append(line)
-            else:
+            if line == ".":
                 break
+            lines.append(line)
 
-        body = '\n'.join(lines)
-        body = body.encode('utf-8')
-
-        return dest, subject, str(body)
+        return dest, subject, '\n'.join(lines)
 
     def _check_stats(self) -> None:
         """
@@ -206,61 +262,23 @@ class Client:
 
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
-        response = self._send_receive(gloutils.Headers.STATS_REQUEST)
-
-        if self._is_response_ok(response):
-            print(f"\n{_payload_to_stats(response['payload'])}")
+        try:
+            print(f"\n{_payload_to_stats(self._client.stats())}")
+        except gloclient.MailClientError as ex:
+            _print_error(ex)
 
     def _logout(self) -> None:
         """
         Préviens le serveur avec l'entête `AUTH_LOGOUT`.
-
-        Met à jour l'attribut `_username`.
-        """
-        message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT)
-        glosocket.send_msg(self._socket, json.dumps(message))
-        self._username = None
-
-    def _send_receive(self, header, payload=None):
-        """
-        abstracts the encapsulation, communication and checks for errors and stuff
         """
-        if payload:
-            self._send(header, payload)
-        else:
-            message = gloutils.GloMessage(header=header)
-            glosocket.send_msg(self._socket, json.dumps(message))
-
-        response = glosocket.recv_msg(self._socket)
-
-        return json.loads(response)
-
-    def _send(self, header, payload) -> None:
-        message = gloutils.GloMessage(
-            header=header,
-            payload=payload
-        )
-
-        glosocket.send_msg(self._socket, json.dumps(message))
-
-    @staticmethod
-    def _is_response_ok(response: dict) -> bool:
-        if response["header"] == gloutils.Headers.OK:
-            return True
-        elif response["header"] == gloutils.Headers.ERROR:
-            payload = response["payload"]
-            print(f"\nERROR : {payload['error_message']}")
-            return False
-        else:
-            print(f"\nERROR : server's message was not recognised")
-            return False
+        self._client.logout()
 
     def run(self) -> None:
         """Point d'entrée du client."""
         should_quit = False
 
         while not should_quit:
-            if not self._username:
+            if not self._client.username:
                 action = input(f"\n{gloutils.CLIENT_AUTH_CHOICE}\n")
                 if re.search(r"[^0-9]", action) is not None:
                     print(f"\n'{action}' n'est pas un nombre.")
@@ -277,6 +295,7 @@ class Client:
                     case _:
                         print("La valeur entrée ne corresponds pas à une des options listées")
             else:
+                self._client.poll_notifications()
                 action = input(f"\n{gloutils.CLIENT_USE_CHOICE}\n")
                 if re.search(r"[^0-9]", action) is not None:
                     print(f"\n'{action}' n'est pas un nombre.")
@@ -290,6 +309,8 @@ class Client:
                     case 3:
                         self._check_stats()
                     case 4:
+                        self._search_emails()
+                    case 5:
                         self._logout()
                     case _:
                         print("La valeur entrée ne corresponds pas à une des options listées")
@@ -300,12 +321,26 @@ def _main() -> int:
     parser.add_argument("-d", "--destination", action="store",
                         dest="dest", required=True,
                         help="Adresse IP/URL du serveur.")
+    parser.add_argument("-e", "--encoding", action="store",
+                        dest="encoding", choices=list(glocodec.CODECS),
+                        default=glocodec.BinaryCodec.name,
+                        help="Encodage des messages proposé au serveur.")
+    parser.add_argument("--no-compress", action="store_false",
+                        dest="compress",
+                        help="Désactive la compression des grands messages.")
+    parser.add_argument("--no-stream", action="store_false",
+                        dest="stream",
+                        help="Désactive la transmission en morceaux des gros courriels.")
     args = parser.parse_args(sys.argv[1:])
-    client = Client(args.dest)
+    client = Client(args.dest, args.encoding, args.compress, args.stream)
     client.run()
     return 0
 
 
+def _print_error(error: gloclient.MailClientError) -> None:
+    print(f"\nERROR : {error}")
+
+
 def _payload_to_stats(stats: dict) -> gloutils.StatsPayload:
     return gloutils.STATS_DISPLAY.format(
         count=stats["count"],
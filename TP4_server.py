@@ -5,60 +5,208 @@ Noms et numéros étudiants:
 -
 -
 """
-from datetime import datetime
-from email.message import EmailMessage
-import hashlib
-import hmac
-import json
+from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import asyncio
+import collections
 import os
+import queue
 import select
-import smtplib
+import signal
 import socket
 import sys
 import re
-
+import threading
+import time
+
+import gloauth
+import glocodec
+import glolists
+import glometrics
+import gloprofile
+import glorelay
 import glosocket
+import glostorage
+import glostream
 import gloutils
 
+ASYNC_EXECUTOR_WORKERS = 16
+# Un client dont autant de messages attendent n'est plus lu jusqu'à leur traitement.
+MAX_BACKLOG_FRAMES = 16
+MAX_RECIPIENTS = 1000
+DELIVERED = "delivered"
 SCALES = ["", "K", "M", "G", "T", "P", "E", "Z", "Y", "Br"]
 
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, quota: Optional[int] = None, reuse_port: bool = False,
+                 smtp_server: str = gloutils.SMTP_SERVER, smtp_port: int = 25,
+                 relay_workers: int = 1,
+                 smtp_max_messages: int = glorelay.SMTP_MAX_MESSAGES,
+                 auth_workers: Optional[int] = None,
+                 scrypt_n: int = gloauth.SCRYPT_N,
+                 storage: str = glostorage.FileSystemStorage.name,
+                 retention: Optional[float] = None,
+                 cache_bytes: int = glostorage.CACHE_MAX_BYTES,
+                 max_frame_size: int = glostream.MAX_FRAME_SIZE,
+                 max_content_size: int = glostream.MAX_CONTENT_SIZE,
+                 admins: Optional[list[str]] = None,
+                 metrics_file: Optional[str] = None,
+                 metrics_interval: float = glometrics.EXPORT_INTERVAL,
+                 slow_request_threshold: float = gloprofile.SLOW_REQUEST_THRESHOLD,
+                 slow_request_log: Optional[str] = None,
+                 profile_dir: str = ".") -> None:
         """
         Prépare le socket du serveur `_server_socket`
         et le met en mode écoute.
 
+        `quota` est la taille maximale en octets attribuée à la boîte
+        des nouveaux comptes, None pour une taille illimitée.
+
+        `reuse_port` permet à plusieurs processus d'écouter sur le même
+        port (SO_REUSEPORT), le noyau répartissant les connexions.
+
+        `smtp_server` et `smtp_port` désignent le relais des courriels
+        externes, envoyés en arrière-plan par la file `_relay` avec
+        `relay_workers` fils et sessions SMTP, chaque session servant
+        au plus `smtp_max_messages` courriels.
+
+        `auth_workers` et `scrypt_n` sont le nombre de processus et le
+        coût de scrypt utilisés par `_auth` pour hacher les mots de passe.
+
+        `storage` choisit le stockage `_storage` des comptes et des
+        courriels: "fs" (un fichier par courriel), "log" (un fichier
+        segment par utilisateur) ou "sqlite". Avec "log", les courriels
+        sont retirés après `retention` secondes si elle est donnée.
+        Les listes et les courriels lus sont gardés en mémoire dans la
+        limite de `cache_bytes` octets, 0 pour désactiver le cache.
+
+        Les listes de distribution `_lists` sont lues du fichier
+        LISTS_FILENAME du dossier des données.
+
+        Un client qui envoie une trame de plus de `max_frame_size` octets
+        est déconnecté. Les contenus plus grands sont transmis en morceaux
+        (voir glostream), dans la limite de `max_content_size` octets.
+
+        Les métriques `_metrics` (voir glometrics) ne sont transmises
+        qu'aux utilisateurs de `admins`. Si `metrics_file` est donné,
+        elles y sont écrites au format Prometheus toutes les
+        `metrics_interval` secondes.
+
+        Les requêtes traitées en plus de `slow_request_threshold`
+        secondes (0 pour désactiver) sont journalisées avec le détail de
+        leur durée dans `slow_request_log`, ou sur la sortie standard.
+        `start_profiler` écrit ses profils dans `profile_dir`.
+
         Prépare les attributs suivants:
         - `_client_socs` une liste des sockets clients.
+        - `_decoders` et `_writers` associant chaque socket client à son
+            décodeur de messages et à son tampon d'écriture.
+        - `_codecs` associant chaque client à l'encodage négocié, JSON
+            par défaut.
+        - `_compressing` l'ensemble des clients qui acceptent les
+            messages compressés, et `_streaming` ceux qui acceptent les
+            contenus en morceaux.
+        - `_streams` le contenu en cours de réception de chaque client
+            qui transmet un courriel en morceaux.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
+        - `_subscribers` l'index inverse associant chaque nom
+            d'utilisateur (en majuscules) aux clients abonnés aux avis
+            de nouveaux courriels.
+        - `_backlogs` les messages reçus de chaque client et pas encore
+            traités, et `_deferred` l'ensemble des clients dont une
+            réponse est en cours de calcul hors de la boucle.
+        - `_completed` la file des réponses calculées hors de la boucle,
+            signalées par une écriture sur `_wakeup_writer`.
 
         S'assure que les dossiers de données du serveur existent.
         """
-        self._server_socket = self._make_server_socket("127.0.0.1", gloutils.APP_PORT)
+        self._server_socket = self._make_server_socket("127.0.0.1", gloutils.APP_PORT, reuse_port)
         self._client_socs: list[socket.socket] = []
+        self._decoders: dict[socket.socket, glosocket.FrameDecoder] = {}
+        self._writers: dict[socket.socket, glosocket.FrameWriter] = {}
+        self._codecs = {}
+        self._compressing = set()
+        self._streaming = set()
+        self._streams: dict[socket.socket, glostream.IncomingStream] = {}
+        self._max_frame_size = max_frame_size
+        self._max_content_size = max_content_size
         self._logged_users = {}
+        self._subscribers: dict[str, set] = {}
+        self._subscribers_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._quota = quota
+        self._backlogs: dict[socket.socket, collections.deque[bytes]] = {}
+        self._deferred: set[socket.socket] = set()
+        self._completed = queue.SimpleQueue()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._auth = gloauth.Authenticator(auth_workers, scrypt_n)
+        self._metrics = glometrics.Metrics()
+        self._admins = {admin.upper() for admin in admins or ()}
+        # Seuls les accès au stockage lui-même, sous le cache, comptent comme disque.
+        # `stats`, que le cache appelle pour valider chacune de ses entrées, est exclu
+        # pour qu'une requête servie par le cache ne compte pas comme un accès disque.
+        self._storage = glometrics.TimedProxy(
+            glostorage.open_storage(storage, gloutils.SERVER_DATA_DIR, retention), self._metrics, "disk",
+            exclude=("stats",))
+        if cache_bytes > 0:
+            self._storage = glostorage.CachedStorage(self._storage, cache_bytes)
+            self._add_cache_gauges(self._storage)
+        self._slow_log = None
+        if slow_request_threshold > 0:
+            self._slow_log = gloprofile.SlowRequestLog(slow_request_threshold, slow_request_log)
+        self._profiler = gloprofile.SamplingProfiler()
+        self._profile_dir = profile_dir
+        self._metrics.add_gauge("logged_in_users", lambda: len(set(self._logged_users.copy().values())))
+        self._lists = glolists.DistributionLists(
+            os.path.join(gloutils.SERVER_DATA_DIR, gloutils.LISTS_FILENAME))
 
-        if not os.path.exists(gloutils.SERVER_DATA_DIR):
-            os.makedirs(gloutils.SERVER_DATA_DIR)
         server_lost_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
-        if not os.path.exists(server_lost_dir_path):
-            os.makedirs(server_lost_dir_path)
+        os.makedirs(server_lost_dir_path, exist_ok=True)
+
+        spool_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_SPOOL_DIR)
+        self._relay = glorelay.RelayQueue(spool_dir_path, smtp_server, smtp_port,
+                                          relay_workers, smtp_max_messages, self._metrics)
+        self._relay.start()
+
+        self._exporter = None
+        if metrics_file is not None:
+            self._exporter = glometrics.MetricsExporter(self._metrics, metrics_file, metrics_interval)
+            self._exporter.start()
+
+    def _add_cache_gauges(self, cache: glostorage.CachedStorage) -> None:
+        for name in ("hits", "misses", "evictions", "entries", "bytes"):
+            self._metrics.add_gauge(f"cache_{name}", lambda name=name: cache.counters()[name])
 
     def cleanup(self) -> None:
-        """Ferme toutes les connexions résiduelles."""
+        """
+        Ferme toutes les connexions résiduelles et arrête la file d'envoi
+        et les processus de hachage.
+        """
         for client_soc in self._client_socs:
             client_soc.close()
         self._server_socket.close()
-
-    def _make_server_socket(self, source: str, port: int) -> socket.socket:
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+        self._relay.stop()
+        self._auth.shutdown()
+        self._storage.close()
+        if self._exporter is not None:
+            self._exporter.stop()
+
+    def _make_server_socket(self, source: str, port: int, reuse_port: bool = False) -> socket.socket:
         """ setup for the server socket """
         try:
             server_soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # IPV4, TCP
             server_soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                server_soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_soc.bind((source, port))
             server_soc.listen()
 
@@ -70,28 +218,46 @@ class Server:
     def _accept_client(self) -> None:
         """Accepte un nouveau client."""
         client_socket, _ = self._server_socket.accept()
+        client_socket.setblocking(False)
         self._client_socs.append(client_socket)
+        self._decoders[client_socket] = glosocket.FrameDecoder(self._max_frame_size)
+        self._writers[client_socket] = glosocket.FrameWriter(client_socket)
+        self._backlogs[client_socket] = collections.deque()
+        self._metrics.connection_opened()
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
         self._logout(client_soc)
         if client_soc in self._client_socs:
             self._client_socs.remove(client_soc)
+            self._metrics.connection_closed()
+        self._decoders.pop(client_soc, None)
+        self._writers.pop(client_soc, None)
+        self._codecs.pop(client_soc, None)
+        self._compressing.discard(client_soc)
+        self._streaming.discard(client_soc)
+        stream = self._streams.pop(client_soc, None)
+        if stream is not None:
+            stream.close()
+        self._backlogs.pop(client_soc, None)
+        self._deferred.discard(client_soc)
         client_soc.close()
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> gloutils.GloMessage | Future:
         """
         Crée un compte à partir des données du payload.
 
         Si les identifiants sont valides, créee le dossier de l'utilisateur,
         associe le socket au nouvel l'utilisateur et retourne un succès,
         sinon retourne un message d'erreur.
+
+        Le mot de passe est haché hors de la boucle: la réponse est alors
+        un Future du message de succès.
         """
         username = payload['username']
         password = payload['password']
-        user_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, username.upper())
 
         if not _is_username_valid(username):
             return _error_message(
@@ -99,90 +265,188 @@ class Server:
         if not _is_password_valid(password):
             return _error_message(
                 "le mot de passe a moins de 10 caractères et/ou ne contient pas au moins une majuscule, une minuscule et un chiffre")
-        if os.path.exists(user_dir_path):
+        if self._storage.user_exists(username) or self._lists.is_list(username):
             return _error_message("ce nom d'utilisateur existe déjà")
 
-        os.makedirs(user_dir_path)
-        _save_password(user_dir_path, password)
+        def _created(hashed_password: str) -> gloutils.GloMessage:
+            try:
+                self._storage.create_user(username, hashed_password, self._quota)
+            except glostorage.UserExistsError:
+                return _error_message("ce nom d'utilisateur existe déjà")
+            self._auth.remember(username.upper(), password)
+            self._link_socket_to_user(client_soc, username)
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
 
-        self._link_socket_to_user(client_soc, username)
-        return gloutils.GloMessage(header=gloutils.Headers.OK)
+        return _then(self._auth.hash(password), _created)
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
-               ) -> gloutils.GloMessage:
+               ) -> gloutils.GloMessage | Future:
         """
         Vérifie que les données fournies correspondent à un compte existant.
 
         Si les identifiants sont valides, associe le socket à l'utilisateur et
         retourne un succès, sinon retourne un message d'erreur.
+
+        Une connexion réussie récemment est acceptée sans lire le disque.
+        Sinon, la vérification est faite hors de la boucle et la réponse
+        est un Future; un hachage d'un ancien format est alors remplacé.
         """
         username = payload['username']
         password = payload['password']
-        user_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, username.upper())
 
-        if not os.path.exists(user_dir_path):
+        if self._auth.is_cached(username.upper(), password):
+            self._link_socket_to_user(client_soc, username)
+            return _success_message(gloutils.AuthPayload(username=username, password=password))
+
+        saved_password = self._storage.get_password(username)
+        if saved_password is None:
             return _error_message("cet utilisateur n'existe pas")
 
-        saved_password = _read_password(user_dir_path)
-        given_password = _hash_password(password)
-        if not given_password == saved_password:
-            return _error_message("mauvais mot de passe")
+        def _verified(is_valid: bool) -> gloutils.GloMessage:
+            if not is_valid:
+                return _error_message("mauvais mot de passe")
+            if self._auth.needs_rehash(saved_password):
+                self._auth.hash(password).add_done_callback(
+                    lambda hashed: self._storage.set_password(username, hashed.result()))
+            self._auth.remember(username.upper(), password)
+            self._link_socket_to_user(client_soc, username)
+            return _success_message(gloutils.AuthPayload(username=username, password=password))
 
-        self._link_socket_to_user(client_soc, username)
-        return _success_message(gloutils.AuthPayload(username=username, password=password))
+        return _then(self._auth.verify(password, saved_password), _verified)
 
     def _link_socket_to_user(self, client_soc: socket.socket, username: str) -> None:
+        self._unsubscribe(client_soc)
         self._logged_users[client_soc] = username
 
     def _logout(self, client_soc: socket.socket) -> None:
         """Déconnecte un utilisateur."""
+        self._unsubscribe(client_soc)
         if client_soc in self._logged_users:
             del self._logged_users[client_soc]
 
-    def _get_email_list(self, client_soc: socket.socket) -> gloutils.GloMessage:
+    def _subscribe(self, client_soc: socket.socket,
+                   payload: gloutils.SubscribePayload = None) -> gloutils.GloMessage:
+        """
+        Abonne la session aux avis de nouveaux courriels de l'utilisateur
+        associé au socket, ou la désabonne si `enabled` est faux.
+        """
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return _error_message("aucun utilisateur n'est connecté")
+
+        if (payload or {}).get("enabled", True):
+            with self._subscribers_lock:
+                self._subscribers.setdefault(username.upper(), set()).add(client_soc)
+        else:
+            self._unsubscribe(client_soc)
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _unsubscribe(self, client_soc: socket.socket) -> None:
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return
+        with self._subscribers_lock:
+            clients = self._subscribers.get(username.upper())
+            if clients is not None:
+                clients.discard(client_soc)
+                if not clients:
+                    del self._subscribers[username.upper()]
+
+    def _notify_new_mail(self, username: str, payload: gloutils.EmailContentPayload) -> None:
+        """
+        Envoie un avis NEW_MAIL aux sessions abonnées du destinataire.
+
+        Seules les sessions de ce processus sont avisées.
+        """
+        with self._subscribers_lock:
+            clients = list(self._subscribers.get(username.upper(), ()))
+        if not clients:
+            return
+
+        message = gloutils.GloMessage(header=gloutils.Headers.NEW_MAIL,
+                                      payload=gloutils.NewMailPayload(
+                                          sender=payload["sender"],
+                                          subject=payload["subject"],
+                                          date=payload["date"]))
+        for client in clients:
+            data = self._codecs.get(client, glocodec.DEFAULT_CODEC).encode(message)
+            self._metrics.add_bytes(sent=len(data))
+            compress = client in self._compressing
+            if isinstance(client, asyncio.StreamWriter):
+                self._loop.call_soon_threadsafe(_push_async, client, data, compress)
+            elif client in self._writers:
+                self._writers[client].write(data, compress)
+                self._flush(client)
+
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: gloutils.InboxRequestPayload = None
+                        ) -> gloutils.GloMessage:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
         Les éléments de la liste sont construits à l'aide du gabarit
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
+        Si le payload précise `offset` et `limit`, seule cette tranche est
+        formatée et retournée, avec le nombre total de courriels.
+
         Une absence de courriel n'est pas une erreur, mais une liste vide.
         """
-        username = self._logged_users[client_soc]
-        email_list = self._get_sorted_email_list(username)
-        subject_display_list = []
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return _error_message("aucun utilisateur n'est connecté")
+
+        payload = payload or {}
+        offset = max(int(payload.get("offset", 0)), 0)
+        limit = payload.get("limit")
+        if limit is not None:
+            limit = max(int(limit), 0)
 
-        for i, data in enumerate(email_list, start=1):
+        summaries, total = self._storage.list_emails(username, offset, limit)
+        subject_display_list = []
+        for i, entry in enumerate(summaries, start=offset + 1):
             subject = gloutils.SUBJECT_DISPLAY.format(
                 number=i,
-                sender=data["sender"],
-                subject=data["subject"],
-                date=data["date"]
+                sender=entry["sender"],
+                subject=entry["subject"],
+                date=entry["date"]
             )
             subject_display_list.append(subject)
 
-        return _success_message(gloutils.EmailListPayload(email_list=subject_display_list))
+        return _success_message(gloutils.EmailListPayload(
+            email_list=subject_display_list,
+            offset=offset,
+            total=total
+        ))
 
-    def _get_sorted_email_list(self, username: str) -> list:
-        """
-        Retourne la liste triée par date des emails en format json présents 
-        dans le dossier utilisateur
+    def _search_emails(self, client_soc: socket.socket,
+                       payload: gloutils.SearchPayload) -> gloutils.GloMessage:
         """
-        user_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, username.upper())
-        user_emails = os.listdir(user_dir_path)
-        user_emails.remove(gloutils.PASSWORD_FILENAME)
-        email_data_list = []
+        Recherche les courriels de l'utilisateur associé au socket qui
+        contiennent tous les mots de la requête, à l'aide de l'index
+        inversé tenu à jour par le stockage.
 
-        for email_file in user_emails:
-            file_path = os.path.join(user_dir_path, email_file)
-            email_file = open(file_path, encoding='utf-8')
-            email_data = json.load(email_file)
-            email_data_list.append(email_data)
-            email_file.close()
-
-        emails_sorted_list = sorted(email_data_list,
-                                    key=lambda data: datetime.strptime(data['date'], "%a, %d %b %Y %H:%M:%S %z"),
-                                    reverse=True)
-        return emails_sorted_list
+        Les résultats sont construits à l'aide du gabarit SUBJECT_DISPLAY,
+        du plus pertinent au moins pertinent, avec le numéro du courriel
+        dans la liste complète.
+        """
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return _error_message("aucun utilisateur n'est connecté")
+
+        limit = max(int(payload.get("limit", gloutils.INBOX_PAGE_SIZE)), 0)
+        results, total = self._storage.search(username, str(payload.get("query", "")), limit)
+        email_list = [gloutils.SUBJECT_DISPLAY.format(
+            number=number,
+            sender=entry["sender"],
+            subject=entry["subject"],
+            date=entry["date"]
+        ) for number, entry in results]
+
+        return _success_message(gloutils.EmailListPayload(
+            email_list=email_list,
+            offset=0,
+            total=total
+        ))
 
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
@@ -191,34 +455,28 @@ class Server:
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
         au socket.
         """
-        username = self._logged_users[client_soc]
-        choice = int(payload['choice'])
-        email = self._get_sorted_email_list(username)[choice - 1]
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return _error_message("aucun utilisateur n'est connecté")
+        email = self._storage.fetch(username, int(payload['choice']))
+        if email is None:
+            return _error_message("ce courriel n'existe pas")
 
         return _success_message(_email_content_payload(email))
 
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
-        Récupère le nombre de courriels et la taille du dossier et des fichiers
-        de l'utilisateur associé au socket.
+        Récupère le nombre de courriels et leur taille totale à partir des
+        compteurs de la boîte de l'utilisateur associé au socket.
         """
-        username = self._logged_users[client_soc]
-        user_dir = os.path.join(gloutils.SERVER_DATA_DIR, username.upper())
-        list_emails = os.listdir(user_dir)
-        list_emails.remove(gloutils.PASSWORD_FILENAME)
-
-        if list_emails is None:
-            nb_emails = 0
-        else:
-            nb_emails = len(list_emails)
-
-        user_dir_size = 0
-        for (current_dir, sousDossiers, files) in os.walk(user_dir):
-            user_dir_size += sum(os.path.getsize(os.path.join(current_dir, file)) for file in files)
+        username = self._logged_users.get(client_soc)
+        if username is None:
+            return _error_message("aucun utilisateur n'est connecté")
+        count, size = self._storage.stats(username)
 
-        formatted_user_dir_size = _format_size(user_dir_size, SCALES[0])
+        formatted_size = _format_size(size)
 
-        stat_payload = gloutils.EmailChoicePayload(count=nb_emails, size=formatted_user_dir_size)
+        stat_payload = gloutils.StatsPayload(count=count, size=formatted_size)
         return _success_message(stat_payload)
 
     def _send_email(self, payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
@@ -228,96 +486,534 @@ class Server:
         du destinataire.
         - Si le destinataire n'existe pas, place le message dans le dossier
         SERVER_LOST_DIR et considère l'envoi comme un échec.
-        - Si le destinataire est externe, transforme le message en
-        EmailMessage et utilise le serveur SMTP pour le relayer.
+        - Si le destinataire est externe, place le message dans la file
+        d'envoi, relayée au serveur SMTP en arrière-plan.
 
         Retourne un messange indiquant le succès ou l'échec de l'opération.
+
+        Si `destination` contient plusieurs adresses ou une liste de
+        distribution, l'envoi est traité par `_send_email_to_many`.
         """
-        destination = payload["destination"]
-        if re.search(r"(^[a-zA-Z0-9_\.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-\.]+$)", destination) is not None:
+        addresses = _split_addresses(payload["destination"])
+        if len(addresses) != 1 or self._lists.is_list_address(addresses[0]):
+            return self._send_email_to_many(payload, addresses)
+
+        destination = addresses[0]
+        if _ADDRESS_PATTERN.search(destination) is not None:
 
-            if re.search(fr"@{gloutils.SERVER_DOMAIN}?", destination):
+            if _INTERNAL_PATTERN.search(destination):
                 return self._handle_internal_email(payload)
             else:
                 return self._handle_external_email(payload)
 
         return _error_message("destinataire invalide")
 
-    @staticmethod
-    def _handle_external_email(payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
-        destination = payload["destination"]
+    def _send_email_to_many(self, payload: gloutils.EmailContentPayload,
+                            addresses: list[str]) -> gloutils.GloMessage:
+        """
+        Envoie le courriel à chaque adresse, les listes de distribution
+        étant remplacées par leurs membres.
+
+        Les destinataires internes sont livrés ensemble par le stockage;
+        les destinataires externes partagent une seule entrée de la file
+        d'envoi. Retourne l'état de l'envoi à chaque destinataire.
+        """
+        recipients = self._lists.expand(addresses)
+        if not recipients:
+            return _error_message("destinataire invalide")
+        if len(recipients) > MAX_RECIPIENTS:
+            return _error_message(f"un courriel ne peut avoir plus de {MAX_RECIPIENTS} destinataires")
+
+        statuses: dict[str, gloutils.RecipientStatusPayload] = {}
+        internal: dict[str, str] = {}
+        external = []
+        for address in recipients:
+            if _ADDRESS_PATTERN.search(address) is None:
+                statuses[address] = _recipient_status(address, glorelay.FAILED, "destinataire invalide")
+            elif _INTERNAL_PATTERN.search(address):
+                internal[_internal_username(address)] = address
+            else:
+                external.append(address)
+
+        if external:
+            # Refusé avant toute livraison, pour ne pas envoyer qu'une partie du courriel.
+            try:
+                glorelay.check_email(payload)
+            except glorelay.RelayError as e:
+                return _error_message(f"courriel invalide pour un envoi externe: {e}")
+        if internal:
+            errors = self._deliver_internal(payload, list(internal))
+            for username, address in internal.items():
+                error = errors[username]
+                if error is None:
+                    statuses[address] = _recipient_status(address, DELIVERED)
+                else:
+                    statuses[address] = _recipient_status(address, glorelay.FAILED, error)
+        if external:
+            entry = self._relay.enqueue(payload, external)
+            for address in external:
+                statuses[address] = _recipient_status(address, entry["status"])
+                statuses[address]["id"] = entry["id"]
+
+        return _success_message(gloutils.SendingReportPayload(
+            recipients=[statuses[address] for address in recipients]))
 
-        message = EmailMessage()
-        message["From"] = payload["sender"]
-        message["To"] = payload["destination"]
-        message["Subject"] = payload["subject"]
-        message["Date"] = payload["date"]
-        message.set_content(payload["content"])
+    def _handle_external_email(self, payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
+        """
+        Place le courriel dans la file d'envoi et confirme immédiatement,
+        avec l'identifiant permettant d'en suivre la livraison.
+        """
         try:
-            with smtplib.SMTP(host=gloutils.SMTP_SERVER, timeout=10) as connection:
-                connection.send_message(message)
-                return gloutils.GloMessage(header=gloutils.Headers.OK)
-        except smtplib.SMTPException:
-            return _error_message("Le message n'a pas pu être envoyé.")
-        except socket.timeout:
-            return _error_message("Le serveur SMTP est injoinable.")
-
-    @staticmethod
-    def _handle_internal_email(payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
-        destination = payload['destination']
-        username = destination.replace(f"@{gloutils.SERVER_DOMAIN}", "", 1)
-        dir_path = os.path.join(gloutils.SERVER_DATA_DIR, username.upper())
-        if os.path.exists(dir_path):
+            entry = self._relay.enqueue(payload)
+        except glorelay.RelayError as e:
+            return _error_message(f"courriel invalide pour un envoi externe: {e}")
+        return _success_message(_delivery_status_payload(entry))
+
+    def _get_delivery_status(self, client_soc: socket.socket,
+                             payload: gloutils.DeliveryStatusPayload
+                             ) -> gloutils.GloMessage:
+        """
+        Retourne l'état de livraison d'un courriel externe envoyé par
+        l'utilisateur associé au socket.
+        """
+        username = self._logged_users.get(client_soc)
+        entry = self._relay.status(str(payload.get("id", "")))
+        if username is None or entry is None \
+                or entry["payload"]["sender"].lower() != f"{username}@{gloutils.SERVER_DOMAIN}".lower():
+            return _error_message("cet envoi n'existe pas")
+        return _success_message(_delivery_status_payload(entry))
+
+    def _handle_internal_email(self, payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
+        username = _internal_username(payload['destination'].strip())
+        error = self._deliver_internal(payload, [username])[username]
+        if error is not None:
+            return _error_message(error)
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _deliver_internal(self, payload: gloutils.EmailContentPayload,
+                          usernames: list[str]) -> dict[str, Optional[str]]:
+        """
+        Livre le courriel aux comptes du serveur en un seul appel au
+        stockage et avise leurs sessions abonnées.
+
+        Retourne pour chaque utilisateur None ou le message d'erreur.
+        Le courriel est placé dans SERVER_LOST_DIR si un destinataire
+        n'existe pas.
+        """
+        errors = {}
+        lost = False
+        for username, error in self._storage.deliver_many(usernames, payload).items():
+            if error is None:
+                self._notify_new_mail(username, payload)
+                errors[username] = None
+            elif isinstance(error, glostorage.QuotaExceededError):
+                errors[username] = "La boîte du destinataire est pleine."
+            else:
+                lost = True
+                errors[username] = "Le destinataire n'existe pas."
+
+        if lost:
+            dir_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
             file_path = os.path.join(dir_path, payload["subject"])
-            _save(file_path, json.dumps(payload))
-            return gloutils.GloMessage(header=gloutils.Headers.OK)
+            gloutils.save_file(file_path, str(payload))
+        return errors
 
-        dir_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
-        file_path = os.path.join(dir_path, payload["subject"])
-        _save(file_path, str(payload))
-        return _error_message("Le destinataire n'existe pas.")
+    def run(self, engine: str = "select") -> None:
+        """
+        Point d'entrée du serveur.
+
+        `engine` choisit la boucle utilisée: "select" traite les requêtes
+        une à une dans le fil principal, "asyncio" sert chaque client dans
+        une coroutine et délègue le traitement des requêtes à des fils.
+        """
+        if engine == "asyncio":
+            asyncio.run(self._run_async())
+            return
 
-    def run(self):
-        """Point d'entrée du serveur."""
         while True:
-            # Select readable sockets
-            result = select.select(self._client_socs + [self._server_socket], [], [])
+            # Select readable sockets and sockets with pending output
+            pending_writes = [client_soc for client_soc, writer in self._writers.items()
+                              if writer.pending]
+            readers = [client_soc for client_soc in self._client_socs
+                       if len(self._backlogs[client_soc]) < MAX_BACKLOG_FRAMES]
+            readers += [self._server_socket, self._wakeup_reader]
+            result = select.select(readers, pending_writes, [])
             waiters: list[socket.socket] = result[0]
+            for writable in result[1]:
+                self._flush(writable)
             for waiter in waiters:
                 if waiter == self._server_socket:
                     self._accept_client()
-                else:
+                elif waiter == self._wakeup_reader:
+                    self._process_completed()
+                elif waiter in self._decoders:
                     self._process_client(waiter)
 
     def _process_client(self, client_socket: socket.socket):
+        """
+        Lit les octets disponibles du client sans bloquer et traite
+        chaque message complet reçu, puis transmet les réponses en bloc.
+        """
         try:
-            message = glosocket.recv_msg(client_socket)
+            messages = self._decoders[client_socket].recv_from(client_socket)
         except glosocket.GLOSocketError as e:
             print(f"an exeption occured : {e}")
             self._remove_client(client_socket)
             return
 
-        match json.loads(message):
+        self._metrics.add_bytes(received=sum(map(len, messages)))
+        self._backlogs[client_socket].extend(messages)
+        self._process_backlog(client_socket)
+
+    def _process_backlog(self, client_socket: socket.socket) -> None:
+        """
+        Traite dans l'ordre les messages en attente du client.
+
+        Si une réponse est calculée hors de la boucle, les messages
+        suivants attendent qu'elle soit transmise, pour que le client
+        reçoive ses réponses dans l'ordre de ses requêtes.
+
+        Les trames qui suivent un message annonçant un contenu en
+        morceaux sont écrites dans le fichier de `_streams`; le message
+        n'est traité qu'une fois son contenu complet.
+        """
+        backlog = self._backlogs[client_socket]
+        while backlog and client_socket not in self._deferred:
+            codec = self._codecs.get(client_socket, glocodec.DEFAULT_CODEC)
+            stream = self._streams.get(client_socket)
+            try:
+                if stream is None:
+                    frame = backlog.popleft()
+                    size = len(frame)
+                    message = codec.decode(frame)
+                    if glostream.is_streamed(message):
+                        stream = glostream.IncomingStream(message, self._max_content_size)
+                        self._streams[client_socket] = stream
+                elif stream.feed(backlog.popleft()):
+                    message = stream.message
+                if stream is not None:
+                    if not stream.done:
+                        continue
+                    del self._streams[client_socket]
+                    # Ses trames ont pu arriver en plusieurs tours: seul le contenu compte.
+                    size = stream.message["payload"]["stream_size"]
+                    if stream.rejected is None:
+                        message = stream.complete()
+            except (glocodec.CodecError, glostream.StreamError) as e:
+                print(f"an exeption occured : {e}")
+                self._remove_client(client_socket)
+                return
+            if message.get("header") == gloutils.Headers.BYE:
+                self._remove_client(client_socket)
+                return
+
+            if stream is not None and stream.rejected is not None:
+                response = _with_id(_error_message(stream.rejected), message)
+            else:
+                response = self._dispatch(client_socket, message, size)
+            if isinstance(response, Future):
+                self._deferred.add(client_socket)
+                response.add_done_callback(
+                    lambda done, client=client_socket, codec=codec, message=message:
+                    self._notify_completed(client, codec, message, done))
+            elif response is not None:
+                self._send(client_socket, response, codec)
+        self._flush(client_socket)
+
+    def _notify_completed(self, client_socket: socket.socket, codec,
+                          message: gloutils.GloMessage, future: Future) -> None:
+        """
+        Place une réponse calculée hors de la boucle dans `_completed` et
+        réveille la boucle. Appelée depuis un autre fil.
+        """
+        self._completed.put((client_socket, codec, message, future))
+        try:
+            self._wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            # La boucle a déjà des réveils en attente.
+            pass
+
+    def _process_completed(self) -> None:
+        """Transmet les réponses calculées hors de la boucle."""
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                client_socket, codec, message, future = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            if client_socket not in self._backlogs:
+                # Le client est parti avant la réponse.
+                self._logout(client_socket)
+                continue
+            self._deferred.discard(client_socket)
+            response = self._deferred_response(message, future)
+            if response is not None:
+                self._send(client_socket, response, codec)
+            self._process_backlog(client_socket)
+
+    def _dispatch(self, client, message: gloutils.GloMessage, size: int = 0
+                  ) -> Optional[gloutils.GloMessage | Future]:
+        """
+        Traite un message selon son entête et retourne la réponse à
+        transmettre au client, ou None si l'entête n'en attend pas.
+
+        La réponse peut être un Future quand elle est calculée hors de la
+        boucle; elle est alors complétée par `_deferred_response`.
+
+        Si le message porte un identifiant `id`, il est recopié dans la
+        réponse pour que le client puisse l'associer à sa requête.
+
+        `client` identifie la connexion dans `_logged_users`.
+
+        La durée du traitement est ajoutée aux métriques, une fois le
+        Future terminé le cas échéant, et journalisée avec le détail de
+        ses phases si elle est lente. `size` est la taille en octets du
+        message reçu.
+
+        Une erreur levée par le traitement (payload mal formé, erreur du
+        stockage) est retournée au client comme une requête refusée,
+        sans interrompre le service des autres clients.
+        """
+        start = time.perf_counter()
+        with self._metrics.tracking() as phases:
+            try:
+                response = self._handle(client, message)
+            except Exception as e:
+                print(f"an exeption occured : {e!r}")
+                response = _error_message("erreur interne du serveur")
+        if isinstance(response, Future):
+            dispatched = time.perf_counter()
+
+            def _observe_deferred(done: Future) -> None:
+                phases["deferred"] = time.perf_counter() - dispatched
+                self._observe_request(client, message, size, start, phases,
+                                      None if done.exception() else done.result())
+            response.add_done_callback(_observe_deferred)
+            return response
+        self._observe_request(client, message, size, start, phases, response)
+        return _with_id(response, message)
+
+    def _handle(self, client, message: gloutils.GloMessage
+                ) -> Optional[gloutils.GloMessage | Future]:
+        """Appelle le traitement correspondant à l'entête du message."""
+        response = None
+        match message:
             case {"header": gloutils.Headers.AUTH_REGISTER, "payload": payload}:
-                self._send(client_socket, self._create_account(client_socket, payload))
+                response = self._create_account(client, payload)
             case {"header": gloutils.Headers.AUTH_LOGIN, "payload": payload}:
-                self._send(client_socket, self._login(client_socket, payload))
+                response = self._login(client, payload)
             case {"header": gloutils.Headers.AUTH_LOGOUT}:
-                self._logout(client_socket)
+                self._logout(client)
+            case {"header": gloutils.Headers.INBOX_READING_REQUEST, "payload": payload}:
+                response = self._get_email_list(client, payload)
             case {"header": gloutils.Headers.INBOX_READING_REQUEST}:
-                self._send(client_socket, self._get_email_list(client_socket))
+                response = self._get_email_list(client)
+            case {"header": gloutils.Headers.SEARCH_REQUEST, "payload": payload}:
+                response = self._search_emails(client, payload)
             case {"header": gloutils.Headers.INBOX_READING_CHOICE, "payload": payload}:
-                self._send(client_socket, self._get_email(client_socket, payload))
+                response = self._get_email(client, payload)
             case {"header": gloutils.Headers.EMAIL_SENDING, "payload": payload}:
-                self._send(client_socket, self._send_email(payload))
+                response = self._send_email(payload)
             case {"header": gloutils.Headers.STATS_REQUEST}:
-                self._send(client_socket, self._get_stats(client_socket))
-            case {"header": gloutils.Headers.BYE}:
-                self._remove_client(client_socket)
+                response = self._get_stats(client)
+            case {"header": gloutils.Headers.HELLO, "payload": payload}:
+                response = self._negotiate(client, payload)
+            case {"header": gloutils.Headers.DELIVERY_STATUS_REQUEST, "payload": payload}:
+                response = self._get_delivery_status(client, payload)
+            case {"header": gloutils.Headers.SUBSCRIBE, "payload": payload}:
+                response = self._subscribe(client, payload)
+            case {"header": gloutils.Headers.SUBSCRIBE}:
+                response = self._subscribe(client)
+            case {"header": gloutils.Headers.METRICS_REQUEST}:
+                response = self._get_metrics(client)
+            case {"header": gloutils.Headers.PROFILE_REQUEST, "payload": payload}:
+                response = self._profile(client, payload)
+            case {"header": gloutils.Headers.PROFILE_REQUEST}:
+                response = self._profile(client)
+        return response
+
+    def _observe_request(self, client, message: gloutils.GloMessage, size: int,
+                         start: float, phases: dict[str, float],
+                         response: Optional[gloutils.GloMessage]) -> None:
+        """
+        Ajoute aux métriques la requête traitée depuis `start`, et la
+        journalise si elle est lente.
+        """
+        try:
+            header = gloutils.Headers(message.get("header")).name
+        except ValueError:
+            header = "UNKNOWN"
+        seconds = time.perf_counter() - start
+        ok = response is None or response.get("header") == gloutils.Headers.OK
+        self._metrics.observe_request(header, seconds, ok)
+        if self._slow_log is not None:
+            self._slow_log.record(header, self._logged_users.get(client), size, seconds, phases)
+
+    def _is_admin(self, client) -> bool:
+        username = self._logged_users.get(client)
+        return username is not None and username.upper() in self._admins
+
+    def _get_metrics(self, client) -> gloutils.GloMessage:
+        """Retourne les métriques du serveur si l'utilisateur est administrateur."""
+        if not self._is_admin(client):
+            return _error_message("cette requête est réservée aux administrateurs")
+        return _success_message(self._metrics.snapshot())
+
+    def _profile(self, client, payload: Optional[gloutils.ProfilePayload] = None
+                 ) -> gloutils.GloMessage:
+        """
+        Lance le profileur si l'utilisateur est administrateur et
+        retourne le chemin du profil à venir.
+        """
+        if not self._is_admin(client):
+            return _error_message("cette requête est réservée aux administrateurs")
+        seconds = (payload or {}).get("seconds", gloprofile.PROFILE_SECONDS)
+        if not isinstance(seconds, (int, float)) or not 0 < seconds <= gloprofile.MAX_PROFILE_SECONDS:
+            return _error_message(f"la durée doit être comprise entre 0 et "
+                                  f"{gloprofile.MAX_PROFILE_SECONDS:g} secondes")
+        try:
+            path = self.start_profiler(seconds)
+        except gloprofile.ProfileError:
+            return _error_message("un profilage est déjà en cours")
+        return _success_message(gloutils.ProfilePayload(seconds=seconds, path=path))
+
+    def start_profiler(self, seconds: float = gloprofile.PROFILE_SECONDS) -> str:
+        """
+        Profile le serveur pendant `seconds` secondes en arrière-plan et
+        retourne le chemin du fichier pstats qui sera écrit à la fin.
+
+        Lève une exception ProfileError si un profilage est déjà en cours.
+        """
+        path = os.path.abspath(os.path.join(
+            self._profile_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.pstats"))
+        self._profiler.start(seconds, path)
+        return path
+
+    def _deferred_response(self, message: gloutils.GloMessage,
+                           future: Future) -> Optional[gloutils.GloMessage]:
+        """Retourne la réponse terminée `future` au message `message`."""
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"an exeption occured : {e}")
+            response = _error_message("erreur interne du serveur")
+        return _with_id(response, message)
 
-    def _send(self, dest: socket.socket, payload) -> None:
+    def _negotiate(self, client, payload: gloutils.HelloPayload) -> gloutils.GloMessage:
+        """
+        Choisit l'encodage des messages suivants du client parmi ceux
+        qu'il propose. La réponse est encore transmise avec l'ancien
+        encodage.
+
+        Active la compression des grands messages et la transmission en
+        morceaux des gros contenus vers le client s'il les accepte.
+        """
+        codec = glocodec.negotiate(payload.get("encodings", []))
+        self._codecs[client] = codec
+        if payload.get("compress"):
+            self._compressing.add(client)
+        if payload.get("stream"):
+            self._streaming.add(client)
+        return _success_message(gloutils.HelloPayload(encoding=codec.name, compress=True, stream=True,
+                                                      max_frame_size=self._max_frame_size))
+
+    async def _run_async(self) -> None:
+        """Sert les clients avec asyncio sur le socket déjà en écoute."""
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS))
+        self._loop = loop
+        server = await asyncio.start_server(self._serve_async_client, sock=self._server_socket)
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_async_client(self, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter) -> None:
+        """
+        Lit les requêtes d'un client tant qu'il est connecté.
+
+        Le traitement de chaque requête (disque, SMTP) est exécuté dans
+        l'exécuteur de la boucle pour ne pas bloquer les autres clients;
+        le hachage des mots de passe est attendu sans occuper de fil.
+
+        Un contenu transmis en morceaux est lu jusqu'au bout avant que
+        son message soit traité.
+        """
+        loop = asyncio.get_running_loop()
+        self._metrics.connection_opened()
         try:
-            glosocket.send_msg(dest, json.dumps(payload))
+            while True:
+                codec = self._codecs.get(writer, glocodec.DEFAULT_CODEC)
+                data = await glosocket.async_recv_data(reader, self._max_frame_size)
+                self._metrics.add_bytes(received=len(data))
+                message = codec.decode(data)
+                if message.get("header") == gloutils.Headers.BYE:
+                    break
+
+                if glostream.is_streamed(message):
+                    stream = glostream.IncomingStream(message, self._max_content_size)
+                    try:
+                        while not stream.done:
+                            chunk = await glosocket.async_recv_data(reader, self._max_frame_size)
+                            self._metrics.add_bytes(received=len(chunk))
+                            stream.feed(chunk)
+                    except BaseException:
+                        stream.close()
+                        raise
+                    if stream.rejected is None:
+                        message = stream.complete()
+                        size = stream.message["payload"]["stream_size"]
+                        response = await loop.run_in_executor(None, self._dispatch, writer, message, size)
+                    else:
+                        response = _with_id(_error_message(stream.rejected), message)
+                else:
+                    response = await loop.run_in_executor(None, self._dispatch, writer, message, len(data))
+                if isinstance(response, Future):
+                    await asyncio.wait([asyncio.wrap_future(response)])
+                    response = self._deferred_response(message, response)
+                if response is not None:
+                    chunks = []
+                    if writer in self._streaming:
+                        response, chunks = glostream.split_message(response)
+                    compress = writer in self._compressing
+                    data = codec.encode(response)
+                    self._metrics.add_bytes(sent=len(data) + sum(map(len, chunks)))
+                    # Un avis NEW_MAIL (`_push_async`) ne doit pas s'intercaler entre les morceaux.
+                    await glosocket.async_send_all(writer, [data, *chunks], compress)
+        except (glosocket.GLOSocketError, glocodec.CodecError, glostream.StreamError) as e:
+            print(f"an exeption occured : {e}")
+        except asyncio.CancelledError:
+            # Arrêt du serveur: la connexion est simplement fermée.
+            pass
+        finally:
+            self._metrics.connection_closed()
+            self._logout(writer)
+            self._codecs.pop(writer, None)
+            self._compressing.discard(writer)
+            self._streaming.discard(writer)
+            writer.close()
+
+    def _send(self, dest: socket.socket, payload, codec=glocodec.DEFAULT_CODEC) -> None:
+        chunks = []
+        if dest in self._streaming:
+            payload, chunks = glostream.split_message(payload)
+        compress = dest in self._compressing
+        data = codec.encode(payload)
+        self._metrics.add_bytes(sent=len(data) + sum(map(len, chunks)))
+        self._writers[dest].write(data, compress)
+        for chunk in chunks:
+            self._writers[dest].write(chunk, compress)
+
+    def _flush(self, dest: socket.socket) -> None:
+        writer = self._writers.get(dest)
+        if writer is None:
+            return
+        try:
+            writer.flush()
         except glosocket.GLOSocketError as e:
             print(f"error : {e}")
             self._remove_client(dest)
@@ -332,6 +1028,50 @@ def _success_message(payload) -> gloutils.GloMessage:
     return gloutils.GloMessage(header=gloutils.Headers.OK, payload=payload)
 
 
+def _push_async(writer: asyncio.StreamWriter, data: bytes, compress: bool) -> None:
+    """Place un avis dans le tampon d'un client asyncio encore connecté."""
+    if not writer.is_closing():
+        glosocket.write_data(writer, data, compress)
+
+
+def _with_id(response: Optional[gloutils.GloMessage],
+             message: gloutils.GloMessage) -> Optional[gloutils.GloMessage]:
+    """Recopie l'identifiant de la requête dans sa réponse."""
+    if response is not None and "id" in message:
+        response["id"] = message["id"]
+    return response
+
+
+def _then(future: Future, callback) -> Future:
+    """
+    Retourne un Future du résultat de `callback` appliqué au résultat
+    de `future`, appelé dans le fil qui termine `future`.
+    """
+    chained = Future()
+
+    def _done(done: Future) -> None:
+        try:
+            chained.set_result(callback(done.result()))
+        except Exception as ex:
+            chained.set_exception(ex)
+
+    future.add_done_callback(_done)
+    return chained
+
+
+def _recipient_status(address: str, status: str, error: str = "") -> gloutils.RecipientStatusPayload:
+    return gloutils.RecipientStatusPayload(address=address, status=status, error=error)
+
+
+def _delivery_status_payload(entry: glorelay.SpoolEntry) -> gloutils.DeliveryStatusPayload:
+    return gloutils.DeliveryStatusPayload(
+        id=entry["id"],
+        status=entry["status"],
+        attempts=entry["attempts"],
+        error=entry["error"]
+    )
+
+
 def _email_content_payload(email) -> gloutils.EmailContentPayload:
     return gloutils.EmailContentPayload(
         sender=email['sender'],
@@ -342,6 +1082,20 @@ def _email_content_payload(email) -> gloutils.EmailContentPayload:
     )
 
 
+_ADDRESS_PATTERN = re.compile(r"(^[a-zA-Z0-9_\.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-\.]+$)")
+_INTERNAL_PATTERN = re.compile(rf"@{re.escape(gloutils.SERVER_DOMAIN)}$", re.IGNORECASE)
+
+
+def _split_addresses(destination: str) -> list[str]:
+    """Retourne les adresses non vides de `destination`, séparées par des virgules."""
+    return [address.strip() for address in destination.split(",") if address.strip()]
+
+
+def _internal_username(address: str) -> str:
+    # Le domaine est reconnu sans égard à la casse (_INTERNAL_PATTERN).
+    return address.rpartition("@")[0]
+
+
 def _is_username_valid(username: str) -> bool:
     """
     vérifies que le nom d'utilisateur ne contient pas des
@@ -358,54 +1112,162 @@ def _is_password_valid(password: str) -> bool:
     return len(password) >= 10 and re.search(r"(?=.*\d)(?=.*[a-z])(?=.*[A-Z])", password) is not None
 
 
-def _save_password(path: str, password: str) -> None:
-    password_file_path = os.path.join(path, gloutils.PASSWORD_FILENAME)
-    _save(password_file_path, _hash_password(password))
-
-
-def _read_password(path: str) -> str:
-    password_file_path = os.path.join(path, gloutils.PASSWORD_FILENAME)
-    password_file = open(password_file_path, "r+")
-    password = password_file.read()
-    password_file.close()
-    return password
-
-
-def _hash_password(password: str) -> str:
-    gfg = hashlib.sha3_512()
-    gfg.update(password.encode('utf-8'))
-    return gfg.hexdigest()
-
+def _format_size(value: float) -> str:
+    scale_index = 0
+    while value >= 1024 and scale_index < len(SCALES) - 1:
+        value /= 1024
+        scale_index += 1
+    return f"{value}{SCALES[scale_index]}"
+
+
+def _serve(args: argparse.Namespace, reuse_port: bool = False) -> None:
+    # SIGTERM arrête le serveur proprement, comme Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = Server(quota=args.quota, reuse_port=reuse_port,
+                    smtp_server=args.smtp_server, smtp_port=args.smtp_port,
+                    relay_workers=args.relay_workers,
+                    smtp_max_messages=args.smtp_max_messages,
+                    auth_workers=args.auth_workers, scrypt_n=args.scrypt_n,
+                    storage=args.storage,
+                    retention=None if args.retention is None else args.retention * 24 * 3600,
+                    cache_bytes=args.cache_bytes,
+                    max_frame_size=args.max_frame_size,
+                    max_content_size=args.max_content_size,
+                    admins=args.admins,
+                    metrics_file=_worker_path(args.metrics_file) if reuse_port else args.metrics_file,
+                    metrics_interval=args.metrics_interval,
+                    slow_request_threshold=args.slow_request_ms / 1000,
+                    slow_request_log=_worker_path(args.slow_request_log) if reuse_port else args.slow_request_log,
+                    profile_dir=args.profile_dir)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda _signum, _frame: _start_profiler(server))
+    try:
+        server.run(args.engine)
+    except KeyboardInterrupt:
+        server.cleanup()
 
-def _save(path: str, data: str) -> None:
-    file = open(path, "w+")
-    file.write(data)
-    file.close()
 
+def _start_profiler(server: Server) -> None:
+    """Lance le profileur à la réception de SIGUSR1."""
+    try:
+        path = server.start_profiler()
+    except gloprofile.ProfileError as ex:
+        print(f"profiler not started: {ex}")
+        return
+    print(f"profiling for {gloprofile.PROFILE_SECONDS:g}s into {path}")
 
-def _format_size(value: int, scale: str) -> str:
-    if scale == SCALES[-1]:
-        return f"{value}{scale}"
 
-    if value >= 1024:
-        current_scale_index = SCALES.index(scale)
-        next_scale = SCALES[current_scale_index + 1]
+def _worker_path(path: Optional[str]) -> Optional[str]:
+    """Retourne le chemin propre au processus courant d'un fichier partagé."""
+    return None if path is None else f"{path}.{os.getpid()}"
 
-        new_value = value / 1024
-        if new_value >= 1024:
-            return _format_size(new_value, next_scale)
 
-        return f"{new_value}{next_scale}"
+def _run_workers(args: argparse.Namespace) -> int:
+    """
+    Lance `args.workers` processus serveur qui partagent le port avec
+    SO_REUSEPORT et attend leur fin.
 
-    return f"{value}{scale}"
+    SIGTERM et SIGUSR1 reçus par le processus parent sont relayés aux
+    travailleurs.
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        print("--workers nécessite SO_REUSEPORT et os.fork")
+        return -1
+
+    workers = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            _serve(args, reuse_port=True)
+            os._exit(0)
+        workers.append(pid)
+
+    def _relay_signal(signum, _frame):
+        for worker in workers:
+            os.kill(worker, signum)
+
+    signal.signal(signal.SIGTERM, _relay_signal)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, _relay_signal)
+    for worker in workers:
+        while True:
+            try:
+                os.waitpid(worker, 0)
+                break
+            except KeyboardInterrupt:
+                continue
+    return 0
 
 
 def _main() -> int:
-    server = Server()
-    try:
-        server.run()
-    except KeyboardInterrupt:
-        server.cleanup()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-q", "--quota", action="store", type=int,
+                        dest="quota", default=None,
+                        help="Taille maximale en octets de la boîte des nouveaux comptes.")
+    parser.add_argument("-e", "--engine", action="store",
+                        dest="engine", choices=["select", "asyncio"], default="select",
+                        help="Boucle de traitement des clients.")
+    parser.add_argument("-s", "--storage", action="store",
+                        dest="storage", choices=list(glostorage.STORAGES), default="fs",
+                        help="Stockage des comptes et des courriels.")
+    parser.add_argument("--retention", action="store", type=float,
+                        dest="retention", default=None,
+                        help="Durée de conservation des courriels en jours (stockage log).")
+    parser.add_argument("--cache-bytes", action="store", type=int,
+                        dest="cache_bytes", default=glostorage.CACHE_MAX_BYTES,
+                        help="Taille maximale du cache des courriels lus, 0 pour le désactiver.")
+    parser.add_argument("--max-frame-size", action="store", type=int,
+                        dest="max_frame_size", default=glostream.MAX_FRAME_SIZE,
+                        help="Taille maximale en octets d'une trame reçue d'un client.")
+    parser.add_argument("--max-content-size", action="store", type=int,
+                        dest="max_content_size", default=glostream.MAX_CONTENT_SIZE,
+                        help="Taille maximale en octets d'un contenu reçu en morceaux.")
+    parser.add_argument("--admin", action="append",
+                        dest="admins", default=[],
+                        help="Utilisateur autorisé à consulter les métriques (peut être répété).")
+    parser.add_argument("--metrics-file", action="store",
+                        dest="metrics_file", default=None,
+                        help="Fichier où écrire périodiquement les métriques au format Prometheus "
+                             "(suffixé du pid de chaque processus avec --workers).")
+    parser.add_argument("--metrics-interval", action="store", type=float,
+                        dest="metrics_interval", default=glometrics.EXPORT_INTERVAL,
+                        help="Délai en secondes entre deux écritures du fichier des métriques.")
+    parser.add_argument("--slow-request-ms", action="store", type=float,
+                        dest="slow_request_ms", default=gloprofile.SLOW_REQUEST_THRESHOLD * 1000,
+                        help="Durée en millisecondes à partir de laquelle une requête est "
+                             "journalisée avec le détail de ses phases, 0 pour désactiver.")
+    parser.add_argument("--slow-request-log", action="store",
+                        dest="slow_request_log", default=None,
+                        help="Fichier du journal des requêtes lentes, la sortie standard par défaut "
+                             "(suffixé du pid de chaque processus avec --workers).")
+    parser.add_argument("--profile-dir", action="store",
+                        dest="profile_dir", default=".",
+                        help="Dossier des profils pstats écrits sur SIGUSR1 ou PROFILE_REQUEST.")
+    parser.add_argument("-w", "--workers", action="store", type=int,
+                        dest="workers", default=1,
+                        help="Nombre de processus serveur partageant le port.")
+    parser.add_argument("--smtp-server", action="store",
+                        dest="smtp_server", default=gloutils.SMTP_SERVER,
+                        help="Serveur SMTP relayant les courriels externes.")
+    parser.add_argument("--smtp-port", action="store", type=int,
+                        dest="smtp_port", default=25,
+                        help="Port du serveur SMTP.")
+    parser.add_argument("--relay-workers", action="store", type=int,
+                        dest="relay_workers", default=1,
+                        help="Nombre de fils et de sessions SMTP pour les envois externes.")
+    parser.add_argument("--smtp-max-messages", action="store", type=int,
+                        dest="smtp_max_messages", default=glorelay.SMTP_MAX_MESSAGES,
+                        help="Nombre maximal de courriels envoyés par session SMTP.")
+    parser.add_argument("--auth-workers", action="store", type=int,
+                        dest="auth_workers", default=None,
+                        help="Nombre de processus de hachage des mots de passe (un par cœur par défaut).")
+    parser.add_argument("--scrypt-n", action="store", type=int,
+                        dest="scrypt_n", default=gloauth.SCRYPT_N,
+                        help="Coût de scrypt pour les nouveaux hachages (puissance de 2).")
+    args = parser.parse_args(sys.argv[1:])
+    if args.workers > 1:
+        return _run_workers(args)
+    _serve(args)
     return 0
 
 
@@ -0,0 +1,81 @@
+"""\
+Banc d'essai des encodages de glocodec.
+
+Pour un message typique de chaque *Payload de gloutils, compare le
+temps d'encodage et de décodage ainsi que la taille sur le réseau
+des encodages JSON et binaire.
+
+Usage: python bench_glocodec.py [-n ITERATIONS]
+"""
+import argparse
+import sys
+import timeit
+
+import glocodec
+import gloutils
+
+_EMAIL = gloutils.EmailContentPayload(
+    sender="alice@glo2000.ca",
+    destination="bob@glo2000.ca",
+    subject="Rencontre de suivi",
+    date="Sun, 18 Oct 2026 02:00:15 +0000",
+    content="Bonjour,\nVoici le compte rendu de la rencontre.\n" * 20
+)
+
+SAMPLES = {
+    "ErrorPayload": gloutils.GloMessage(
+        id=12, header=gloutils.Headers.ERROR,
+        payload=gloutils.ErrorPayload(error_message="mauvais mot de passe")),
+    "AuthPayload": gloutils.GloMessage(
+        id=1, header=gloutils.Headers.AUTH_LOGIN,
+        payload=gloutils.AuthPayload(username="alice", password="Password123")),
+    "EmailContentPayload": gloutils.GloMessage(
+        id=42, header=gloutils.Headers.EMAIL_SENDING, payload=_EMAIL),
+    "InboxRequestPayload": gloutils.GloMessage(
+        id=7, header=gloutils.Headers.INBOX_READING_REQUEST,
+        payload=gloutils.InboxRequestPayload(offset=20, limit=gloutils.INBOX_PAGE_SIZE)),
+    "EmailListPayload": gloutils.GloMessage(
+        id=8, header=gloutils.Headers.OK,
+        payload=gloutils.EmailListPayload(
+            email_list=[gloutils.SUBJECT_DISPLAY.format(
+                number=i, sender=_EMAIL["sender"], subject=_EMAIL["subject"], date=_EMAIL["date"])
+                for i in range(1, gloutils.INBOX_PAGE_SIZE + 1)],
+            offset=0, total=1500)),
+    "EmailChoicePayload": gloutils.GloMessage(
+        id=9, header=gloutils.Headers.INBOX_READING_CHOICE,
+        payload=gloutils.EmailChoicePayload(choice=3)),
+    "StatsPayload": gloutils.GloMessage(
+        id=10, header=gloutils.Headers.OK,
+        payload=gloutils.StatsPayload(count=1500, size=2_500_000)),
+    "HelloPayload": gloutils.GloMessage(
+        id=0, header=gloutils.Headers.HELLO,
+        payload=gloutils.HelloPayload(encodings=["binary", "json"])),
+}
+
+
+def _measure(codec, message: gloutils.GloMessage, iterations: int) -> tuple[float, float, int]:
+    """Retourne les temps moyens d'encodage et de décodage (µs) et la taille (octets)."""
+    data = codec.encode(message)
+    assert codec.decode(data) == message
+    encode_time = timeit.timeit(lambda: codec.encode(message), number=iterations)
+    decode_time = timeit.timeit(lambda: codec.decode(data), number=iterations)
+    return encode_time / iterations * 1e6, decode_time / iterations * 1e6, len(data)
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", action="store", type=int,
+                        dest="iterations", default=20000,
+                        help="Nombre d'encodages et de décodages par mesure.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'payload':<20} {'encodage':<7} {'enc (µs)':>9} {'dec (µs)':>9} {'octets':>7}")
+    for name, message in SAMPLES.items():
+        for codec in (glocodec.JSONCodec, glocodec.BinaryCodec):
+            encode_time, decode_time, size = _measure(codec, message, args.iterations)
+            print(f"{name:<20} {codec.name:<7} {encode_time:>9.2f} {decode_time:>9.2f} {size:>7}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
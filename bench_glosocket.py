@@ -0,0 +1,85 @@
+"""\
+Micro-banc d'essai du débit de glosocket.send_msg/recv_msg.
+
+Compare l'implémentation courante à l'ancienne (concaténation par
+morceaux de 4096 octets) pour des messages de 1 Ko à 50 Mo, sur une
+paire de sockets locale.
+
+Usage: python bench_glosocket.py [-r REPETITIONS]
+
+L'ancienne implémentation étant quadratique, le nombre de messages
+diminue avec la taille (au moins un message de chaque taille).
+"""
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+
+import glosocket
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024]
+
+
+def _legacy_recvall(source: socket.socket, size: int) -> bytes:
+    msg = b""
+    while size > 0:
+        buffer = source.recv(min(size, 4096))
+        if not buffer:
+            raise glosocket.GLOSocketError("The other socket is closed.")
+        msg += buffer
+        size -= len(buffer)
+    return msg
+
+
+def _legacy_send_msg(dest_soc: socket.socket, message: str) -> None:
+    data = message.encode(encoding='utf-8')
+    dest_soc.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _legacy_recv_msg(source_soc: socket.socket) -> str:
+    length, = struct.unpack("!I", _legacy_recvall(source_soc, 4))
+    return _legacy_recvall(source_soc, length).decode('utf-8')
+
+
+def _measure(send, recv, message: str, repetitions: int) -> float:
+    """Retourne le débit moyen en Mo/s pour `repetitions` messages."""
+    left, right = socket.socketpair()
+    sender = threading.Thread(target=lambda: [send(left, message) for _ in range(repetitions)])
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(repetitions):
+        recv(right)
+    sender.join()
+    elapsed = time.perf_counter() - start
+    left.close()
+    right.close()
+    return len(message) * repetitions / elapsed / (1024 * 1024)
+
+
+def _format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size // (1024 * 1024)} Mo"
+    return f"{size // 1024} Ko"
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repetitions", action="store", type=int,
+                        dest="repetitions", default=1,
+                        help="Multiplie le nombre de messages transmis par taille.")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'taille':>8} {'avant (Mo/s)':>14} {'après (Mo/s)':>14} {'gain':>7}")
+    for size in SIZES:
+        message = "x" * size
+        repetitions = args.repetitions * max(1, 4 * 1024 * 1024 // size)
+        before = _measure(_legacy_send_msg, _legacy_recv_msg, message, repetitions)
+        after = _measure(glosocket.send_msg, glosocket.recv_msg, message, repetitions)
+        print(f"{_format_size(size):>8} {before:>14.1f} {after:>14.1f} {after / before:>6.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,549 @@
+"""\
+Générateur de charge et banc d'essai du serveur de courriels.
+
+Ouvre N sessions simultanées vers un serveur TP4_server et mesure, pour
+chaque type de requête (`Headers`), le débit et les latences p50, p95 et
+p99. Deux modes de charge:
+
+- un mélange pondéré d'opérations (`--mix`), par exemple
+    `send=4,list=3,read=2,stats=1`, parmi register, login, send, list,
+    read, search et stats. Chaque session crée d'abord son compte et
+    remplit sa boîte de `--prefill` courriels, hors mesure;
+- le rejeu de sessions scriptées (`--replay FICHIER.jsonl`): une requête
+    JSON par ligne, `{"session": "a", "header": "AUTH_LOGIN",
+    "payload": {...}}`. Les requêtes d'une même session sont rejouées
+    dans l'ordre, les sessions en parallèle. Un courriel sans `date`
+    reçoit la date courante.
+
+Avec `--spawn`, le banc lance lui-même un serveur local dans un dossier
+temporaire, avec un faux serveur SMTP qui accepte tous les courriels
+externes (voir `--external`). Les options qui suivent `--` sont passées
+au serveur, par exemple `-- -e asyncio -s sqlite --scrypt-n 1024`.
+
+`--output` sauvegarde les résultats en JSON; `--baseline` compare la
+course à des résultats sauvegardés et termine avec un code non nul si
+le débit baisse ou si la latence p95 d'un type de requête augmente de
+plus de `--tolerance`.
+
+Usage: python bench_server.py [-c SESSIONS] [-t SECONDES | -n REQUÊTES]
+                              [--mix MÉLANGE | --replay FICHIER] [--spawn]
+                              [--output FICHIER] [--baseline FICHIER]
+                              [-- OPTIONS DU SERVEUR]
+
+Toutes les sessions partagent la boucle asyncio d'un seul processus:
+au-delà de quelques centaines de sessions, le banc peut devenir le
+facteur limitant.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+import glocodec
+import glosocket
+import gloutils
+
+OPERATIONS = ["register", "login", "send", "list", "read", "search", "stats"]
+DEFAULT_MIX = "login=1,send=4,list=3,read=3,search=1,stats=1"
+PASSWORD = "Bench-Password1"
+SERVER_START_TIMEOUT = 10.0
+_SEARCH_WORDS = ["budget", "rencontre", "rapport", "projet", "horaire", "facture"]
+
+
+class BenchError(Exception):
+    """Erreur empêchant le déroulement du banc d'essai."""
+
+
+class Recorder:
+    """Latences et erreurs des requêtes, par type de requête."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.enabled = False
+
+    def record(self, header: gloutils.Headers, latency: float, ok: bool) -> None:
+        if not self.enabled:
+            return
+        self.latencies.setdefault(header.name, []).append(latency)
+        if not ok:
+            self.errors[header.name] = self.errors.get(header.name, 0) + 1
+
+    @property
+    def count(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+
+class Session:
+    """Session d'un utilisateur simulé, sans interaction."""
+
+    def __init__(self, recorder: Recorder, encoding: str, compress: bool) -> None:
+        self._recorder = recorder
+        self._encoding = encoding
+        self._compress_requested = compress
+        self._codec = glocodec.DEFAULT_CODEC
+        self._compress = False
+        self._next_request_id = 1
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self.username: Optional[str] = None
+        self.inbox_total = 0
+
+    async def connect(self, destination: str) -> None:
+        """Se connecte au serveur et négocie l'encodage et la compression."""
+        self._reader, self._writer = await asyncio.open_connection(destination, gloutils.APP_PORT)
+        if self._encoding != glocodec.DEFAULT_CODEC.name or self._compress_requested:
+            payload = gloutils.HelloPayload(encodings=[self._encoding, glocodec.DEFAULT_CODEC.name],
+                                            compress=self._compress_requested)
+            response = await self.request(gloutils.Headers.HELLO, payload, record=False)
+            if response["header"] == gloutils.Headers.OK:
+                self._codec = glocodec.CODECS.get(response["payload"]["encoding"], glocodec.DEFAULT_CODEC)
+                self._compress = self._compress_requested and response["payload"].get("compress", False)
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        try:
+            await self.notify(gloutils.Headers.BYE)
+            self._writer.close()
+            await self._writer.wait_closed()
+        except (OSError, glosocket.GLOSocketError):
+            pass
+
+    async def notify(self, header: gloutils.Headers, payload=None) -> None:
+        """Envoie une requête sans réponse (AUTH_LOGOUT, BYE)."""
+        await glosocket.async_send_data(self._writer, self._codec.encode(self._message(header, payload)),
+                                        self._compress)
+
+    async def request(self, header: gloutils.Headers, payload=None,
+                      record: bool = True) -> gloutils.GloMessage:
+        """Envoie une requête, attend sa réponse et mesure sa latence si `record`."""
+        message = self._message(header, payload)
+        start = time.perf_counter()
+        await glosocket.async_send_data(self._writer, self._codec.encode(message), self._compress)
+        while True:
+            response = self._codec.decode(await glosocket.async_recv_data(self._reader))
+            # Les avis de nouveaux courriels ne sont pas des réponses.
+            if response.get("id") == message["id"]:
+                break
+        if record:
+            self._recorder.record(header, time.perf_counter() - start,
+                                  response["header"] == gloutils.Headers.OK)
+        return response
+
+    def _message(self, header: gloutils.Headers, payload) -> gloutils.GloMessage:
+        message = gloutils.GloMessage(id=self._next_request_id, header=header)
+        self._next_request_id += 1
+        if payload is not None:
+            message["payload"] = payload
+        return message
+
+
+class MixWorkload:
+    """Mélange pondéré d'opérations exécuté par chaque session."""
+
+    def __init__(self, weights: dict[str, int], body_size: int, prefill: int,
+                 external: float, prefix: str) -> None:
+        self._operations = list(weights)
+        self._weights = list(weights.values())
+        self._body = ("Lorem ipsum dolor sit amet " * (body_size // 27 + 1))[:body_size]
+        self._prefill = prefill
+        self._external = external
+        self._prefix = prefix
+        self._next_user = 0
+        self.users: list[str] = []
+
+    def new_username(self) -> str:
+        self._next_user += 1
+        return f"{self._prefix}{self._next_user}"
+
+    async def setup(self, session: Session) -> None:
+        """Crée le compte de la session et remplit sa boîte, hors mesure."""
+        await self._register(session)
+        for _ in range(self._prefill):
+            await self._send(session, session.username)
+
+    async def step(self, session: Session) -> None:
+        operation, = random.choices(self._operations, self._weights)
+        match operation:
+            case "register":
+                # Le nouveau compte reçoit des courriels, mais la session
+                # revient au sien pour garder une boîte remplie.
+                await session.notify(gloutils.Headers.AUTH_LOGOUT)
+                username = session.username
+                await self._register(session)
+                await session.notify(gloutils.Headers.AUTH_LOGOUT)
+                await _check(session.request(gloutils.Headers.AUTH_LOGIN,
+                                             gloutils.AuthPayload(username=username, password=PASSWORD),
+                                             record=False))
+                session.username = username
+            case "login":
+                await session.notify(gloutils.Headers.AUTH_LOGOUT)
+                await _check(session.request(gloutils.Headers.AUTH_LOGIN,
+                                             gloutils.AuthPayload(username=session.username, password=PASSWORD)))
+            case "send":
+                if random.random() < self._external:
+                    await self._send(session, "bench@exemple.com")
+                else:
+                    await self._send(session, random.choice(self.users))
+            case "list":
+                response = await session.request(
+                    gloutils.Headers.INBOX_READING_REQUEST,
+                    gloutils.InboxRequestPayload(offset=0, limit=gloutils.INBOX_PAGE_SIZE))
+                if response["header"] == gloutils.Headers.OK:
+                    session.inbox_total = response["payload"].get("total", len(response["payload"]["email_list"]))
+            case "read":
+                choice = random.randint(1, max(1, min(session.inbox_total, gloutils.INBOX_PAGE_SIZE)))
+                await session.request(gloutils.Headers.INBOX_READING_CHOICE,
+                                      gloutils.EmailChoicePayload(choice=choice))
+            case "search":
+                await session.request(gloutils.Headers.SEARCH_REQUEST,
+                                      gloutils.SearchPayload(query=random.choice(_SEARCH_WORDS), limit=10))
+            case "stats":
+                await session.request(gloutils.Headers.STATS_REQUEST)
+
+    async def _register(self, session: Session) -> None:
+        username = self.new_username()
+        await _check(session.request(gloutils.Headers.AUTH_REGISTER,
+                                     gloutils.AuthPayload(username=username, password=PASSWORD)))
+        session.username = username
+        self.users.append(username)
+
+    async def _send(self, session: Session, destination: str) -> None:
+        if "@" not in destination:
+            destination = f"{destination}@{gloutils.SERVER_DOMAIN}"
+        await session.request(gloutils.Headers.EMAIL_SENDING, gloutils.EmailContentPayload(
+            sender=f"{session.username}@{gloutils.SERVER_DOMAIN}",
+            destination=destination,
+            subject=f"{random.choice(_SEARCH_WORDS)} {session.inbox_total}",
+            date=gloutils.get_current_utc_time(),
+            content=self._body
+        ))
+        if destination == f"{session.username}@{gloutils.SERVER_DOMAIN}":
+            session.inbox_total += 1
+
+
+class SMTPStub:
+    """Faux serveur SMTP local qui accepte tous les courriels."""
+
+    def __init__(self) -> None:
+        stub = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                self._reply("220 bench")
+                in_data = False
+                for line in self.rfile:
+                    line = line.rstrip(b"\r\n")
+                    if in_data:
+                        if line == b".":
+                            in_data = False
+                            with stub._lock:
+                                stub.delivered += 1
+                            self._reply("250 ok")
+                        continue
+                    command = line[:4].upper()
+                    if command == b"DATA":
+                        in_data = True
+                        self._reply("354 go ahead")
+                    elif command == b"QUIT":
+                        self._reply("221 bye")
+                        return
+                    else:
+                        self._reply("250 ok")
+
+            def _reply(self, line: str) -> None:
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._lock = threading.Lock()
+        self.delivered = 0
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        operation, _, weight = item.partition("=")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise BenchError(f"opération inconnue {operation!r}, choisir parmi {', '.join(OPERATIONS)}")
+        try:
+            weights[operation] = int(weight or 1)
+        except ValueError:
+            raise BenchError(f"poids invalide pour {operation}: {weight!r}")
+    if not any(weights.values()):
+        raise BenchError("le mélange ne contient aucune opération")
+    return weights
+
+
+def _load_replay(path: str) -> dict[str, list[tuple[gloutils.Headers, Optional[dict]]]]:
+    """Retourne les requêtes de chaque session du fichier, dans l'ordre."""
+    sessions: dict[str, list] = {}
+    with open(path, encoding="utf-8") as replay_file:
+        for line_number, line in enumerate(replay_file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                header = record["header"]
+                header = gloutils.Headers[header] if isinstance(header, str) else gloutils.Headers(header)
+            except (ValueError, KeyError, TypeError) as ex:
+                raise BenchError(f"{path}:{line_number}: requête invalide ({ex})")
+            payload = record.get("payload")
+            if header == gloutils.Headers.EMAIL_SENDING and isinstance(payload, dict):
+                payload.setdefault("date", gloutils.get_current_utc_time())
+            sessions.setdefault(str(record.get("session", 0)), []).append((header, payload))
+    return sessions
+
+
+async def _check(request) -> gloutils.GloMessage:
+    response = await request
+    if response["header"] != gloutils.Headers.OK:
+        raise BenchError(f"requête refusée: {response.get('payload')}")
+    return response
+
+
+async def _run_mix(args: argparse.Namespace, recorder: Recorder) -> float:
+    """Exécute le mélange dans `args.clients` sessions et retourne la durée mesurée."""
+    workload = MixWorkload(_parse_mix(args.mix), args.size, args.prefill, args.external,
+                           f"bench{uuid.uuid4().hex[:6]}_")
+    sessions = [Session(recorder, args.encoding, args.compress) for _ in range(args.clients)]
+    try:
+        for session in sessions:
+            await session.connect(args.destination)
+        await asyncio.gather(*(workload.setup(session) for session in sessions))
+
+        deadline = None if args.duration is None else time.perf_counter() + args.duration
+        requests_per_session = args.requests
+
+        async def _drive(session: Session) -> None:
+            done = 0
+            while (deadline is None or time.perf_counter() < deadline) and \
+                    (requests_per_session is None or done < requests_per_session):
+                await workload.step(session)
+                done += 1
+
+        recorder.enabled = True
+        start = time.perf_counter()
+        await asyncio.gather(*(_drive(session) for session in sessions))
+        return time.perf_counter() - start
+    finally:
+        await asyncio.gather(*(session.close() for session in sessions))
+
+
+async def _run_replay(args: argparse.Namespace, recorder: Recorder) -> float:
+    """Rejoue les sessions du fichier `args.replay` et retourne la durée mesurée."""
+    scripts = _load_replay(args.replay)
+
+    async def _replay(requests: list) -> None:
+        session = Session(recorder, args.encoding, args.compress)
+        try:
+            await session.connect(args.destination)
+            for header, payload in requests:
+                if header in (gloutils.Headers.AUTH_LOGOUT, gloutils.Headers.BYE):
+                    await session.notify(header, payload)
+                else:
+                    await session.request(header, payload)
+        finally:
+            await session.close()
+
+    recorder.enabled = True
+    start = time.perf_counter()
+    await asyncio.gather(*(_replay(requests) for _ in range(args.repeat) for requests in scripts.values()))
+    return time.perf_counter() - start
+
+
+def _percentile(ordered: list[float], percent: float) -> float:
+    """Percentile par rang le plus proche d'une liste triée."""
+    index = max(0, int(len(ordered) * percent / 100 + 0.5) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def _summarize(recorder: Recorder, elapsed: float) -> dict:
+    headers = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        headers[name] = {
+            "count": len(ordered),
+            "errors": recorder.errors.get(name, 0),
+            "throughput": len(ordered) / elapsed,
+            "p50": _percentile(ordered, 50) * 1000,
+            "p95": _percentile(ordered, 95) * 1000,
+            "p99": _percentile(ordered, 99) * 1000,
+        }
+    return {"elapsed": elapsed, "requests": recorder.count,
+            "throughput": recorder.count / elapsed if elapsed else 0.0, "headers": headers}
+
+
+def _print_summary(summary: dict) -> None:
+    print(f"{'requête':<24} {'nombre':>8} {'erreurs':>8} {'req/s':>9} "
+          f"{'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for name, stats in summary["headers"].items():
+        print(f"{name:<24} {stats['count']:>8} {stats['errors']:>8} {stats['throughput']:>9.1f} "
+              f"{stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['p99']:>9.2f}")
+    print(f"{summary['requests']} requêtes en {summary['elapsed']:.2f} s: "
+          f"{summary['throughput']:.1f} requêtes/s")
+
+
+def _compare(summary: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Retourne les régressions de la course par rapport à `baseline`."""
+    regressions = []
+    if summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"débit: {summary['throughput']:.1f} < {baseline['throughput']:.1f} requêtes/s")
+    for name, stats in summary["headers"].items():
+        reference = baseline["headers"].get(name)
+        if reference is not None and stats["p95"] > reference["p95"] * (1 + tolerance):
+            regressions.append(f"{name} p95: {stats['p95']:.2f} > {reference['p95']:.2f} ms")
+    return regressions
+
+
+def _spawn_server(server_args: list[str], smtp_port: int, data_dir: str) -> subprocess.Popen:
+    """Lance TP4_server dans `data_dir` et attend qu'il accepte les connexions."""
+    try:
+        socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=1).close()
+    except OSError:
+        pass
+    else:
+        raise BenchError(f"le port {gloutils.APP_PORT} est déjà utilisé")
+
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TP4_server.py")
+    process = subprocess.Popen([sys.executable, server_path, "--smtp-server", "127.0.0.1",
+                                "--smtp-port", str(smtp_port), *server_args],
+                               cwd=data_dir, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise BenchError(f"le serveur s'est arrêté (code {process.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise BenchError("le serveur n'accepte pas de connexion")
+
+
+def _main() -> int:
+    argv = sys.argv[1:]
+    server_args = []
+    if "--" in argv:
+        server_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--destination", action="store",
+                        dest="destination", default="127.0.0.1",
+                        help="Adresse IP/URL du serveur.")
+    parser.add_argument("-c", "--clients", action="store", type=int,
+                        dest="clients", default=10,
+                        help="Nombre de sessions simultanées du mélange.")
+    limit = parser.add_mutually_exclusive_group()
+    limit.add_argument("-t", "--duration", action="store", type=float,
+                       dest="duration", default=None,
+                       help="Durée de la mesure en secondes (10 par défaut).")
+    limit.add_argument("-n", "--requests", action="store", type=int,
+                       dest="requests", default=None,
+                       help="Nombre de requêtes par session.")
+    workload = parser.add_mutually_exclusive_group()
+    workload.add_argument("--mix", action="store",
+                          dest="mix", default=DEFAULT_MIX,
+                          help=f"Poids des opérations parmi {', '.join(OPERATIONS)}.")
+    workload.add_argument("--replay", action="store",
+                          dest="replay", default=None,
+                          help="Fichier JSONL des sessions à rejouer.")
+    parser.add_argument("--repeat", action="store", type=int,
+                        dest="repeat", default=1,
+                        help="Nombre de copies simultanées de chaque session rejouée.")
+    parser.add_argument("--size", action="store", type=int,
+                        dest="size", default=1000,
+                        help="Taille en caractères du corps des courriels envoyés.")
+    parser.add_argument("--prefill", action="store", type=int,
+                        dest="prefill", default=5,
+                        help="Nombre de courriels envoyés à chaque session avant la mesure.")
+    parser.add_argument("--external", action="store", type=float,
+                        dest="external", default=0.0,
+                        help="Proportion des courriels envoyés à une adresse externe.")
+    parser.add_argument("-e", "--encoding", action="store",
+                        dest="encoding", choices=list(glocodec.CODECS),
+                        default=glocodec.BinaryCodec.name,
+                        help="Encodage des messages proposé au serveur.")
+    parser.add_argument("--no-compress", action="store_false",
+                        dest="compress",
+                        help="Désactive la compression des grands messages.")
+    parser.add_argument("--spawn", action="store_true",
+                        dest="spawn",
+                        help="Lance un serveur local et un faux serveur SMTP.")
+    parser.add_argument("--output", action="store",
+                        dest="output", default=None,
+                        help="Fichier JSON où sauvegarder les résultats.")
+    parser.add_argument("--baseline", action="store",
+                        dest="baseline", default=None,
+                        help="Fichier JSON de résultats auxquels comparer la course.")
+    parser.add_argument("--tolerance", action="store", type=float,
+                        dest="tolerance", default=0.2,
+                        help="Dégradation relative tolérée par rapport à --baseline.")
+    args = parser.parse_args(argv)
+    if args.duration is None and args.requests is None:
+        args.duration = 10.0
+
+    recorder = Recorder()
+    smtp_stub = None
+    server = None
+    data_dir = None
+    try:
+        if args.spawn:
+            smtp_stub = SMTPStub()
+            data_dir = tempfile.TemporaryDirectory(prefix="bench_server_")
+            server = _spawn_server(server_args, smtp_stub.port, data_dir.name)
+        if args.replay is not None:
+            elapsed = asyncio.run(_run_replay(args, recorder))
+        else:
+            elapsed = asyncio.run(_run_mix(args, recorder))
+    except (BenchError, OSError, glosocket.GLOSocketError, glocodec.CodecError) as ex:
+        print(f"bench_server: {ex}", file=sys.stderr)
+        return 2
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if smtp_stub is not None:
+            smtp_stub.close()
+        if data_dir is not None:
+            data_dir.cleanup()
+
+    summary = _summarize(recorder, elapsed)
+    _print_summary(summary)
+    if smtp_stub is not None and smtp_stub.delivered:
+        print(f"{smtp_stub.delivered} courriels reçus par le faux serveur SMTP")
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(summary, output_file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = _compare(summary, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,135 @@
+"""\
+Module fournissant le hachage et la vérification des mots de passe.
+
+Les mots de passe sont hachés avec scrypt et un sel aléatoire, au
+format `scrypt$<n>$<r>$<p>$<sel>$<hachage>`. Les anciens hachages
+sha3_512 sans sel sont encore acceptés et signalés pour être
+remplacés à la prochaine connexion.
+
+Le hachage étant volontairement lent, il est exécuté dans un bassin
+de processus par `Authenticator`, qui garde aussi en mémoire, pour une
+courte durée, les vérifications réussies.
+"""
+import collections
+import hashlib
+import hmac
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 64
+
+CACHE_TTL = 60.0
+CACHE_MAX_ENTRIES = 10000
+
+_SCHEME = "scrypt"
+
+
+def hash_password(password: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> str:
+    """Hache le mot de passe avec scrypt et un nouveau sel."""
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{_SCHEME}${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """Vérifie le mot de passe contre un hachage scrypt ou sha3_512 (ancien format)."""
+    if not stored.startswith(f"{_SCHEME}$"):
+        legacy = hashlib.sha3_512(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(legacy, stored.strip())
+
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        expected = bytes.fromhex(digest)
+        computed = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(computed, expected)
+
+
+def needs_rehash(stored: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P) -> bool:
+    """Indique si le hachage est d'un ancien format ou d'autres paramètres."""
+    return not stored.startswith(f"{_SCHEME}${n}${r}${p}$")
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * (n + p + 2), dklen=HASH_SIZE)
+
+
+class Authenticator:
+    """
+    Exécute le hachage et la vérification dans un bassin de processus et
+    garde un cache borné des vérifications réussies.
+    """
+
+    def __init__(self, workers: Optional[int] = None, n: int = SCRYPT_N,
+                 cache_ttl: float = CACHE_TTL, cache_max_entries: int = CACHE_MAX_ENTRIES) -> None:
+        """
+        Prépare un bassin de `workers` processus (un par cœur par défaut),
+        créés à la première utilisation. `n` est le coût de scrypt.
+        """
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_ignore_interrupts)
+        self._n = n
+        self._cache_ttl = cache_ttl
+        self._cache_max_entries = cache_max_entries
+        self._cache: collections.OrderedDict[str, tuple[bytes, float]] = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_key = os.urandom(32)
+
+    def hash(self, password: str) -> Future:
+        """Retourne un Future du hachage du mot de passe."""
+        return self._executor.submit(hash_password, password, self._n)
+
+    def verify(self, password: str, stored: str) -> Future:
+        """Retourne un Future du résultat de la vérification."""
+        return self._executor.submit(verify_password, password, stored)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """Indique si le hachage doit être remplacé à la prochaine connexion."""
+        return needs_rehash(stored, self._n)
+
+    def is_cached(self, username: str, password: str) -> bool:
+        """Indique si ce mot de passe a été vérifié récemment pour l'utilisateur."""
+        with self._cache_lock:
+            cached = self._cache.get(username)
+            if cached is None:
+                return False
+            digest, expiry = cached
+            if expiry < time.monotonic():
+                del self._cache[username]
+                return False
+            self._cache.move_to_end(username)
+        return hmac.compare_digest(digest, self._cache_digest(password))
+
+    def remember(self, username: str, password: str) -> None:
+        """Conserve une vérification réussie pour CACHE_TTL secondes."""
+        digest = self._cache_digest(password)
+        with self._cache_lock:
+            self._cache[username] = (digest, time.monotonic() + self._cache_ttl)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self._cache_max_entries:
+                self._cache.popitem(last=False)
+
+    def shutdown(self) -> None:
+        """Arrête le bassin de processus après les calculs en cours."""
+        self._executor.shutdown(cancel_futures=True)
+
+    def _cache_digest(self, password: str) -> bytes:
+        # Le cache ne garde qu'un HMAC du mot de passe, avec une clé propre au processus.
+        return hmac.new(self._cache_key, password.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _ignore_interrupts() -> None:
+    # Ctrl-C est traité par le serveur, qui arrête ensuite le bassin.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -0,0 +1,615 @@
+"""\
+Module fournissant une interface programmatique au serveur de courriels.
+
+`MailClient` (synchrone) et `AsyncMailClient` (asyncio) exposent une
+méthode par opération du protocole (`register`, `login`, `list_inbox`,
+`fetch`, `send`, `search`, `stats`, ...). Elles retournent le payload de
+la réponse et lèvent une exception MailClientError si le serveur répond
+avec l'entête ERROR.
+
+Une connexion sert à toutes les requêtes d'un client: `pipeline` envoie
+plusieurs requêtes sans attendre leurs réponses et un AsyncMailClient
+peut être utilisé par plusieurs tâches à la fois, les réponses étant
+associées aux requêtes par leur `id`.
+
+`SessionPool` et `AsyncSessionPool` gardent un nombre borné de sessions
+authentifiées d'un même utilisateur, ouvertes à la demande et réutilisées
+d'une tâche à l'autre.
+
+Les avis de nouveaux courriels (NEW_MAIL) reçus d'une session abonnée
+sont transmis à la fonction `on_new_mail`, s'il y en a une.
+"""
+import asyncio
+import contextlib
+import queue
+import select
+import socket
+import threading
+from typing import Callable, Optional
+
+import glocodec
+import glosocket
+import glostream
+import gloutils
+
+NewMailCallback = Callable[[gloutils.NewMailPayload], None]
+
+# Durée par défaut d'un profilage du serveur, en secondes.
+PROFILE_SECONDS = 30.0
+
+
+class MailClientError(Exception):
+    """Erreur levée quand le serveur refuse une requête ou répond de façon inattendue."""
+
+
+class _ClientBase:
+    """Logique commune aux clients synchrone et asynchrone, sans entrées-sorties."""
+
+    def __init__(self, encoding: str, compress: bool, stream: bool,
+                 on_new_mail: Optional[NewMailCallback]) -> None:
+        self.username: Optional[str] = None
+        self._encoding = encoding
+        self._compress_requested = compress
+        self._stream_requested = stream
+        self._on_new_mail = on_new_mail
+        self._codec = glocodec.DEFAULT_CODEC
+        self._compress = False
+        self._stream = False
+        self._chunk_size = glostream.CHUNK_SIZE
+        self._next_request_id = 1
+
+    def _hello_payload(self) -> Optional[gloutils.HelloPayload]:
+        """Retourne la proposition HELLO, ou None si le défaut convient."""
+        if self._encoding == glocodec.DEFAULT_CODEC.name and not (
+                self._compress_requested or self._stream_requested):
+            return None
+        return gloutils.HelloPayload(encodings=[self._encoding, glocodec.DEFAULT_CODEC.name],
+                                     compress=self._compress_requested, stream=self._stream_requested)
+
+    def _adopt(self, response: gloutils.GloMessage) -> None:
+        """Adopte ce que le serveur a retenu dans sa réponse à HELLO."""
+        if response["header"] != gloutils.Headers.OK:
+            return
+        payload = response["payload"]
+        self._codec = glocodec.CODECS.get(payload["encoding"], glocodec.DEFAULT_CODEC)
+        self._compress = self._compress_requested and payload.get("compress", False)
+        self._stream = self._stream_requested and payload.get("stream", False)
+        self._chunk_size = min(glostream.CHUNK_SIZE, payload.get("max_frame_size", glostream.CHUNK_SIZE))
+
+    def _frames(self, header: gloutils.Headers, payload=None) -> tuple[int, list]:
+        """Retourne l'identifiant de la requête et ses trames à transmettre."""
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        message = gloutils.GloMessage(id=request_id, header=header)
+        if payload:
+            message["payload"] = payload
+        chunks = []
+        if self._stream:
+            message, chunks = glostream.split_message(message, self._chunk_size)
+        return request_id, [self._codec.encode(message), *chunks]
+
+    def _is_notification(self, message: gloutils.GloMessage) -> bool:
+        """Transmet un avis de nouveau courriel à `on_new_mail` et l'indique."""
+        if message.get("header") != gloutils.Headers.NEW_MAIL or "id" in message:
+            return False
+        if self._on_new_mail is not None:
+            self._on_new_mail(message["payload"])
+        return True
+
+    def _email_payload(self, destination: str | list[str], subject: str,
+                       content: str) -> gloutils.EmailContentPayload:
+        if not isinstance(destination, str):
+            destination = ", ".join(destination)
+        return gloutils.EmailContentPayload(
+            sender=f"{self.username}@{gloutils.SERVER_DOMAIN}",
+            destination=destination,
+            subject=subject,
+            date=gloutils.get_current_utc_time(),
+            content=content
+        )
+
+    @staticmethod
+    def result(response: gloutils.GloMessage):
+        """
+        Retourne le payload de la réponse, None si elle n'en a pas.
+
+        Lève une exception MailClientError si la réponse est une erreur.
+        """
+        if response["header"] == gloutils.Headers.OK:
+            return response.get("payload")
+        stream = response.get("stream")
+        if stream is not None:
+            stream.close()
+        if response["header"] == gloutils.Headers.ERROR:
+            raise MailClientError(response["payload"]["error_message"])
+        raise MailClientError("server's message was not recognised")
+
+    @staticmethod
+    def _complete(response: gloutils.GloMessage) -> gloutils.EmailContentPayload:
+        """Retourne le courriel de la réponse, avec son contenu reçu en morceaux."""
+        stream = response.get("stream")
+        if stream is None:
+            return response["payload"]
+        return stream.complete()["payload"]
+
+
+class MailClient(_ClientBase):
+    """Client synchrone du serveur de courriels, sur une connexion."""
+
+    def __init__(self, destination: str, port: int = gloutils.APP_PORT,
+                 encoding: str = glocodec.BinaryCodec.name, compress: bool = True,
+                 stream: bool = True, on_new_mail: Optional[NewMailCallback] = None,
+                 timeout: Optional[float] = None) -> None:
+        """
+        Se connecte au serveur et lui propose `encoding`, la compression
+        et la transmission en morceaux avec l'entête HELLO.
+
+        Lève une exception OSError si la connexion échoue.
+        """
+        super().__init__(encoding, compress, stream, on_new_mail)
+        self._socket = socket.create_connection((destination, port), timeout=timeout)
+        self._responses: dict[int, gloutils.GloMessage] = {}
+        hello = self._hello_payload()
+        if hello is not None:
+            self._adopt(self.pipeline([(gloutils.Headers.HELLO, hello)])[0])
+
+    def __enter__(self) -> "MailClient":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Prévient le serveur avec l'entête BYE et ferme la connexion."""
+        try:
+            self._send(gloutils.Headers.BYE)
+        except (OSError, glosocket.GLOSocketError):
+            pass
+        self._socket.close()
+
+    def request(self, header: gloutils.Headers, payload=None):
+        """
+        Envoie une requête et retourne le payload de sa réponse.
+
+        Lève une exception MailClientError si le serveur la refuse.
+        """
+        response, = self.pipeline([(header, payload)])
+        return self.result(response)
+
+    def pipeline(self, requests: list[tuple]) -> list[gloutils.GloMessage]:
+        """
+        Envoie toutes les requêtes `(header, payload)` sans attendre
+        les réponses, puis retourne les réponses dans le même ordre.
+
+        Les réponses ne sont pas vérifiées (voir `result`). Le contenu
+        d'un courriel reçu en morceaux est dans le fichier temporaire
+        `stream` de sa réponse (voir glostream).
+        """
+        request_ids = [self._send(header, payload) for header, payload in requests]
+        return [self._receive(request_id) for request_id in request_ids]
+
+    def poll_notifications(self) -> None:
+        """Traite les avis de nouveaux courriels déjà reçus, sans attendre."""
+        while select.select([self._socket], [], [], 0)[0]:
+            self._receive_one()
+
+    def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte."""
+        self.request(gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(username=username, password=password))
+        self.username = username
+
+    def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte."""
+        self.request(gloutils.Headers.AUTH_LOGIN, gloutils.AuthPayload(username=username, password=password))
+        self.username = username
+
+    def logout(self) -> None:
+        """Se déconnecte du compte, sans fermer la connexion."""
+        self._send(gloutils.Headers.AUTH_LOGOUT)
+        self.username = None
+
+    def subscribe(self, enabled: bool = True) -> None:
+        """Active ou désactive les avis de nouveaux courriels."""
+        self.request(gloutils.Headers.SUBSCRIBE, gloutils.SubscribePayload(enabled=enabled))
+
+    def list_inbox(self, offset: int = 0, limit: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Retourne au plus `limit` courriels à partir du rang `offset`, ou toute la liste."""
+        payload = None
+        if offset or limit is not None:
+            payload = gloutils.InboxRequestPayload(offset=offset)
+            if limit is not None:
+                payload["limit"] = limit
+        return self.request(gloutils.Headers.INBOX_READING_REQUEST, payload)
+
+    def fetch(self, choice: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel au rang `choice` (à partir de 1) de la liste."""
+        response, = self.pipeline([(gloutils.Headers.INBOX_READING_CHOICE,
+                                    gloutils.EmailChoicePayload(choice=choice))])
+        self.result(response)
+        return self._complete(response)
+
+    def fetch_streamed(self, choice: int
+                       ) -> tuple[gloutils.EmailContentPayload, Optional[glostream.IncomingStream]]:
+        """
+        Retourne le courriel au rang `choice` et, s'il a été reçu en
+        morceaux, le fichier de son contenu, à fermer par l'appelant.
+        """
+        response, = self.pipeline([(gloutils.Headers.INBOX_READING_CHOICE,
+                                    gloutils.EmailChoicePayload(choice=choice))])
+        return self.result(response), response.get("stream")
+
+    def send(self, destination: str | list[str], subject: str, content: str):
+        """
+        Envoie un courriel à une ou plusieurs adresses et retourne le
+        payload de la réponse: None pour un destinataire du serveur,
+        l'`id` de suivi pour une adresse externe ou l'état de chaque
+        destinataire (SendingReportPayload).
+        """
+        return self.request(gloutils.Headers.EMAIL_SENDING, self._email_payload(destination, subject, content))
+
+    def search(self, query: str, limit: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Retourne les courriels contenant tous les mots de `query`."""
+        payload = gloutils.SearchPayload(query=query)
+        if limit is not None:
+            payload["limit"] = limit
+        return self.request(gloutils.Headers.SEARCH_REQUEST, payload)
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Retourne le nombre et la taille des courriels du compte."""
+        return self.request(gloutils.Headers.STATS_REQUEST)
+
+    def delivery_status(self, delivery_id: str) -> gloutils.DeliveryStatusPayload:
+        """Retourne l'état de la livraison d'un courriel externe."""
+        return self.request(gloutils.Headers.DELIVERY_STATUS_REQUEST, gloutils.DeliveryStatusPayload(id=delivery_id))
+
+    def metrics(self) -> gloutils.MetricsPayload:
+        """Retourne les métriques du serveur; réservé aux administrateurs."""
+        return self.request(gloutils.Headers.METRICS_REQUEST)
+
+    def profile(self, seconds: float = PROFILE_SECONDS) -> str:
+        """
+        Profile le serveur pendant `seconds` secondes et retourne le
+        chemin du fichier pstats qu'il écrira; réservé aux administrateurs.
+        """
+        payload = gloutils.ProfilePayload(seconds=seconds)
+        return self.request(gloutils.Headers.PROFILE_REQUEST, payload)["path"]
+
+    def _send(self, header: gloutils.Headers, payload=None) -> int:
+        request_id, frames = self._frames(header, payload)
+        for frame in frames:
+            glosocket.send_data(self._socket, frame, self._compress)
+        return request_id
+
+    def _receive(self, request_id: int) -> gloutils.GloMessage:
+        """
+        Retourne la réponse à la requête `request_id`, en conservant
+        les réponses aux autres requêtes reçues entre temps.
+        """
+        while request_id not in self._responses:
+            self._receive_one(request_id)
+        return self._responses.pop(request_id)
+
+    def _receive_one(self, request_id: Optional[int] = None) -> None:
+        message = self._codec.decode(glosocket.recv_data(self._socket))
+        if glostream.is_streamed(message):
+            stream = glostream.IncomingStream(message, max_size=None)
+            while not stream.done:
+                stream.feed(glosocket.recv_data(self._socket))
+            message["stream"] = stream
+        if not self._is_notification(message):
+            self._responses[message.get("id", request_id)] = message
+
+
+class AsyncMailClient(_ClientBase):
+    """
+    Client asyncio du serveur de courriels, sur une connexion partagée
+    par les tâches qui l'utilisent.
+
+    S'obtient avec `await AsyncMailClient.connect(...)`.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 encoding: str, compress: bool, stream: bool,
+                 on_new_mail: Optional[NewMailCallback]) -> None:
+        super().__init__(encoding, compress, stream, on_new_mail)
+        self._reader = reader
+        self._writer = writer
+        self._pending: dict[int, asyncio.Future] = {}
+        self._write_lock = asyncio.Lock()
+        self._error: Optional[BaseException] = None
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def connect(cls, destination: str, port: int = gloutils.APP_PORT,
+                      encoding: str = glocodec.BinaryCodec.name, compress: bool = True,
+                      stream: bool = True, on_new_mail: Optional[NewMailCallback] = None
+                      ) -> "AsyncMailClient":
+        """
+        Se connecte au serveur et négocie l'encodage, la compression et
+        la transmission en morceaux.
+        """
+        reader, writer = await asyncio.open_connection(destination, port)
+        client = cls(reader, writer, encoding, compress, stream, on_new_mail)
+        hello = client._hello_payload()
+        if hello is not None:
+            client._adopt((await client.pipeline([(gloutils.Headers.HELLO, hello)]))[0])
+        return client
+
+    async def __aenter__(self) -> "AsyncMailClient":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Prévient le serveur avec l'entête BYE et ferme la connexion."""
+        try:
+            await self._send(gloutils.Headers.BYE)
+        except (OSError, glosocket.GLOSocketError):
+            pass
+        self._writer.close()
+        self._reader_task.cancel()
+        with contextlib.suppress(OSError):
+            await self._writer.wait_closed()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._reader_task
+
+    async def request(self, header: gloutils.Headers, payload=None):
+        """
+        Envoie une requête et retourne le payload de sa réponse.
+
+        Lève une exception MailClientError si le serveur la refuse.
+        """
+        response, = await self.pipeline([(header, payload)])
+        return self.result(response)
+
+    async def pipeline(self, requests: list[tuple]) -> list[gloutils.GloMessage]:
+        """Équivalent de MailClient.pipeline."""
+        futures = [await self._send(header, payload, expect_response=True) for header, payload in requests]
+        return list(await asyncio.gather(*futures))
+
+    async def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte."""
+        await self.request(gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(username=username, password=password))
+        self.username = username
+
+    async def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte."""
+        await self.request(gloutils.Headers.AUTH_LOGIN, gloutils.AuthPayload(username=username, password=password))
+        self.username = username
+
+    async def logout(self) -> None:
+        """Se déconnecte du compte, sans fermer la connexion."""
+        await self._send(gloutils.Headers.AUTH_LOGOUT)
+        self.username = None
+
+    async def subscribe(self, enabled: bool = True) -> None:
+        """Active ou désactive les avis de nouveaux courriels."""
+        await self.request(gloutils.Headers.SUBSCRIBE, gloutils.SubscribePayload(enabled=enabled))
+
+    async def list_inbox(self, offset: int = 0, limit: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Retourne au plus `limit` courriels à partir du rang `offset`, ou toute la liste."""
+        payload = None
+        if offset or limit is not None:
+            payload = gloutils.InboxRequestPayload(offset=offset)
+            if limit is not None:
+                payload["limit"] = limit
+        return await self.request(gloutils.Headers.INBOX_READING_REQUEST, payload)
+
+    async def fetch(self, choice: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel au rang `choice` (à partir de 1) de la liste."""
+        response, = await self.pipeline([(gloutils.Headers.INBOX_READING_CHOICE,
+                                          gloutils.EmailChoicePayload(choice=choice))])
+        self.result(response)
+        return self._complete(response)
+
+    async def fetch_streamed(self, choice: int
+                             ) -> tuple[gloutils.EmailContentPayload, Optional[glostream.IncomingStream]]:
+        """Équivalent de MailClient.fetch_streamed."""
+        response, = await self.pipeline([(gloutils.Headers.INBOX_READING_CHOICE,
+                                          gloutils.EmailChoicePayload(choice=choice))])
+        return self.result(response), response.get("stream")
+
+    async def send(self, destination: str | list[str], subject: str, content: str):
+        """Équivalent de MailClient.send."""
+        return await self.request(gloutils.Headers.EMAIL_SENDING,
+                                  self._email_payload(destination, subject, content))
+
+    async def search(self, query: str, limit: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Retourne les courriels contenant tous les mots de `query`."""
+        payload = gloutils.SearchPayload(query=query)
+        if limit is not None:
+            payload["limit"] = limit
+        return await self.request(gloutils.Headers.SEARCH_REQUEST, payload)
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Retourne le nombre et la taille des courriels du compte."""
+        return await self.request(gloutils.Headers.STATS_REQUEST)
+
+    async def delivery_status(self, delivery_id: str) -> gloutils.DeliveryStatusPayload:
+        """Retourne l'état de la livraison d'un courriel externe."""
+        return await self.request(gloutils.Headers.DELIVERY_STATUS_REQUEST,
+                                  gloutils.DeliveryStatusPayload(id=delivery_id))
+
+    async def metrics(self) -> gloutils.MetricsPayload:
+        """Retourne les métriques du serveur; réservé aux administrateurs."""
+        return await self.request(gloutils.Headers.METRICS_REQUEST)
+
+    async def profile(self, seconds: float = PROFILE_SECONDS) -> str:
+        """Équivalent de MailClient.profile."""
+        payload = gloutils.ProfilePayload(seconds=seconds)
+        return (await self.request(gloutils.Headers.PROFILE_REQUEST, payload))["path"]
+
+    async def _send(self, header: gloutils.Headers, payload=None,
+                    expect_response: bool = False) -> Optional[asyncio.Future]:
+        """
+        Envoie une requête et retourne, si `expect_response`, le Future
+        de sa réponse.
+        """
+        if self._error is not None:
+            raise glosocket.GLOSocketError(f"The connection is closed: {self._error}")
+        async with self._write_lock:
+            request_id, frames = self._frames(header, payload)
+            future = None
+            if expect_response:
+                future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+            # La tâche de lecture a pu s'arrêter pendant l'attente du verrou.
+            if self._error is not None:
+                self._pending.pop(request_id, None)
+                raise glosocket.GLOSocketError(f"The connection is closed: {self._error}")
+            # Les trames d'une requête ne sont pas entrecoupées de celles d'une autre.
+            for frame in frames:
+                glosocket.write_data(self._writer, frame, self._compress)
+            await self._writer.drain()
+        return future
+
+    async def _read_responses(self) -> None:
+        """
+        Associe chaque réponse reçue au Future de sa requête.
+
+        Si la lecture s'arrête sur une erreur (connexion, message
+        invalide, exception de `on_new_mail`), les requêtes en attente
+        et les suivantes échouent avec cette erreur.
+        """
+        try:
+            while True:
+                data = await glosocket.async_recv_data(self._reader)
+                # Le codec peut avoir changé (HELLO) pendant l'attente.
+                message = self._codec.decode(data)
+                if glostream.is_streamed(message):
+                    stream = glostream.IncomingStream(message, max_size=None)
+                    while not stream.done:
+                        stream.feed(await glosocket.async_recv_data(self._reader))
+                    message["stream"] = stream
+                if self._is_notification(message):
+                    continue
+                future = self._pending.pop(message.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except Exception as ex:
+            self._error = ex
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(glosocket.GLOSocketError(f"The connection is closed: {ex}"))
+            self._pending.clear()
+
+
+class SessionPool:
+    """
+    Sessions authentifiées d'un utilisateur, réutilisées par les fils
+    qui les empruntent avec `session()`.
+    """
+
+    def __init__(self, destination: str, username: str, password: str,
+                 size: int = 4, **options) -> None:
+        """
+        Ouvre au plus `size` sessions, à la demande. Les `options` sont
+        passées à MailClient.
+        """
+        self._destination = destination
+        self._username = username
+        self._password = password
+        self._options = options
+        self._idle: queue.LifoQueue[MailClient] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Prête une session connectée au compte, en attendant qu'une se
+        libère si `size` sont déjà prêtées.
+
+        Une session dont la connexion a échoué n'est pas réutilisée.
+        """
+        if self._closed:
+            raise MailClientError("the session pool is closed")
+        self._slots.acquire()
+        client = None
+        try:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                client = self._open()
+            yield client
+        except (OSError, glosocket.GLOSocketError, glocodec.CodecError):
+            if client is not None:
+                client.close()
+                client = None
+            raise
+        finally:
+            if client is not None:
+                if self._closed:
+                    client.close()
+                else:
+                    self._idle.put(client)
+            self._slots.release()
+
+    def close(self) -> None:
+        """Ferme les sessions libres; les sessions prêtées le sont à leur retour."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _open(self) -> MailClient:
+        client = MailClient(self._destination, **self._options)
+        try:
+            client.login(self._username, self._password)
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+
+class AsyncSessionPool:
+    """Équivalent asyncio de SessionPool, pour AsyncMailClient."""
+
+    def __init__(self, destination: str, username: str, password: str,
+                 size: int = 4, **options) -> None:
+        self._destination = destination
+        self._username = username
+        self._password = password
+        self._options = options
+        self._idle: list[AsyncMailClient] = []
+        self._slots = asyncio.BoundedSemaphore(size)
+        self._closed = False
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """Équivalent de SessionPool.session."""
+        if self._closed:
+            raise MailClientError("the session pool is closed")
+        async with self._slots:
+            client = None
+            try:
+                client = self._idle.pop() if self._idle else await self._open()
+                yield client
+            except (OSError, glosocket.GLOSocketError, glocodec.CodecError):
+                if client is not None:
+                    await client.close()
+                    client = None
+                raise
+            finally:
+                if client is not None:
+                    if self._closed:
+                        await client.close()
+                    else:
+                        self._idle.append(client)
+
+    async def close(self) -> None:
+        """Ferme les sessions libres; les sessions prêtées le sont à leur retour."""
+        self._closed = True
+        while self._idle:
+            await self._idle.pop().close()
+
+    async def _open(self) -> AsyncMailClient:
+        client = await AsyncMailClient.connect(self._destination, **self._options)
+        try:
+            await client.login(self._username, self._password)
+        except BaseException:
+            await client.close()
+            raise
+        return client
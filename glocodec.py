@@ -0,0 +1,224 @@
+"""\
+Module fournissant les encodages des messages GloMessage.
+
+JSON est l'encodage par défaut. L'encodage binaire, négocié avec
+l'entête HELLO, place l'entête et l'identifiant de requête dans un
+en-tête fixe puis encode le payload dans un format inspiré de
+MessagePack.
+"""
+import json
+import struct
+from typing import Any
+
+import gloutils
+
+# En-tête binaire: entête (octet), drapeaux (octet), identifiant de requête.
+_MESSAGE_HEADER = struct.Struct("!BBI")
+_HAS_ID = 0x01
+_HAS_PAYLOAD = 0x02
+_FIXSTR_TAGS = [bytes([0xa0 | length]) for length in range(32)]
+# Profondeur maximale des listes et dictionnaires imbriqués d'un payload.
+MAX_DEPTH = 32
+
+
+class CodecError(Exception):
+    """Erreur levée quand un message ne peut pas être encodé ou décodé."""
+
+
+class JSONCodec:
+    """Encodage texte d'origine du protocole."""
+    name = "json"
+
+    @staticmethod
+    def encode(message: gloutils.GloMessage) -> bytes:
+        """Encode le message en JSON UTF-8."""
+        return json.dumps(message).encode("utf-8")
+
+    @staticmethod
+    def decode(data: bytes) -> gloutils.GloMessage:
+        """
+        Décode un message JSON UTF-8.
+
+        Lève une exception CodecError si ce n'est pas un objet avec une
+        entête entière, comme ceux que produit l'encodage binaire.
+        """
+        try:
+            message = json.loads(data)
+        except ValueError as ex:
+            raise CodecError("The received data is not valid JSON") from ex
+        if not isinstance(message, dict) or type(message.get("header")) is not int:
+            raise CodecError("The received data is not a message")
+        return message
+
+
+class BinaryCodec:
+    """Encodage binaire compact."""
+    name = "binary"
+
+    @staticmethod
+    def encode(message: gloutils.GloMessage) -> bytes:
+        """Encode le message avec l'en-tête fixe suivi du payload."""
+        flags = 0
+        if "id" in message:
+            flags |= _HAS_ID
+        if "payload" in message:
+            flags |= _HAS_PAYLOAD
+
+        parts = [_MESSAGE_HEADER.pack(message["header"], flags, message.get("id", 0))]
+        if flags & _HAS_PAYLOAD:
+            _pack(message["payload"], parts)
+        return b"".join(parts)
+
+    @staticmethod
+    def decode(data: bytes) -> gloutils.GloMessage:
+        """Décode un message encodé par `encode`."""
+        try:
+            header, flags, request_id = _MESSAGE_HEADER.unpack_from(data)
+            message = gloutils.GloMessage(header=header)
+            if flags & _HAS_ID:
+                message["id"] = request_id
+            if flags & _HAS_PAYLOAD:
+                message["payload"], _ = _unpack(data, _MESSAGE_HEADER.size)
+        except CodecError:
+            raise
+        except Exception as ex:
+            # Toute donnée reçue mal formée, quelle que soit l'erreur, refuse le message.
+            raise CodecError("The received data is not a binary message") from ex
+        return message
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec, JSONCodec)}
+DEFAULT_CODEC = JSONCodec
+
+
+def negotiate(offered: list[str]):
+    """
+    Retourne le premier encodage proposé que le module connaît,
+    ou l'encodage par défaut si aucun ne convient.
+    """
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return DEFAULT_CODEC
+
+
+def _pack(value: Any, parts: list[bytes]) -> None:
+    """Ajoute à `parts` l'encodage binaire de `value`."""
+    if value is None:
+        parts.append(b"\xc0")
+    elif value is True:
+        parts.append(b"\xc3")
+    elif value is False:
+        parts.append(b"\xc2")
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            parts.append(struct.pack("!B", value))
+        elif 0 <= value <= 0xffffffff:
+            parts.append(struct.pack("!BI", 0xce, value))
+        else:
+            parts.append(struct.pack("!Bq", 0xd3, value))
+    elif isinstance(value, float):
+        parts.append(struct.pack("!Bd", 0xcb, value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        if len(data) < 32:
+            parts.append(_FIXSTR_TAGS[len(data)])
+        elif len(data) < 0x100:
+            parts.append(struct.pack("!BB", 0xd9, len(data)))
+        else:
+            parts.append(struct.pack("!BI", 0xdb, len(data)))
+        parts.append(data)
+    elif isinstance(value, (list, tuple)):
+        if len(value) < 16:
+            parts.append(struct.pack("!B", 0x90 | len(value)))
+        else:
+            parts.append(struct.pack("!BI", 0xdd, len(value)))
+        for item in value:
+            _pack(item, parts)
+    elif isinstance(value, dict):
+        if len(value) < 16:
+            parts.append(struct.pack("!B", 0x80 | len(value)))
+        else:
+            parts.append(struct.pack("!BI", 0xdf, len(value)))
+        for key, item in value.items():
+            _pack(key, parts)
+            _pack(item, parts)
+    else:
+        raise CodecError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _unpack(data: bytes, offset: int, depth: int = 0) -> tuple[Any, int]:
+    """
+    Décode la valeur à la position `offset` et retourne la position
+    suivante. `depth` est le nombre de listes et de dictionnaires qui
+    la contiennent.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag & 0xe0 == 0xa0:
+        end = offset + (tag & 0x1f)
+        if end > len(data):
+            raise IndexError("string goes past the end of the message")
+        return data[offset:end].decode("utf-8"), end
+    if tag < 0x80:
+        return tag, offset
+    if tag == 0xd9:
+        return _unpack_str(data, offset + 1, data[offset])
+    if tag & 0xf0 == 0x90:
+        return _unpack_list(data, offset, tag & 0x0f, depth)
+    if tag & 0xf0 == 0x80:
+        return _unpack_dict(data, offset, tag & 0x0f, depth)
+
+    match tag:
+        case 0xc0:
+            return None, offset
+        case 0xc2:
+            return False, offset
+        case 0xc3:
+            return True, offset
+        case 0xce:
+            return struct.unpack_from("!I", data, offset)[0], offset + 4
+        case 0xd3:
+            return struct.unpack_from("!q", data, offset)[0], offset + 8
+        case 0xcb:
+            return struct.unpack_from("!d", data, offset)[0], offset + 8
+        case 0xdb:
+            return _unpack_str(data, offset + 4, struct.unpack_from("!I", data, offset)[0])
+        case 0xdd:
+            return _unpack_list(data, offset + 4, struct.unpack_from("!I", data, offset)[0], depth)
+        case 0xdf:
+            return _unpack_dict(data, offset + 4, struct.unpack_from("!I", data, offset)[0], depth)
+    raise CodecError(f"Unknown type tag {tag:#x}")
+
+
+def _unpack_str(data: bytes, offset: int, length: int) -> tuple[str, int]:
+    end = offset + length
+    if end > len(data):
+        raise IndexError("string goes past the end of the message")
+    return data[offset:end].decode("utf-8"), end
+
+
+def _unpack_list(data: bytes, offset: int, count: int, depth: int) -> tuple[list, int]:
+    _check_depth(depth)
+    items = []
+    for _ in range(count):
+        item, offset = _unpack(data, offset, depth + 1)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_dict(data: bytes, offset: int, count: int, depth: int) -> tuple[dict, int]:
+    _check_depth(depth)
+    items = {}
+    for _ in range(count):
+        key, offset = _unpack(data, offset, depth + 1)
+        # Comme en JSON, seuls les textes (et les entiers) servent de clés.
+        if type(key) not in (str, int):
+            raise CodecError(f"Invalid dictionary key of type {type(key).__name__}")
+        items[key], offset = _unpack(data, offset, depth + 1)
+    return items, offset
+
+
+def _check_depth(depth: int) -> None:
+    if depth >= MAX_DEPTH:
+        raise CodecError(f"The message is nested more than {MAX_DEPTH} levels deep")
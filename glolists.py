@@ -0,0 +1,107 @@
+"""\
+Module fournissant les listes de distribution du serveur.
+
+Les listes sont lues du fichier LISTS_FILENAME du dossier des données:
+un objet JSON associant le nom de chaque liste aux adresses de ses
+membres, par exemple
+
+    {"equipe": ["alice@glo2000.ca", "bob@exemple.com", "tous@glo2000.ca"]}
+
+Une liste est désignée par l'adresse `<nom>@SERVER_DOMAIN`, sans égard
+à la casse du nom. Ses membres peuvent être d'autres listes. Le fichier
+est relu quand il est modifié, sans redémarrer le serveur.
+"""
+import json
+import os
+import threading
+from typing import Optional
+
+import gloutils
+
+
+class DistributionLists:
+    """Listes de distribution lues d'un fichier JSON."""
+
+    def __init__(self, path: str) -> None:
+        """Utilise le fichier `path`, qui peut ne pas exister."""
+        self._path = path
+        self._lists: dict[str, list[str]] = {}
+        self._mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def is_list(self, name: str) -> bool:
+        """Indique si `name` est le nom d'une liste."""
+        return name.upper() in self._load()
+
+    def is_list_address(self, address: str) -> bool:
+        """Indique si l'adresse désigne une liste."""
+        name = _list_name(address)
+        return name is not None and name in self._load()
+
+    def expand(self, addresses: list[str]) -> list[str]:
+        """
+        Remplace récursivement les adresses de listes par leurs membres et
+        retourne les adresses obtenues, sans doublons (sans égard à la
+        casse), dans l'ordre de leur première apparition.
+        """
+        lists = self._load()
+        expanded = []
+        seen = set()
+        pending = list(reversed(addresses))
+        while pending:
+            address = pending.pop().strip()
+            # Une liste déjà développée est ignorée, ce qui coupe les cycles.
+            if address.lower() in seen:
+                continue
+            seen.add(address.lower())
+            name = _list_name(address)
+            if name is not None and name in lists:
+                pending.extend(reversed(lists[name]))
+            else:
+                expanded.append(address)
+        return expanded
+
+    def _load(self) -> dict[str, list[str]]:
+        """Retourne les listes, relues si le fichier a changé."""
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime:
+                return self._lists
+            if mtime is None:
+                self._lists = {}
+            else:
+                try:
+                    with open(self._path, encoding="utf-8") as lists_file:
+                        self._lists = _parse_lists(json.load(lists_file))
+                except (OSError, ValueError) as ex:
+                    # Les listes précédentes restent en vigueur.
+                    print(f"invalid distribution lists: {ex}")
+            self._mtime = mtime
+            return self._lists
+
+
+def _parse_lists(data) -> dict[str, list[str]]:
+    """
+    Retourne les listes du contenu décodé du fichier, indexées par leur
+    nom en majuscules.
+
+    Lève une exception ValueError si ce n'est pas un objet associant
+    chaque nom à une liste d'adresses.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("the file must contain a JSON object")
+    for name, members in data.items():
+        if not isinstance(members, list) or not all(isinstance(member, str) for member in members):
+            raise ValueError(f"the members of {name!r} must be a list of addresses")
+    return {name.upper(): members for name, members in data.items()}
+
+
+def _list_name(address: str) -> Optional[str]:
+    """Retourne le nom de liste possible d'une adresse du serveur, sinon None."""
+    local_part, _, domain = address.rpartition("@")
+    if not local_part or domain.lower() != gloutils.SERVER_DOMAIN:
+        return None
+    return local_part.upper()
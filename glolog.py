@@ -0,0 +1,355 @@
+"""\
+Module fournissant les boîtes de courriels en journal à ajout seul.
+
+Chaque dossier utilisateur contient:
+- SEGMENT_FILENAME: les courriels à la suite, une ligne JSON chacun,
+    avec l'instant de leur livraison (`timestamp`);
+- SEGMENT_INDEX_FILENAME: une ligne JSON par courriel donnant sa
+    position et sa taille dans le segment, ainsi que les informations
+    affichées dans la liste;
+- QUOTA_FILENAME: le quota optionnel de la boîte;
+- SEARCH_INDEX_FILENAME: l'index de recherche (voir glosearch), où
+    chaque courriel est désigné par sa position dans le segment.
+
+Une livraison ajoute une ligne à la fin de chacun des deux fichiers,
+sans créer de fichier. La lecture d'un courriel ne décode que sa ligne,
+découpée dans une projection `mmap` du segment.
+
+Le compactage réécrit le segment sans les courriels expirés. L'index
+est reconstruit à partir du segment quand il ne lui correspond plus,
+par exemple après une interruption pendant une livraison ou un
+compactage.
+"""
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import threading
+import time
+from typing import Optional, TypedDict
+
+import glomailbox
+import glosearch
+import gloutils
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus serveur
+    fcntl = None
+
+SEGMENT_FILENAME = "segment"
+SEGMENT_INDEX_FILENAME = "segment.index"
+QUOTA_FILENAME = "quota"
+
+
+class SegmentEntry(TypedDict, total=True):
+    """Entrée de l'index décrivant un courriel du segment."""
+    offset: int
+    size: int
+    timestamp: float
+    sender: str
+    subject: str
+    date: str
+
+
+class LogMailbox:
+    """Boîte de courriels d'un dossier utilisateur en journal à ajout seul."""
+
+    def __init__(self, user_dir_path: str) -> None:
+        """
+        Charge l'index du dossier `user_dir_path`, le complète avec les
+        courriels du segment qu'il ne contient pas encore ou le
+        reconstruit s'il ne correspond plus au segment.
+        """
+        self._dir_path = user_dir_path
+        self._segment_path = os.path.join(user_dir_path, SEGMENT_FILENAME)
+        self._path = os.path.join(user_dir_path, SEGMENT_INDEX_FILENAME)
+        self._quota_path = os.path.join(user_dir_path, QUOTA_FILENAME)
+        self._lock_path = os.path.join(user_dir_path, glomailbox.LOCK_FILENAME)
+        self._search = glosearch.SearchIndex(os.path.join(user_dir_path, gloutils.SEARCH_INDEX_FILENAME))
+        self._lock = threading.RLock()
+        self._map: Optional[mmap.mmap] = None
+        self._reset()
+
+        with self._locked():
+            open(self._segment_path, "ab").close()
+            if not os.path.exists(self._path):
+                self._rebuild()
+            self.refresh()
+            self._recover()
+        self._quota = _load_quota(self._quota_path)
+
+    @property
+    def quota(self) -> Optional[int]:
+        """Taille maximale en octets des courriels, None si illimitée."""
+        return self._quota
+
+    def set_quota(self, quota: Optional[int]) -> None:
+        """Modifie et sauvegarde le quota de la boîte."""
+        with self._locked():
+            self._quota = quota
+            tmp_path = f"{self._quota_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as quota_file:
+                json.dump(quota, quota_file)
+            os.replace(tmp_path, self._quota_path)
+
+    def refresh(self) -> None:
+        """
+        Lit les entrées ajoutées à l'index depuis la dernière lecture.
+
+        Si l'index a été remplacé par un compactage, il est relu au
+        complet et le segment est projeté de nouveau.
+        """
+        with self._lock:
+            stat = os.stat(self._path)
+            if stat.st_ino == self._inode and stat.st_size == self._read_offset:
+                return
+            with open(self._path, "rb") as index_file:
+                inode = os.fstat(index_file.fileno()).st_ino
+                if inode != self._inode:
+                    self._reset()
+                    self._inode = inode
+                index_file.seek(self._read_offset)
+                for line in index_file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._read_offset += len(line)
+                    self._append_entry(json.loads(line))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def entries(self) -> list[SegmentEntry]:
+        """Retourne les entrées, de la plus récente à la plus ancienne."""
+        return self._entries[::-1]
+
+    def page(self, offset: int, limit: Optional[int] = None) -> list[SegmentEntry]:
+        """
+        Retourne au plus `limit` entrées à partir du rang `offset`
+        (à partir de 0, du plus récent au plus ancien).
+        """
+        end = len(self._entries) - offset
+        if end <= 0:
+            return []
+        start = 0 if limit is None else max(end - limit, 0)
+        return self._entries[start:end][::-1]
+
+    def get(self, number: int) -> Optional[SegmentEntry]:
+        """
+        Retourne l'entrée affichée au rang `number` (à partir de 1,
+        du plus récent au plus ancien) ou None si elle n'existe pas.
+        """
+        if not 1 <= number <= len(self._entries):
+            return None
+        return self._entries[-number]
+
+    def read(self, entry: SegmentEntry) -> gloutils.EmailContentPayload:
+        """Décode le courriel de l'entrée à partir du segment projeté."""
+        return json.loads(self._read_data(entry))
+
+    def search(self, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, SegmentEntry]], int]:
+        """
+        Retourne au plus `limit` entrées des courriels contenant tous les
+        termes de `query`, de la plus pertinente à la moins pertinente,
+        avec leur rang d'affichage, et le nombre total de courriels trouvés.
+
+        L'index de recherche est reconstruit s'il ne compte pas autant de
+        courriels que la boîte.
+        """
+        with self._lock:
+            self.refresh()
+            self._search.refresh()
+            if len(self._search) != len(self._entries):
+                with self._locked():
+                    self.refresh()
+                    self._search.refresh()
+                    if len(self._search) != len(self._entries):
+                        self._search.rebuild((entry["offset"], self.read(entry)) for entry in self._entries)
+            offsets, total = self._search.search(query, limit)
+            results = []
+            for offset in offsets:
+                position = bisect.bisect_left(self._entries, offset, key=_offset_of)
+                if position < len(self._entries) and self._entries[position]["offset"] == offset:
+                    results.append((len(self._entries) - position, self._entries[position]))
+            return results, total
+
+    def deliver(self, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> SegmentEntry:
+        """
+        Ajoute le courriel à la fin du segment et son entrée à l'index.
+        `timestamp` est l'instant de livraison, l'instant présent par
+        défaut.
+
+        Lève une exception glomailbox.QuotaExceededError si le courriel
+        ferait dépasser le quota de la boîte.
+        """
+        with self._locked():
+            self.refresh()
+            record = dict(payload, timestamp=time.time() if timestamp is None else timestamp)
+            data = json.dumps(record).encode("utf-8")
+            if self._quota is not None and self.size + len(data) > self._quota:
+                raise glomailbox.QuotaExceededError(f"{self.size + len(data)} > {self._quota}")
+
+            with open(self._segment_path, "ab") as segment_file:
+                offset = os.fstat(segment_file.fileno()).st_size
+                segment_file.write(data + b"\n")
+            entry = _make_entry(offset, len(data), record)
+            with open(self._path, "ab") as index_file:
+                index_file.write(_encode_entry(entry))
+            self._search.add(offset, payload)
+            self.refresh()
+            return entry
+
+    def compact(self, max_age: float) -> int:
+        """
+        Réécrit le segment sans les courriels livrés depuis plus de
+        `max_age` secondes et retourne le nombre de courriels retirés.
+        """
+        with self._locked():
+            self.refresh()
+            cutoff = time.time() - max_age
+            kept = [entry for entry in self._entries if entry["timestamp"] >= cutoff]
+            removed = len(self._entries) - len(kept)
+            if removed == 0:
+                return 0
+
+            segment_tmp_path = f"{self._segment_path}.tmp"
+            index_tmp_path = f"{self._path}.tmp"
+            new_offsets = {}
+            with open(segment_tmp_path, "wb") as segment_file, \
+                    open(index_tmp_path, "wb") as index_file:
+                offset = 0
+                for entry in kept:
+                    data = self._read_data(entry)
+                    segment_file.write(data + b"\n")
+                    index_file.write(_encode_entry(dict(entry, offset=offset, size=len(data))))
+                    new_offsets[entry["offset"]] = offset
+                    offset += len(data) + 1
+            # Un index qui dépasse le segment est reconstruit au chargement
+            # si le remplacement est interrompu entre les deux fichiers.
+            os.replace(segment_tmp_path, self._segment_path)
+            os.replace(index_tmp_path, self._path)
+            self._search.remap(new_offsets)
+            self.refresh()
+            return removed
+
+    def close(self) -> None:
+        """Libère la projection du segment."""
+        with self._lock:
+            self._close_map()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Verrouille la boîte pour les autres fils du processus et,
+        si possible, pour les autres processus.
+        """
+        with self._lock, open(self._lock_path, "ab") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reset(self) -> None:
+        self._close_map()
+        self._entries: list[SegmentEntry] = []
+        self._inode = None
+        self._read_offset = 0
+        self.count = 0
+        self.size = 0
+
+    def _append_entry(self, entry: SegmentEntry) -> None:
+        self._entries.append(entry)
+        self.count += 1
+        self.size += entry["size"]
+
+    def _read_data(self, entry: SegmentEntry) -> bytes:
+        end = entry["offset"] + entry["size"]
+        with self._lock:
+            if self._map is None or end > len(self._map):
+                self._remap()
+            return self._map[entry["offset"]:end]
+
+    def _remap(self) -> None:
+        self._close_map()
+        with open(self._segment_path, "rb") as segment_file:
+            if os.fstat(segment_file.fileno()).st_size > 0:
+                self._map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _recover(self) -> None:
+        """
+        Fait correspondre l'index au segment: ajoute les courriels écrits
+        sans leur entrée, retire une ligne incomplète à la fin du segment
+        et reconstruit l'index s'il dépasse le segment.
+        """
+        indexed_end = 0
+        if self._entries:
+            indexed_end = self._entries[-1]["offset"] + self._entries[-1]["size"] + 1
+        segment_size = os.path.getsize(self._segment_path)
+        if indexed_end > segment_size:
+            self._rebuild()
+            self.refresh()
+            return
+        if indexed_end == segment_size:
+            return
+
+        with open(self._segment_path, "rb+") as segment_file, open(self._path, "ab") as index_file:
+            segment_file.seek(indexed_end)
+            offset = indexed_end
+            for line in segment_file:
+                if not line.endswith(b"\n"):
+                    break
+                index_file.write(_encode_entry(_make_entry(offset, len(line) - 1, json.loads(line))))
+                offset += len(line)
+            segment_file.truncate(offset)
+        self.refresh()
+
+    def _rebuild(self) -> None:
+        """Reconstruit l'index à partir des courriels complets du segment."""
+        tmp_path = f"{self._path}.tmp"
+        with open(self._segment_path, "rb") as segment_file, open(tmp_path, "wb") as index_file:
+            offset = 0
+            for line in segment_file:
+                if not line.endswith(b"\n"):
+                    break
+                index_file.write(_encode_entry(_make_entry(offset, len(line) - 1, json.loads(line))))
+                offset += len(line)
+        os.replace(tmp_path, self._path)
+
+
+def _make_entry(offset: int, size: int, record: dict) -> SegmentEntry:
+    timestamp = record.get("timestamp")
+    return SegmentEntry(
+        offset=offset,
+        size=size,
+        timestamp=glomailbox.parse_date(record["date"]) if timestamp is None else timestamp,
+        sender=record["sender"],
+        subject=record["subject"],
+        date=record["date"]
+    )
+
+
+def _offset_of(entry: SegmentEntry) -> int:
+    return entry["offset"]
+
+
+def _encode_entry(entry: SegmentEntry) -> bytes:
+    return json.dumps(entry).encode("utf-8") + b"\n"
+
+
+def _load_quota(path: str) -> Optional[int]:
+    try:
+        with open(path, encoding="utf-8") as quota_file:
+            return json.load(quota_file)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,347 @@
+"""\
+Module fournissant l'index persistant des boîtes de courriels
+du serveur.
+
+Chaque dossier utilisateur contient un fichier INDEX_FILENAME où
+chaque ligne est une entrée JSON décrivant un courriel livré.
+Le fichier n'est modifié que par ajout, ce qui permet de relire
+seulement les nouvelles lignes pour se mettre à jour.
+
+Chaque courriel porte l'instant de sa livraison (`timestamp`, en
+secondes depuis l'époque), qui sert au tri; la date texte n'est
+utilisée que pour l'affichage. Les courriels livrés avant l'ajout de
+ce champ le reçoivent une seule fois, à la reconstruction de l'index.
+
+Le nombre de courriels et leur taille totale sont tenus à jour
+à chaque livraison et sauvegardés dans STATS_FILENAME avec le
+quota optionnel de l'utilisateur. L'index de recherche du dossier
+(voir glosearch) est complété à chaque livraison.
+
+Les écritures sont protégées par un verrou de fichier pour que
+plusieurs processus serveur puissent livrer dans le même dossier.
+"""
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional, TypedDict
+
+import glosearch
+import gloutils
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus serveur
+    fcntl = None
+
+DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
+MESSAGE_FILE_FORMAT = "msg-{id}.json"
+LOCK_FILENAME = "lock"
+_RESERVED_FILENAMES = (gloutils.PASSWORD_FILENAME, gloutils.INDEX_FILENAME,
+                       gloutils.STATS_FILENAME, gloutils.SEARCH_INDEX_FILENAME,
+                       LOCK_FILENAME)
+
+
+class MailboxError(Exception):
+    """Erreur levée par les opérations sur une boîte de courriels."""
+
+
+class QuotaExceededError(MailboxError):
+    """Erreur levée quand une livraison dépasserait le quota."""
+
+
+class IndexEntry(TypedDict, total=True):
+    """Entrée de l'index décrivant un courriel stocké."""
+    id: int
+    timestamp: float
+    sender: str
+    subject: str
+    date: str
+    size: int
+    file: str
+
+
+class MailboxIndex:
+    """Index des courriels d'un dossier utilisateur."""
+
+    def __init__(self, user_dir_path: str) -> None:
+        """
+        Charge l'index du dossier `user_dir_path`.
+
+        Si le fichier d'index n'existe pas encore (dossier créé avant
+        l'index), s'il ne contient pas les instants de livraison ou si
+        les compteurs sauvegardés ne correspondent pas à l'index, il est
+        reconstruit à partir des fichiers présents.
+        """
+        self._dir_path = user_dir_path
+        self._path = os.path.join(user_dir_path, gloutils.INDEX_FILENAME)
+        self._stats_path = os.path.join(user_dir_path, gloutils.STATS_FILENAME)
+        self._lock_path = os.path.join(user_dir_path, LOCK_FILENAME)
+        self._search = glosearch.SearchIndex(os.path.join(user_dir_path, gloutils.SEARCH_INDEX_FILENAME))
+        self._quota: Optional[int] = None
+        self._lock = threading.RLock()
+        self._reset()
+
+        with self._locked():
+            if not os.path.exists(self._path):
+                self._rebuild()
+            self.refresh()
+
+            saved_stats = self._load_stats()
+            if saved_stats is not None:
+                self._quota = saved_stats["quota"]
+            if saved_stats is None \
+                    or (saved_stats["count"], saved_stats["size"]) != (self.count, self.size) \
+                    or any("timestamp" not in entry for entry in self._entries):
+                self._rebuild()
+                self.refresh()
+                self._save_stats()
+
+    @property
+    def quota(self) -> Optional[int]:
+        """Taille maximale en octets des courriels, None si illimitée."""
+        return self._quota
+
+    def set_quota(self, quota: Optional[int]) -> None:
+        """Modifie et sauvegarde le quota de la boîte."""
+        with self._locked():
+            self._quota = quota
+            self._save_stats()
+
+    def refresh(self) -> None:
+        """
+        Lit les entrées ajoutées au fichier depuis la dernière lecture.
+
+        Si le fichier a été remplacé par une reconstruction, il est relu
+        au complet.
+        """
+        with self._lock:
+            stat = os.stat(self._path)
+            if stat.st_ino == self._inode and stat.st_size == self._read_offset:
+                return
+            with open(self._path, "rb") as index_file:
+                inode = os.fstat(index_file.fileno()).st_ino
+                if inode != self._inode:
+                    self._reset()
+                    self._inode = inode
+                index_file.seek(self._read_offset)
+                for line in index_file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._read_offset += len(line)
+                    self._append_entry(json.loads(line))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def entries(self) -> list[IndexEntry]:
+        """Retourne les entrées, de la plus récente à la plus ancienne."""
+        return self._entries[::-1]
+
+    def page(self, offset: int, limit: Optional[int] = None) -> list[IndexEntry]:
+        """
+        Retourne au plus `limit` entrées à partir du rang `offset`
+        (à partir de 0, du plus récent au plus ancien).
+        """
+        end = len(self._entries) - offset
+        if end <= 0:
+            return []
+        start = 0 if limit is None else max(end - limit, 0)
+        return self._entries[start:end][::-1]
+
+    def get(self, number: int) -> Optional[IndexEntry]:
+        """
+        Retourne l'entrée affichée au rang `number` (à partir de 1,
+        du plus récent au plus ancien) ou None si elle n'existe pas.
+        """
+        if not 1 <= number <= len(self._entries):
+            return None
+        return self._entries[-number]
+
+    def search(self, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, IndexEntry]], int]:
+        """
+        Retourne au plus `limit` entrées des courriels contenant tous les
+        termes de `query`, de la plus pertinente à la moins pertinente,
+        avec leur rang d'affichage, et le nombre total de courriels trouvés.
+
+        L'index de recherche est reconstruit s'il ne compte pas autant de
+        courriels que la boîte, par exemple pour une boîte créée avant lui.
+        """
+        with self._lock:
+            self.refresh()
+            self._search.refresh()
+            if len(self._search) != len(self._entries):
+                with self._locked():
+                    self.refresh()
+                    self._search.refresh()
+                    if len(self._search) != len(self._entries):
+                        self._search.rebuild((entry["file"], self.read(entry)) for entry in self._entries)
+            file_names, total = self._search.search(query, limit)
+            results = []
+            for file_name in file_names:
+                entry = self._by_file.get(file_name)
+                if entry is not None:
+                    position = bisect.bisect_left(self._entries, _sort_key(entry), key=_sort_key)
+                    results.append((len(self._entries) - position, entry))
+            return results, total
+
+    def path_of(self, entry: IndexEntry) -> str:
+        """Retourne le chemin du fichier contenant le courriel."""
+        return os.path.join(self._dir_path, entry["file"])
+
+    def read(self, entry: IndexEntry) -> gloutils.EmailContentPayload:
+        """Lit le courriel de l'entrée."""
+        with open(self.path_of(entry), encoding="utf-8") as email_file:
+            return json.load(email_file)
+
+    def deliver(self, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> IndexEntry:
+        """
+        Écrit le courriel dans un nouveau fichier du dossier et
+        l'ajoute à l'index.
+
+        `timestamp` est l'instant de livraison, l'instant présent par
+        défaut.
+
+        Lève une exception QuotaExceededError si le courriel ferait
+        dépasser le quota de la boîte.
+        """
+        with self._locked():
+            self.refresh()
+            timestamp = time.time() if timestamp is None else timestamp
+            data = json.dumps(dict(payload, timestamp=timestamp)).encode("utf-8")
+            if self._quota is not None and self.size + len(data) > self._quota:
+                raise QuotaExceededError(f"{self.size + len(data)} > {self._quota}")
+
+            message_id = self._next_id
+            while os.path.exists(os.path.join(self._dir_path, MESSAGE_FILE_FORMAT.format(id=message_id))):
+                message_id += 1
+            file_name = MESSAGE_FILE_FORMAT.format(id=message_id)
+            with open(os.path.join(self._dir_path, file_name), "wb") as message_file:
+                message_file.write(data)
+
+            entry = _make_entry(message_id, timestamp, payload, len(data), file_name)
+            with open(self._path, "ab") as index_file:
+                index_file.write(_encode_entry(entry))
+            self._search.add(file_name, payload)
+            self.refresh()
+            self._save_stats()
+            return entry
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Verrouille la boîte pour les autres fils du processus et,
+        si possible, pour les autres processus.
+        """
+        with self._lock, open(self._lock_path, "ab") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reset(self) -> None:
+        self._entries: list[IndexEntry] = []
+        self._by_file: dict[str, IndexEntry] = {}
+        self._inode = None
+        self._read_offset = 0
+        self._next_id = 1
+        self.count = 0
+        self.size = 0
+
+    def _append_entry(self, entry: IndexEntry) -> None:
+        if self._entries and _sort_key(entry) < _sort_key(self._entries[-1]):
+            # Livraison concurrente d'un autre processus, ajoutée après une plus récente.
+            bisect.insort(self._entries, entry, key=_sort_key)
+        else:
+            self._entries.append(entry)
+        self._by_file[entry["file"]] = entry
+        self._next_id = max(self._next_id, entry["id"] + 1)
+        self.count += 1
+        self.size += entry["size"]
+
+    def _load_stats(self) -> Optional[dict]:
+        try:
+            with open(self._stats_path, encoding="utf-8") as stats_file:
+                return json.load(stats_file)
+        except (OSError, ValueError):
+            return None
+
+    def _save_stats(self) -> None:
+        stats = {"count": self.count, "size": self.size, "quota": self._quota}
+        tmp_path = f"{self._stats_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stats_file:
+            json.dump(stats, stats_file)
+        os.replace(tmp_path, self._stats_path)
+
+    def _rebuild(self) -> None:
+        """
+        Reconstruit le fichier d'index à partir des courriels déjà présents
+        dans le dossier, triés du plus ancien au plus récent.
+
+        Un courriel sans instant de livraison reçoit celui de sa date
+        texte et son fichier est réécrit, pour ne plus avoir à la lire.
+        """
+        emails = []
+        for file_name in os.listdir(self._dir_path):
+            if file_name in _RESERVED_FILENAMES or file_name.endswith(".tmp"):
+                continue
+            file_path = os.path.join(self._dir_path, file_name)
+            with open(file_path, encoding="utf-8") as email_file:
+                email_data = json.load(email_file)
+            if "timestamp" not in email_data:
+                email_data["timestamp"] = parse_date(email_data["date"])
+                tmp_path = f"{file_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as email_file:
+                    json.dump(email_data, email_file)
+                os.replace(tmp_path, file_path)
+            emails.append((email_data, os.path.getsize(file_path), file_name))
+
+        emails.sort(key=lambda email: email[0]["timestamp"])
+
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "wb") as index_file:
+            for message_id, (email_data, size, file_name) in enumerate(emails, start=1):
+                index_file.write(_encode_entry(
+                    _make_entry(message_id, email_data["timestamp"], email_data, size, file_name)))
+        os.replace(tmp_path, self._path)
+
+
+def parse_date(date: str) -> float:
+    """
+    Retourne l'instant (secondes depuis l'époque) de la date affichée
+    d'un courriel, ou l'instant présent si elle est invalide.
+    """
+    try:
+        return datetime.strptime(date, DATE_FORMAT).timestamp()
+    except ValueError:
+        return time.time()
+
+
+def _make_entry(message_id: int, timestamp: float, payload: gloutils.EmailContentPayload,
+                size: int, file_name: str) -> IndexEntry:
+    return IndexEntry(
+        id=message_id,
+        timestamp=timestamp,
+        sender=payload["sender"],
+        subject=payload["subject"],
+        date=payload["date"],
+        size=size,
+        file=file_name
+    )
+
+
+def _sort_key(entry: IndexEntry) -> tuple[float, int]:
+    # Les entrées d'avant l'ajout des instants sont gardées dans l'ordre du fichier.
+    return entry.get("timestamp", 0.0), entry["id"]
+
+
+def _encode_entry(entry: IndexEntry) -> bytes:
+    return json.dumps(entry).encode("utf-8") + b"\n"
@@ -0,0 +1,303 @@
+"""\
+Module fournissant les métriques de fonctionnement du serveur.
+
+`Metrics` compte, pour chaque type de requête (`Headers`), les requêtes
+traitées et celles refusées (réponse ERROR), avec un histogramme de leur
+durée de traitement. Il mesure aussi:
+- les octets des messages reçus et transmis, encodés mais avant
+    compression;
+- les connexions ouvertes depuis le démarrage et les connexions actives;
+- le temps passé dans chaque phase (`disk` pour le stockage, `smtp` pour
+    les envois au serveur SMTP), voir `timed` et `TimedProxy`;
+- des jauges lues au moment de la consultation (`add_gauge`), comme le
+    nombre d'utilisateurs connectés.
+
+Le temps des phases est aussi cumulé pour la requête en cours dans le
+fil qui la traite (voir `tracking`), ce qui permet de détailler une
+requête lente. Le temps `smtp`, mesuré dans les fils de la file
+d'envoi, n'est jamais attribué à une requête.
+
+Les histogrammes ont des bornes fixes (LATENCY_BUCKETS): une mesure ne
+coûte qu'une recherche par bisection et un verrou, ce qui permet de les
+laisser actives en production.
+
+`snapshot` retourne les métriques sous forme de MetricsPayload et
+`to_prometheus` au format texte de Prometheus, que `MetricsExporter`
+écrit périodiquement dans un fichier.
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import gloutils
+
+# Bornes supérieures des classes des histogrammes, en secondes.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EXPORT_INTERVAL = 15.0
+PHASES = ("disk", "smtp")
+
+# Temps par phase de la requête en cours de traitement dans chaque fil.
+_current = threading.local()
+
+
+class Histogram:
+    """Histogramme à bornes fixes de durées en secondes."""
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        # La dernière classe reçoit les valeurs au-delà de la dernière borne.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estime le quantile `q` (entre 0 et 1) par interpolation linéaire
+        dans sa classe; retourne la dernière borne s'il la dépasse.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+    def payload(self) -> gloutils.HistogramPayload:
+        return gloutils.HistogramPayload(
+            count=self.count,
+            sum=self.sum,
+            buckets=list(self.counts),
+            p50=self.quantile(0.50),
+            p95=self.quantile(0.95),
+            p99=self.quantile(0.99)
+        )
+
+
+class Metrics:
+    """Métriques d'un processus serveur, utilisables par plusieurs fils."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._requests: dict[str, int] = {}
+        self._errors: dict[str, int] = {}
+        self._latencies: dict[str, Histogram] = {}
+        self._phases: dict[str, Histogram] = {phase: Histogram() for phase in PHASES}
+        self._gauges: dict[str, Callable[[], float]] = {}
+        self._bytes_received = 0
+        self._bytes_sent = 0
+        self._connections = 0
+        self._active_connections = 0
+
+    def observe_request(self, header: str, seconds: float, ok: bool) -> None:
+        """Compte une requête de type `header` traitée en `seconds` secondes."""
+        with self._lock:
+            histogram = self._latencies.get(header)
+            if histogram is None:
+                histogram = self._latencies[header] = Histogram()
+                self._requests[header] = 0
+                self._errors[header] = 0
+            histogram.observe(seconds)
+            self._requests[header] += 1
+            if not ok:
+                self._errors[header] += 1
+
+    def observe_phase(self, phase: str, seconds: float) -> None:
+        """
+        Ajoute `seconds` secondes passées dans la phase `phase`, ainsi
+        qu'à la requête suivie par le fil courant, s'il y en a une.
+        """
+        phases = getattr(_current, "phases", None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + seconds
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def tracking():
+        """
+        Retourne le dictionnaire où sont cumulés, par phase, les temps
+        observés par ce fil pendant le bloc.
+        """
+        previous = getattr(_current, "phases", None)
+        _current.phases = phases = {}
+        try:
+            yield phases
+        finally:
+            _current.phases = previous
+
+    @contextlib.contextmanager
+    def timed(self, phase: str):
+        """Mesure la durée du bloc dans la phase `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start)
+
+    def add_bytes(self, received: int = 0, sent: int = 0) -> None:
+        with self._lock:
+            self._bytes_received += received
+            self._bytes_sent += sent
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self._connections += 1
+            self._active_connections += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self._active_connections -= 1
+
+    def add_gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Ajoute la jauge `name`, dont la valeur est lue par `read`."""
+        self._gauges[name] = read
+
+    def snapshot(self) -> gloutils.MetricsPayload:
+        """Retourne une copie cohérente des métriques."""
+        gauges = {name: read() for name, read in self._gauges.items()}
+        with self._lock:
+            return gloutils.MetricsPayload(
+                uptime=time.time() - self._started,
+                buckets=list(LATENCY_BUCKETS),
+                requests=dict(self._requests),
+                errors=dict(self._errors),
+                latencies={header: histogram.payload() for header, histogram in self._latencies.items()},
+                phases={phase: histogram.payload() for phase, histogram in self._phases.items()},
+                bytes_received=self._bytes_received,
+                bytes_sent=self._bytes_sent,
+                connections=self._connections,
+                active_connections=self._active_connections,
+                gauges=gauges
+            )
+
+    def to_prometheus(self) -> str:
+        """Retourne les métriques au format texte de Prometheus."""
+        snapshot = self.snapshot()
+        lines = [
+            "# TYPE glo_uptime_seconds gauge",
+            f"glo_uptime_seconds {snapshot['uptime']:.3f}",
+            "# TYPE glo_requests_total counter",
+            *(f'glo_requests_total{{header="{header}"}} {count}'
+              for header, count in sorted(snapshot["requests"].items())),
+            "# TYPE glo_request_errors_total counter",
+            *(f'glo_request_errors_total{{header="{header}"}} {count}'
+              for header, count in sorted(snapshot["errors"].items())),
+            "# TYPE glo_request_duration_seconds histogram",
+        ]
+        for header, histogram in sorted(snapshot["latencies"].items()):
+            lines += _histogram_lines("glo_request_duration_seconds", f'header="{header}"', histogram)
+        lines.append("# TYPE glo_phase_duration_seconds histogram")
+        for phase, histogram in sorted(snapshot["phases"].items()):
+            lines += _histogram_lines("glo_phase_duration_seconds", f'phase="{phase}"', histogram)
+        lines += [
+            "# TYPE glo_received_bytes_total counter",
+            f"glo_received_bytes_total {snapshot['bytes_received']}",
+            "# TYPE glo_sent_bytes_total counter",
+            f"glo_sent_bytes_total {snapshot['bytes_sent']}",
+            "# TYPE glo_connections_total counter",
+            f"glo_connections_total {snapshot['connections']}",
+            "# TYPE glo_active_connections gauge",
+            f"glo_active_connections {snapshot['active_connections']}",
+        ]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE glo_{name} gauge", f"glo_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+class TimedProxy:
+    """
+    Enveloppe un objet et mesure la durée de chacun des appels à ses
+    méthodes dans une phase de `Metrics`, sauf celles de `exclude`.
+    """
+
+    def __init__(self, target, metrics: Metrics, phase: str,
+                 exclude: tuple[str, ...] = ()) -> None:
+        self._target = target
+        self._metrics = metrics
+        self._phase = phase
+        self._exclude = exclude
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name in self._exclude:
+            return attribute
+
+        def _timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._metrics.observe_phase(self._phase, time.perf_counter() - start)
+        return _timed
+
+
+class MetricsExporter:
+    """Écrit périodiquement les métriques au format Prometheus dans un fichier."""
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = EXPORT_INTERVAL) -> None:
+        """Les écritures ne commencent qu'avec `start`."""
+        self._metrics = metrics
+        self._path = path
+        self._interval = interval
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Lance le fil d'écriture en arrière-plan."""
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Arrête le fil d'écriture après une dernière écriture."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def export(self) -> None:
+        """Remplace le fichier par les métriques courantes."""
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self._metrics.to_prometheus())
+        os.replace(tmp_path, self._path)
+
+    def _run(self) -> None:
+        while True:
+            stopping = self._stopping.wait(self._interval)
+            try:
+                self.export()
+            except OSError as ex:
+                print(f"metrics export failed: {ex}")
+            if stopping:
+                return
+
+
+def _histogram_lines(name: str, labels: str, histogram: gloutils.HistogramPayload) -> list[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram['sum']:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {histogram['count']}")
+    return lines
@@ -0,0 +1,158 @@
+"""\
+Module fournissant le journal des requêtes lentes et le profileur du
+serveur.
+
+`SlowRequestLog` écrit une ligne JSON pour chaque requête dont le
+traitement dépasse un seuil: l'entête, l'utilisateur, la taille du
+message reçu, la durée totale et son détail par phase (voir
+glometrics): `disk` (stockage), `deferred` (attente d'un calcul hors de
+la boucle, comme le hachage d'un mot de passe) et `other`, le reste du
+traitement. Les envois SMTP n'en font pas partie: ils sont faits en
+arrière-plan par la file d'envoi (voir glorelay), après la réponse, et
+leur durée n'apparaît que dans les métriques.
+
+`SamplingProfiler` relève à intervalles réguliers la pile de tous les
+fils du processus pendant un nombre de secondes donné, puis écrit le
+résultat dans un fichier lisible par le module pstats
+(`python -m pstats FICHIER`). Contrairement à cProfile, qui ne suit que
+le fil qui l'active, il voit aussi bien la boucle select que la boucle
+asyncio et les fils de son exécuteur, sans les ralentir entre deux
+relevés. Les durées sont des estimations: un relevé compte pour le
+temps écoulé depuis le précédent. Le temps des fils inactifs apparaît
+dans les fonctions où ils attendent (`select`, `wait`).
+"""
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+SLOW_REQUEST_THRESHOLD = 1.0
+PROFILE_SECONDS = 30.0
+MAX_PROFILE_SECONDS = 600.0
+SAMPLE_INTERVAL = 0.005
+
+
+class ProfileError(Exception):
+    """Erreur levée quand le profileur ne peut pas être lancé."""
+
+
+class SlowRequestLog:
+    """Journal des requêtes dont le traitement dépasse un seuil."""
+
+    def __init__(self, threshold: float = SLOW_REQUEST_THRESHOLD,
+                 path: Optional[str] = None) -> None:
+        """
+        Journalise les requêtes de plus de `threshold` secondes dans le
+        fichier `path`, ou sur la sortie standard.
+        """
+        self.threshold = threshold
+        self._path = path
+        self._lock = threading.Lock()
+
+    def record(self, header: str, username: Optional[str], size: int,
+               seconds: float, phases: dict[str, float]) -> None:
+        """Journalise la requête si elle a duré au moins le seuil."""
+        if seconds < self.threshold:
+            return
+        phases = dict(phases)
+        phases["other"] = max(seconds - sum(phases.values()), 0.0)
+        line = json.dumps({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "header": header,
+            "user": username,
+            "size": size,
+            "ms": round(seconds * 1000, 3),
+            "phases_ms": {phase: round(value * 1000, 3) for phase, value in phases.items()},
+        })
+        if self._path is None:
+            print(f"slow request: {line}")
+            return
+        with self._lock, open(self._path, "a", encoding="utf-8") as log_file:
+            log_file.write(line + "\n")
+
+
+class SamplingProfiler:
+    """Profileur par échantillonnage des piles de tous les fils."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self._interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, path: str) -> None:
+        """
+        Profile le processus pendant `seconds` secondes en arrière-plan
+        puis écrit le résultat dans `path`.
+
+        Lève une exception ProfileError si un profilage est déjà en cours.
+        """
+        with self._lock:
+            if self.running:
+                raise ProfileError("a profiling session is already running")
+            self._thread = threading.Thread(target=self._run, args=(seconds, path),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+
+    def _run(self, seconds: float, path: str) -> None:
+        stats: dict[tuple, list] = {}
+        own_id = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        previous = time.perf_counter()
+        while True:
+            time.sleep(self._interval)
+            now = time.perf_counter()
+            elapsed, previous = now - previous, now
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    _add_sample(stats, frame, elapsed)
+            if now >= deadline:
+                break
+
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as stats_file:
+                marshal.dump({function: (calls, calls, own_time, total_time, callers)
+                              for function, (calls, own_time, total_time, callers) in stats.items()},
+                             stats_file)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            print(f"profile export failed: {ex}")
+            return
+        print(f"profile written to {path}")
+
+
+def _add_sample(stats: dict[tuple, list], frame, elapsed: float) -> None:
+    """
+    Ajoute la pile `frame` aux statistiques, au format de pstats:
+    [appels, temps propre, temps cumulé, {appelant: (appels, appels,
+    temps propre, temps cumulé)}], où un appel est un relevé.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+
+    seen = set()
+    for depth, function in enumerate(stack):
+        entry = stats.get(function)
+        if entry is None:
+            entry = stats[function] = [0, 0.0, 0.0, {}]
+        own_time = elapsed if depth == 0 else 0.0
+        entry[1] += own_time
+        # Une fonction récursive ne compte qu'une fois par relevé.
+        if function not in seen:
+            seen.add(function)
+            entry[0] += 1
+            entry[2] += elapsed
+        if depth + 1 < len(stack):
+            caller = stack[depth + 1]
+            calls, _, caller_own, caller_total = entry[3].get(caller, (0, 0, 0.0, 0.0))
+            entry[3][caller] = (calls + 1, calls + 1, caller_own + own_time, caller_total + elapsed)
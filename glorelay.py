@@ -0,0 +1,503 @@
+"""\
+Module fournissant la file d'envoi des courriels externes.
+
+Les courriels à relayer sont écrits dans le dossier SERVER_SPOOL_DIR
+puis confirmés immédiatement au client. Des fils de livraison vident la
+file en arrière-plan et réessaient les envois échoués avec un délai
+exponentiel.
+
+Les fils partagent un petit bassin de sessions SMTP persistantes: les
+courriels en attente sont envoyés par lots sur une même session, qui
+est réutilisée jusqu'à `max_messages` courriels puis fermée.
+
+Un courriel destiné à plusieurs adresses externes n'occupe qu'une
+entrée de la file et est envoyé en une seule transaction SMTP, avec
+une commande RCPT TO par destinataire.
+
+Organisation du dossier:
+- `<id>.json`: courriel en attente (nouveau ou à réessayer);
+- `<id>.sending`: courriel réservé par un fil en cours d'envoi;
+- `done/<id>.json`: courriel envoyé ou abandonné, conservé pour le suivi.
+
+La réservation par renommage permet à plusieurs processus serveur de
+partager la même file.
+"""
+import contextlib
+import json
+import os
+import smtplib
+import threading
+import time
+import uuid
+from email.message import EmailMessage
+from typing import Optional, TypedDict
+
+import glometrics
+import gloutils
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+POLL_INTERVAL = 1.0
+RETRY_BASE_DELAY = 30.0
+RETRY_MAX_DELAY = 3600.0
+MAX_ATTEMPTS = 8
+SMTP_TIMEOUT = 10
+# Une session inutilisée plus longtemps est fermée.
+SMTP_IDLE_TIMEOUT = 30.0
+# Une session inutilisée plus longtemps est vérifiée avec NOOP avant d'être réutilisée.
+SMTP_HEALTH_CHECK_DELAY = 5.0
+SMTP_MAX_MESSAGES = 100
+# Un envoi réservé depuis plus longtemps est considéré interrompu.
+STALE_SENDING_DELAY = 300.0
+DONE_RETENTION = 24 * 3600.0
+PURGE_INTERVAL = 60.0
+
+_DONE_DIR = "done"
+
+
+class RelayError(Exception):
+    """Erreur levée quand un courriel ne peut pas être relayé."""
+
+
+class SpoolEntry(TypedDict, total=True):
+    """
+    Courriel de la file, ses destinataires externes et son état de
+    livraison.
+    """
+    id: str
+    recipients: list[str]
+    status: str
+    attempts: int
+    next_attempt: float
+    error: str
+    payload: gloutils.EmailContentPayload
+
+
+class _Session:
+    """Session SMTP ouverte et son utilisation."""
+
+    def __init__(self, connection: smtplib.SMTP) -> None:
+        self.connection = connection
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """Bassin de sessions SMTP persistantes vers un même serveur."""
+
+    def __init__(self, host: str, port: int, size: int = 1,
+                 max_messages: int = SMTP_MAX_MESSAGES) -> None:
+        """
+        Garde au plus `size` sessions inactives vers `host`:`port`.
+        Une session est fermée après `max_messages` courriels.
+        """
+        self._host = host
+        self._port = port
+        self._size = size
+        self._max_messages = max_messages
+        self._idle: list[_Session] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> _Session:
+        """
+        Retourne une session inactive en bon état ou en ouvre une nouvelle,
+        saluée avec EHLO (ou HELO).
+
+        Lève les exceptions de smtplib ou OSError si la connexion ou la
+        salutation échoue.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session = self._idle.pop()
+            idle_time = time.monotonic() - session.last_used
+            if idle_time > SMTP_IDLE_TIMEOUT:
+                _close_session(session)
+            elif idle_time > SMTP_HEALTH_CHECK_DELAY and not _is_healthy(session):
+                _close_session(session)
+            else:
+                return session
+        connection = smtplib.SMTP(host=self._host, port=self._port, timeout=SMTP_TIMEOUT)
+        try:
+            # Saluer ici plutôt que dans `send_message`, pour qu'un refus
+            # soit une erreur de connexion et non celle d'un courriel.
+            connection.ehlo_or_helo_if_needed()
+        except BaseException:
+            connection.close()
+            raise
+        return _Session(connection)
+
+    def release(self, session: _Session, broken: bool = False) -> None:
+        """
+        Rend la session au bassin, ou la ferme si elle est brisée, a atteint
+        sa limite de courriels ou si le bassin est plein.
+        """
+        session.last_used = time.monotonic()
+        if not broken and session.sent < self._max_messages:
+            with self._lock:
+                if len(self._idle) < self._size:
+                    self._idle.append(session)
+                    return
+        _close_session(session, broken)
+
+    def exhausted(self, session: _Session) -> bool:
+        """Indique si la session a envoyé son nombre maximal de courriels."""
+        return session.sent >= self._max_messages
+
+    def expire_idle(self) -> None:
+        """Ferme les sessions inactives depuis plus de SMTP_IDLE_TIMEOUT."""
+        with self._lock:
+            expired = [session for session in self._idle
+                       if time.monotonic() - session.last_used > SMTP_IDLE_TIMEOUT]
+            self._idle = [session for session in self._idle if session not in expired]
+        for session in expired:
+            _close_session(session)
+
+    def close(self) -> None:
+        """Ferme toutes les sessions inactives."""
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            _close_session(session)
+
+
+class RelayQueue:
+    """File persistante des courriels à relayer au serveur SMTP."""
+
+    def __init__(self, spool_dir: str, smtp_host: str = gloutils.SMTP_SERVER,
+                 smtp_port: int = 25, workers: int = 1,
+                 max_messages: int = SMTP_MAX_MESSAGES,
+                 metrics: Optional[glometrics.Metrics] = None) -> None:
+        """
+        Prépare la file dans `spool_dir` pour le serveur `smtp_host`.
+
+        `workers` fils de livraison partageront un bassin d'autant de
+        sessions, chacune réutilisée pour au plus `max_messages` courriels.
+        Les fils ne sont lancés que par `start`.
+
+        Le temps passé avec le serveur SMTP (connexion et envois) est
+        ajouté à la phase `smtp` de `metrics`, s'il y en a.
+        """
+        self._spool_dir = spool_dir
+        self._done_dir = os.path.join(spool_dir, _DONE_DIR)
+        self._pool = SMTPPool(smtp_host, smtp_port, workers, max_messages)
+        self._workers = workers
+        self._batch_size = max_messages
+        self._metrics = metrics
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+        self._last_purge = 0.0
+        self._last_recovery = 0.0
+        os.makedirs(self._done_dir, exist_ok=True)
+
+    def start(self) -> None:
+        """Lance les fils de livraison en arrière-plan."""
+        self._recover_stale()
+        for index in range(self._workers):
+            thread = threading.Thread(target=self._run, name=f"relay-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Demande l'arrêt des fils de livraison, les attend et ferme les sessions."""
+        self._stopping = True
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._pool.close()
+
+    def enqueue(self, payload: gloutils.EmailContentPayload,
+                recipients: Optional[list[str]] = None) -> SpoolEntry:
+        """
+        Écrit le courriel dans la file et retourne son entrée.
+
+        `recipients` sont les adresses à qui l'envoyer, par défaut
+        `destination`.
+
+        Lève une exception RelayError si le courriel ne peut pas être
+        transmis au serveur SMTP (voir `check_email`).
+        """
+        check_email(payload)
+        entry = SpoolEntry(
+            id=uuid.uuid4().hex,
+            recipients=[payload["destination"]] if recipients is None else recipients,
+            status=QUEUED,
+            attempts=0,
+            next_attempt=time.time(),
+            error="",
+            payload=payload
+        )
+        _write_entry(self._pending_path(entry["id"]), entry)
+        self._wakeup.set()
+        return entry
+
+    def status(self, relay_id: str) -> Optional[SpoolEntry]:
+        """Retourne l'entrée du courriel `relay_id`, None si elle est inconnue."""
+        if not relay_id.isalnum():
+            return None
+        for path, status in ((self._pending_path(relay_id), None),
+                             (self._sending_path(relay_id), SENDING),
+                             (os.path.join(self._done_dir, f"{relay_id}.json"), None)):
+            try:
+                entry = _read_entry(path)
+            except (OSError, ValueError):
+                continue
+            if status is not None:
+                entry["status"] = status
+            return entry
+        return None
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                next_attempt = self._deliver_due()
+                self._pool.expire_idle()
+            except Exception as ex:
+                # Une erreur imprévue ne doit pas arrêter les livraisons; les
+                # courriels réservés seront repris par `_recover_stale`.
+                print(f"relay failed: {ex!r}")
+                next_attempt = None
+            delay = POLL_INTERVAL if next_attempt is None else min(POLL_INTERVAL, next_attempt - time.time())
+            self._wakeup.wait(max(delay, 0))
+
+    def _deliver_due(self) -> Optional[float]:
+        """
+        Envoie par lots les courriels dont l'heure d'essai est passée et
+        retourne l'heure du prochain essai connu.
+        """
+        next_attempt = None
+        batch = []
+        for file_name in os.listdir(self._spool_dir):
+            if self._stopping:
+                break
+            if not file_name.endswith(".json"):
+                continue
+            relay_id = file_name[:-len(".json")]
+            try:
+                entry = _read_entry(self._pending_path(relay_id))
+            except (OSError, ValueError):
+                continue
+            if entry["next_attempt"] > time.time():
+                if next_attempt is None or entry["next_attempt"] < next_attempt:
+                    next_attempt = entry["next_attempt"]
+                continue
+            if self._claim(relay_id):
+                batch.append(entry)
+            if len(batch) >= self._batch_size:
+                self._deliver_batch(batch)
+                batch = []
+        if batch:
+            self._deliver_batch(batch)
+        self._purge_done()
+        self._recover_stale()
+        return next_attempt
+
+    def _claim(self, relay_id: str) -> bool:
+        """Réserve le courriel pour ce fil; échoue si un autre l'a déjà pris."""
+        try:
+            os.rename(self._pending_path(relay_id), self._sending_path(relay_id))
+            os.utime(self._sending_path(relay_id))
+        except OSError:
+            return False
+        return True
+
+    def _deliver_batch(self, entries: list[SpoolEntry]) -> None:
+        """
+        Envoie les courriels sur une même session du bassin et enregistre
+        leur nouvel état.
+
+        Si la connexion au serveur échoue ou est refusée, le courriel et
+        les courriels restants du lot sont reportés sans nouvelle
+        tentative de connexion. Une session fermée par le serveur (421,
+        déconnexion) n'est pas réutilisée. Un courriel
+        accepté pour une partie de ses destinataires est considéré
+        envoyé, les adresses refusées étant notées dans `error`.
+        """
+        session = None
+        connection_error = ""
+        for entry in entries:
+            # Un lot peut durer plus que STALE_SENDING_DELAY: la réservation
+            # est rafraîchie pour que `_recover_stale` ne la reprenne pas.
+            try:
+                os.utime(self._sending_path(entry["id"]))
+            except OSError:
+                # Réservation déjà reprise: le courriel sera envoyé par son nouveau fil.
+                continue
+            entry["attempts"] += 1
+            if connection_error:
+                self._reschedule(entry, connection_error, permanent=False)
+                self._record(entry)
+                continue
+            try:
+                with self._timed():
+                    if session is None:
+                        session = self._pool.acquire()
+                    refused = session.connection.send_message(make_email_message(entry["payload"]),
+                                                              to_addrs=_recipients(entry))
+                session.sent += 1
+                entry["status"] = SENT
+                entry["error"] = f"recipients refused: {sorted(refused)}" if refused else ""
+            except smtplib.SMTPRecipientsRefused as ex:
+                self._reschedule(entry, f"recipients refused: {list(ex.recipients)}", permanent=True)
+            except ValueError as ex:
+                # Courriel mis en file avant `check_email`: il ne pourra jamais être envoyé.
+                self._reschedule(entry, f"invalid email: {ex}", permanent=True)
+            except smtplib.SMTPResponseException as ex:
+                error = f"{ex.smtp_code} {ex.smtp_error!r}"
+                if session is None:
+                    # Refus de la connexion (accueil ou salutation, voir SMTPPool.acquire):
+                    # rien ne concerne ce courriel.
+                    connection_error = error
+                    self._reschedule(entry, error, permanent=False)
+                else:
+                    if ex.smtp_code == 421:
+                        # Le serveur ferme la session.
+                        self._pool.release(session, broken=True)
+                        session = None
+                    self._reschedule(entry, error, permanent=ex.smtp_code >= 500)
+            except (smtplib.SMTPException, OSError) as ex:
+                if session is None:
+                    connection_error = str(ex) or type(ex).__name__
+                else:
+                    self._pool.release(session, broken=True)
+                    session = None
+                self._reschedule(entry, str(ex) or type(ex).__name__, permanent=False)
+            self._record(entry)
+
+            if session is not None and self._pool.exhausted(session):
+                self._pool.release(session)
+                session = None
+        if session is not None:
+            self._pool.release(session)
+
+    def _timed(self):
+        if self._metrics is None:
+            return contextlib.nullcontext()
+        return self._metrics.timed("smtp")
+
+    def _record(self, entry: SpoolEntry) -> None:
+        """Enregistre l'état du courriel et libère sa réservation."""
+        if entry["status"] in (SENT, FAILED):
+            _write_entry(os.path.join(self._done_dir, f"{entry['id']}.json"), entry)
+        else:
+            _write_entry(self._pending_path(entry["id"]), entry)
+        # La réservation a pu être reprise par un autre fil ou processus.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._sending_path(entry["id"]))
+
+    @staticmethod
+    def _reschedule(entry: SpoolEntry, error: str, permanent: bool) -> None:
+        entry["error"] = error
+        if permanent or entry["attempts"] >= MAX_ATTEMPTS:
+            entry["status"] = FAILED
+            return
+        entry["status"] = QUEUED
+        delay = min(RETRY_BASE_DELAY * 2 ** (entry["attempts"] - 1), RETRY_MAX_DELAY)
+        entry["next_attempt"] = time.time() + delay
+
+    def _recover_stale(self) -> None:
+        """
+        Remet en file les envois interrompus par l'arrêt d'un serveur,
+        au démarrage puis toutes les PURGE_INTERVAL secondes, pour qu'un
+        envoi interrompu peu avant un redémarrage ne reste pas bloqué.
+        """
+        if time.time() - self._last_recovery < PURGE_INTERVAL:
+            return
+        self._last_recovery = time.time()
+        for file_name in os.listdir(self._spool_dir):
+            if not file_name.endswith(".sending"):
+                continue
+            path = os.path.join(self._spool_dir, file_name)
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_SENDING_DELAY:
+                    os.rename(path, self._pending_path(file_name[:-len(".sending")]))
+            except OSError:
+                continue
+
+    def _purge_done(self) -> None:
+        """Supprime les suivis plus vieux que DONE_RETENTION."""
+        if time.time() - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = time.time()
+        for file_name in os.listdir(self._done_dir):
+            path = os.path.join(self._done_dir, file_name)
+            try:
+                if time.time() - os.path.getmtime(path) > DONE_RETENTION:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _pending_path(self, relay_id: str) -> str:
+        return os.path.join(self._spool_dir, f"{relay_id}.json")
+
+    def _sending_path(self, relay_id: str) -> str:
+        return os.path.join(self._spool_dir, f"{relay_id}.sending")
+
+
+def check_email(payload: gloutils.EmailContentPayload) -> None:
+    """
+    Lève une exception RelayError si le courriel ne peut pas devenir un
+    message SMTP, par exemple si une entête contient un saut de ligne.
+    """
+    try:
+        make_email_message(payload)
+    except ValueError as ex:
+        raise RelayError(str(ex)) from ex
+
+
+def make_email_message(payload: gloutils.EmailContentPayload) -> EmailMessage:
+    """
+    Transforme le payload en EmailMessage pour le serveur SMTP.
+
+    Lève une exception ValueError si une entête est invalide.
+    """
+    message = EmailMessage()
+    message["From"] = payload["sender"]
+    message["To"] = payload["destination"]
+    message["Subject"] = payload["subject"]
+    message["Date"] = payload["date"]
+    message.set_content(payload["content"])
+    return message
+
+
+def _recipients(entry: SpoolEntry) -> list[str]:
+    # Les entrées écrites avant l'envoi à plusieurs destinataires n'ont pas de `recipients`.
+    return entry.get("recipients") or [entry["payload"]["destination"]]
+
+
+def _is_healthy(session: _Session) -> bool:
+    try:
+        code, _ = session.connection.noop()
+    except (smtplib.SMTPException, OSError):
+        return False
+    return code == 250
+
+
+def _close_session(session: _Session, broken: bool = False) -> None:
+    """Termine la session avec QUIT, ou ferme simplement le socket si elle est brisée."""
+    try:
+        if not broken:
+            session.connection.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+    finally:
+        session.connection.close()
+
+
+def _read_entry(path: str) -> SpoolEntry:
+    with open(path, encoding="utf-8") as entry_file:
+        return json.load(entry_file)
+
+
+def _write_entry(path: str, entry: SpoolEntry) -> None:
+    """Écrit l'entrée dans un fichier temporaire puis le renomme."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as entry_file:
+        json.dump(entry, entry_file)
+    os.replace(tmp_path, path)
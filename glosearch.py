@@ -0,0 +1,211 @@
+"""\
+Module fournissant la recherche plein texte dans les boîtes de courriels.
+
+Chaque courriel est découpé en termes (mots en minuscules, sans
+accents) tirés de l'expéditeur, du sujet et du contenu, pondérés selon
+leur champ. Un index inversé associe chaque terme aux courriels qui le
+contiennent.
+
+`SearchIndex` garde l'index d'une boîte dans le fichier
+SEARCH_INDEX_FILENAME de son dossier, une ligne JSON par courriel,
+complété à chaque livraison. Les listes de courriels d'un terme sont
+gardées en mémoire dans des tableaux compacts, triés par ordre de
+livraison.
+
+Une recherche retourne les courriels contenant tous les termes de la
+requête, classés par la somme des poids de leurs termes multipliés par
+la rareté de ceux-ci dans la boîte, puis du plus récent au plus ancien.
+"""
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from typing import Hashable, Iterable, Optional, Sequence
+
+import gloutils
+
+MIN_TERM_LENGTH = 2
+FIELD_WEIGHTS = {"subject": 3, "sender": 2, "content": 1}
+
+# Une liste plus longue que ce facteur fois les candidats est sondée par bisection.
+_MERGE_RATIO = 8
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Découpe le texte en termes en minuscules et sans accents."""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    if not normalized.isascii():
+        normalized = "".join(char for char in normalized if not unicodedata.combining(char))
+    return [word for word in _WORD_PATTERN.findall(normalized) if len(word) >= MIN_TERM_LENGTH]
+
+
+def query_terms(query: str) -> list[str]:
+    """Retourne les termes distincts de la requête."""
+    return list(dict.fromkeys(tokenize(query)))
+
+
+def document_terms(payload: gloutils.EmailContentPayload) -> dict[str, int]:
+    """Retourne le poids de chaque terme du courriel."""
+    weights: dict[str, int] = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        for term in tokenize(payload[field]):
+            weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def rank(postings: list[tuple[Sequence[int], Sequence[int]]], document_count: int,
+         limit: Optional[int] = None) -> tuple[list[int], int]:
+    """
+    Classe les documents présents dans toutes les listes `postings`,
+    chacune formée des numéros de documents croissants d'un terme et de
+    leurs poids. Retourne au plus `limit` numéros, du plus pertinent au
+    moins pertinent, et le nombre total de documents trouvés.
+    """
+    if not postings or any(len(docs) == 0 for docs, _ in postings):
+        return [], 0
+
+    postings = sorted(postings, key=lambda posting: len(posting[0]))
+    idfs = [math.log(1 + document_count / len(docs)) for docs, _ in postings]
+    first_docs, first_weights = postings[0]
+    scores = {doc: weight * idfs[0] for doc, weight in zip(first_docs, first_weights)}
+    for (docs, weights), idf in zip(postings[1:], idfs[1:]):
+        if len(docs) <= _MERGE_RATIO * len(scores):
+            # Listes de tailles voisines: parcours complet de la liste.
+            scores = {doc: scores[doc] + weight * idf
+                      for doc, weight in zip(docs, weights) if doc in scores}
+        else:
+            # Liste beaucoup plus longue: sondée par bisection.
+            matched = {}
+            for doc, score in scores.items():
+                index = bisect.bisect_left(docs, doc)
+                if index < len(docs) and docs[index] == doc:
+                    matched[doc] = score + weights[index] * idf
+            scores = matched
+        if not scores:
+            return [], 0
+    scored = [(score, doc) for doc, score in scores.items()]
+
+    if limit is None:
+        best = sorted(scored, reverse=True)
+    else:
+        best = heapq.nlargest(limit, scored)
+    return [doc for _, doc in best], len(scored)
+
+
+class SearchIndex:
+    """
+    Index inversé persistant des courriels d'une boîte.
+
+    Chaque courriel y est désigné par une clé fournie par la boîte, qui
+    doit protéger les écritures avec son propre verrou.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Utilise le fichier `path`, lu seulement au premier `refresh`."""
+        self._path = path
+        self._lock = threading.RLock()
+        self._reset()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def refresh(self) -> None:
+        """
+        Lit les courriels ajoutés au fichier depuis la dernière lecture,
+        ou le relit au complet s'il a été remplacé.
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self._path)
+            except FileNotFoundError:
+                self._reset()
+                return
+            if stat.st_ino == self._inode and stat.st_size == self._read_offset:
+                return
+            with open(self._path, "rb") as index_file:
+                inode = os.fstat(index_file.fileno()).st_ino
+                if inode != self._inode:
+                    self._reset()
+                    self._inode = inode
+                index_file.seek(self._read_offset)
+                for line in index_file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._read_offset += len(line)
+                    record = json.loads(line)
+                    self._append_document(record["key"], record["terms"])
+
+    def add(self, key: Hashable, payload: gloutils.EmailContentPayload) -> None:
+        """Ajoute le courriel `key` à la fin du fichier."""
+        with open(self._path, "ab") as index_file:
+            index_file.write(_encode_document(key, document_terms(payload)))
+
+    def rebuild(self, documents: Iterable[tuple[Hashable, gloutils.EmailContentPayload]]) -> None:
+        """Remplace l'index par celui des courriels `documents`, dans l'ordre."""
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "wb") as index_file:
+            for key, payload in documents:
+                index_file.write(_encode_document(key, document_terms(payload)))
+        os.replace(tmp_path, self._path)
+        self.refresh()
+
+    def remap(self, keys: dict) -> None:
+        """
+        Réécrit l'index en remplaçant chaque clé par `keys[clé]`; les
+        courriels dont la clé n'y figure pas sont retirés.
+        """
+        if not os.path.exists(self._path):
+            return
+        tmp_path = f"{self._path}.tmp"
+        with open(self._path, "rb") as index_file, open(tmp_path, "wb") as tmp_file:
+            for line in index_file:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if record["key"] in keys:
+                    tmp_file.write(_encode_document(keys[record["key"]], record["terms"]))
+        os.replace(tmp_path, self._path)
+        self.refresh()
+
+    def search(self, query: str, limit: Optional[int] = None) -> tuple[list[Hashable], int]:
+        """
+        Retourne les clés d'au plus `limit` courriels contenant tous les
+        termes de la requête, du plus pertinent au moins pertinent, et
+        le nombre total de courriels trouvés.
+        """
+        with self._lock:
+            postings = []
+            for term in query_terms(query):
+                posting = self._postings.get(term)
+                if posting is None:
+                    return [], 0
+                postings.append(posting)
+            docs, total = rank(postings, len(self._keys), limit)
+            return [self._keys[doc] for doc in docs], total
+
+    def _reset(self) -> None:
+        self._keys: list[Hashable] = []
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._inode = None
+        self._read_offset = 0
+
+    def _append_document(self, key: Hashable, terms: dict[str, int]) -> None:
+        doc = len(self._keys)
+        self._keys.append(key)
+        for term, weight in terms.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = (array("I"), array("I"))
+            posting[0].append(doc)
+            posting[1].append(weight)
+
+
+def _encode_document(key: Hashable, terms: dict[str, int]) -> bytes:
+    return json.dumps({"key": key, "terms": terms}).encode("utf-8") + b"\n"
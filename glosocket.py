@@ -1,9 +1,29 @@
 """\
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
+
+Chaque message est précédé de sa longueur sur 4 octets. Le bit de
+poids fort de la longueur indique un message compressé avec zlib.
+L'émetteur ne compresse que si le destinataire l'a accepté, mais
+tout récepteur décompresse les messages marqués.
+
+Les fonctions de réception acceptent une taille maximale: un message
+annoncé ou décompressé plus grand est refusé avant d'être lu en entier.
 """
+import asyncio
 import socket
 import struct
+import zlib
+
+# En deçà de cette taille, copier le message coûte moins cher que
+# les appels recv_into/sendmsg supplémentaires.
+SMALL_MESSAGE_SIZE = 64 * 1024
+
+COMPRESSED_FLAG = 0x80000000
+MAX_MESSAGE_SIZE = COMPRESSED_FLAG - 1
+# Les messages plus petits ne sont jamais compressés.
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
 
 
 class GLOSocketError(Exception):
@@ -13,49 +33,139 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+def _recvall(source: socket.socket, size: int) -> bytes | bytearray:
     """
     Fonction utilitaire pour recv_msg.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Préalloue un tampon de la taille voulue et le remplit
+    avec socket.recv_into jusqu'à ce qu'il soit complet.
+    Les petits messages sont d'abord lus avec un seul recv.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    buffer = b""
+    if 0 < size <= SMALL_MESSAGE_SIZE:
         try:
-            buffer = source.recv(chunk_size)
+            buffer = source.recv(size)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
         if not buffer:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
+        if len(buffer) == size:
+            return buffer
+
+    msg = bytearray(size)
+    msg[:len(buffer)] = buffer
+    view = memoryview(msg)[len(buffer):]
+    while view:
+        try:
+            received = source.recv_into(view)
+        except OSError as ex:
+            raise GLOSocketError("The source socket is closed.") from ex
+        if not received:
+            raise GLOSocketError("The other socket is closed.")
+        view = view[received:]
     return msg
 
 
-def send_msg(dest_soc: socket.socket, message: str) -> None:
+def _sendall_parts(dest_soc: socket.socket, *parts: bytes) -> None:
     """
-    Encode le message puis le transmet à la destination.
+    Fonction utilitaire pour send_msg.
+
+    Transmet les morceaux à la suite sans les concaténer, avec
+    socket.sendmsg quand la plateforme le permet.
+    """
+    if not hasattr(dest_soc, "sendmsg"):
+        for part in parts:
+            dest_soc.sendall(part)
+        return
+
+    views = [memoryview(part) for part in parts if part]
+    while views:
+        sent = dest_soc.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def _frame(data: bytes, compress: bool) -> tuple[bytes, bytes]:
+    """
+    Retourne la longueur encodée et les octets à transmettre, compressés
+    si `compress` est vrai, que le message dépasse COMPRESSION_THRESHOLD
+    et que la compression le réduit.
+    """
+    if compress and len(data) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        if len(compressed) < len(data):
+            return struct.pack("!I", len(compressed) | COMPRESSED_FLAG), compressed
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise GLOSocketError("The message is too large")
+    return struct.pack("!I", len(data)), data
+
+
+def _unframe(data: bytes, compressed: bool, max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    Décompresse les octets reçus si le message était marqué compressé,
+    sans produire plus de `max_size` octets.
+    """
+    if not compressed:
+        return data
+    decompressor = zlib.decompressobj()
+    try:
+        decompressed = decompressor.decompress(data, max_size + 1)
+    except zlib.error as ex:
+        raise GLOSocketError("The received data could not be decompressed") from ex
+    if len(decompressed) > max_size:
+        raise GLOSocketError("The message is too large")
+    if not decompressor.eof:
+        raise GLOSocketError("The received data could not be decompressed")
+    return decompressed
+
+
+def _check_size(length: int, max_size: int) -> int:
+    """Retourne la taille annoncée par la longueur, si elle est acceptée."""
+    size = length & MAX_MESSAGE_SIZE
+    if size > max_size:
+        raise GLOSocketError("The message is too large")
+    return size
+
+
+def send_data(dest_soc: socket.socket, data: bytes, compress: bool = False) -> None:
+    """
+    Transmet les octets à la destination, précédés de leur longueur.
+
+    Si `compress` est vrai, les messages assez grands sont compressés.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    data_length, data = _frame(data, compress)
     try:
-        dest_soc.sendall(data_length + data)
+        if len(data) <= SMALL_MESSAGE_SIZE:
+            dest_soc.sendall(data_length + data)
+        else:
+            _sendall_parts(dest_soc, data_length, data)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def recv_msg(source_soc: socket.socket) -> str:
+def send_msg(dest_soc: socket.socket, message: str) -> None:
     """
-    Récupère un message de la source et le décode.
+    Encode le message puis le transmet à la destination.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
+    send_data(dest_soc, message.encode(encoding='utf-8'))
+
+
+def recv_data(source_soc: socket.socket, max_size: int = MAX_MESSAGE_SIZE) -> bytes | bytearray:
+    """
+    Récupère les octets d'un message de la source.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message dépasse `max_size` octets.
+    """
     data_length = _recvall(source_soc, 4)
     try:
         length, = struct.unpack("!I", data_length)
@@ -63,5 +173,194 @@ def recv_msg(source_soc: socket.socket) -> str:
         raise GLOSocketError("The received data was"
                              " not the message's length") from ex
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+    data = _recvall(source_soc, _check_size(length, max_size))
+    return _unframe(data, bool(length & COMPRESSED_FLAG), max_size)
+
+
+def recv_msg(source_soc: socket.socket) -> str:
+    """
+    Récupère un message de la source et le décode.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    return recv_data(source_soc).decode('utf-8')
+
+
+class FrameDecoder:
+    """
+    Décodeur incrémental des messages reçus sur un socket non bloquant.
+
+    Accumule les octets disponibles et retourne les messages complets
+    dès que leur longueur annoncée a été reçue. Un message annoncé plus
+    grand que `max_size` est refusé sans être accumulé.
+    """
+
+    def __init__(self, max_size: int = MAX_MESSAGE_SIZE) -> None:
+        self._buffer = bytearray()
+        self._max_size = max_size
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        Ajoute `data` au tampon et retourne les messages complets,
+        encodés en UTF-8, dans leur ordre d'arrivée.
+
+        Lève une exception GLOSocketError si un message est trop grand.
+        """
+        # Les octets reçus ne sont ajoutés au tampon que s'il contient le
+        # début d'un message. Les messages sont lus à leur position dans
+        # `data`, les messages compressés décompressés sans copie, et le
+        # tampon n'est compacté qu'une fois par appel.
+        if self._buffer:
+            self._buffer += data
+            data = self._buffer
+        messages = []
+        offset = 0
+        with memoryview(data) as view:
+            while len(view) - offset >= 4:
+                length, = struct.unpack_from("!I", view, offset)
+                size = _check_size(length, self._max_size)
+                end = offset + 4 + size
+                if len(view) < end:
+                    break
+                if length & COMPRESSED_FLAG:
+                    with view[offset + 4:end] as frame:
+                        messages.append(_unframe(frame, True, self._max_size))
+                else:
+                    messages.append(bytes(view[offset + 4:end]))
+                offset = end
+        if data is self._buffer:
+            del self._buffer[:offset]
+        else:
+            self._buffer = bytearray(data[offset:])
+        return messages
+
+    def recv_from(self, source: socket.socket) -> list[bytes]:
+        """
+        Lit les octets disponibles sur le socket sans bloquer et retourne
+        les messages complets.
+
+        Lève une exception GLOSocketError si le socket est fermé ou si
+        un message est trop grand ou compressé de façon invalide.
+        """
+        try:
+            data = source.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError as ex:
+            raise GLOSocketError("The source socket is closed.") from ex
+        if not data:
+            raise GLOSocketError("The other socket is closed.")
+        return self.feed(data)
+
+
+class FrameWriter:
+    """
+    Tampon d'écriture pour un socket non bloquant.
+
+    Les messages sont ajoutés au tampon et transmis au fur et à mesure
+    que le socket accepte des données.
+    """
+
+    def __init__(self, dest: socket.socket) -> None:
+        self._socket = dest
+        self._buffer = bytearray()
+
+    @property
+    def pending(self) -> bool:
+        """Indique s'il reste des octets à transmettre."""
+        return bool(self._buffer)
+
+    def write(self, message: str | bytes, compress: bool = False) -> None:
+        """
+        Encode et ajoute le message au tampon. Il sera transmis par le
+        prochain appel à flush, avec les autres messages en attente.
+
+        Si `compress` est vrai, les messages assez grands sont compressés.
+        """
+        data = message.encode(encoding='utf-8') if isinstance(message, str) else message
+        data_length, data = _frame(data, compress)
+        self._buffer += data_length
+        self._buffer += data
+
+    def flush(self) -> None:
+        """
+        Transmet autant d'octets du tampon que le socket en accepte.
+
+        Lève une exception GLOSocketError en cas de problème
+        de communication.
+        """
+        while self._buffer:
+            try:
+                sent = self._socket.send(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                raise GLOSocketError("Cannot send data with socket") from ex
+            del self._buffer[:sent]
+
+
+def write_data(writer: asyncio.StreamWriter, data: bytes, compress: bool = False) -> None:
+    """
+    Place le message dans le tampon d'un flux asyncio sans attendre
+    qu'il soit transmis. Doit être appelée dans le fil de la boucle.
+    """
+    writer.writelines(_frame(data, compress))
+
+
+async def async_send_data(writer: asyncio.StreamWriter, data: bytes,
+                          compress: bool = False) -> None:
+    """
+    Équivalent de send_data pour un flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    await async_send_all(writer, [data], compress)
+
+
+async def async_send_all(writer: asyncio.StreamWriter, messages: list[bytes],
+                         compress: bool = False) -> None:
+    """
+    Place tous les messages dans le tampon du flux, sans attente entre
+    eux pour qu'aucun autre message ne s'intercale, puis attend qu'ils
+    soient transmis.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    try:
+        for data in messages:
+            write_data(writer, data, compress)
+        await writer.drain()
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with stream") from ex
+
+
+async def async_send_msg(writer: asyncio.StreamWriter, message: str) -> None:
+    """Équivalent de send_msg pour un flux asyncio."""
+    await async_send_data(writer, message.encode(encoding='utf-8'))
+
+
+async def async_recv_data(reader: asyncio.StreamReader,
+                          max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    Équivalent de recv_data pour un flux asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    try:
+        data_length = await reader.readexactly(4)
+        length, = struct.unpack("!I", data_length)
+        data = await reader.readexactly(_check_size(length, max_size))
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source stream is closed.") from ex
+    return _unframe(data, bool(length & COMPRESSED_FLAG), max_size)
+
+
+async def async_recv_msg(reader: asyncio.StreamReader) -> str:
+    """Équivalent de recv_msg pour un flux asyncio."""
+    return (await async_recv_data(reader)).decode('utf-8')
@@ -0,0 +1,789 @@
+"""\
+Module fournissant le stockage des comptes et des courriels du serveur.
+
+`MailStorage` décrit les opérations utilisées par le serveur. Trois
+implémentations sont offertes:
+- `FileSystemStorage`: un dossier par utilisateur dans SERVER_DATA_DIR,
+    un fichier par courriel et un index (voir glomailbox);
+- `LogStorage`: les mêmes dossiers, les courriels étant ajoutés à un
+    seul fichier segment (voir glolog);
+- `SQLiteStorage`: une base SQLite en mode WAL, les courriels étant
+    indexés par utilisateur et par date.
+
+`CachedStorage` ajoute à l'un d'eux un cache LRU en mémoire des listes
+et des courriels décodés.
+
+Chaque stockage tient à jour, à chaque livraison, un index inversé des
+termes des courriels pour la recherche (voir glosearch).
+
+Les noms d'utilisateur ne sont pas sensibles à la casse.
+"""
+import abc
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional, TypedDict
+
+import glolog
+import glomailbox
+import glosearch
+import gloutils
+
+SQLITE_TIMEOUT = 30.0
+COMPACTION_INTERVAL = 600.0
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Dossiers du serveur rangés avec ceux des utilisateurs.
+_RESERVED_DIRS = frozenset(name.upper() for name in (gloutils.SERVER_LOST_DIR, gloutils.SERVER_SPOOL_DIR))
+
+
+class StorageError(Exception):
+    """Erreur levée par les opérations de stockage."""
+
+
+class UserExistsError(StorageError):
+    """Erreur levée à la création d'un compte qui existe déjà."""
+
+
+class UnknownUserError(StorageError):
+    """Erreur levée pour un compte qui n'existe pas."""
+
+
+class QuotaExceededError(StorageError):
+    """Erreur levée quand une livraison dépasserait le quota."""
+
+
+class EmailSummary(TypedDict, total=True):
+    """Informations d'un courriel affichées dans la liste."""
+    sender: str
+    subject: str
+    date: str
+    size: int
+
+
+class MailStorage(abc.ABC):
+    """
+    Interface des stockages de comptes et de courriels. Un stockage qui
+    n'implémente pas toutes les méthodes abstraites ne peut être créé.
+    """
+    name = ""
+
+    @abc.abstractmethod
+    def users(self) -> list[str]:
+        """Retourne les noms (en majuscules) des comptes existants."""
+
+    @abc.abstractmethod
+    def user_exists(self, username: str) -> bool:
+        """Indique si le compte existe."""
+
+    @abc.abstractmethod
+    def create_user(self, username: str, hashed_password: str,
+                    quota: Optional[int] = None) -> None:
+        """
+        Crée le compte avec le hachage de son mot de passe et le quota
+        de sa boîte, None pour une taille illimitée.
+
+        Lève une exception UserExistsError si le compte existe déjà.
+        """
+
+    @abc.abstractmethod
+    def get_password(self, username: str) -> Optional[str]:
+        """Retourne le hachage du mot de passe, ou None si le compte n'existe pas."""
+
+    @abc.abstractmethod
+    def set_password(self, username: str, hashed_password: str) -> None:
+        """Remplace le hachage du mot de passe."""
+
+    @abc.abstractmethod
+    def get_quota(self, username: str) -> Optional[int]:
+        """Retourne le quota de la boîte, None si illimité."""
+
+    @abc.abstractmethod
+    def set_quota(self, username: str, quota: Optional[int]) -> None:
+        """Modifie le quota de la boîte."""
+
+    @abc.abstractmethod
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> None:
+        """
+        Ajoute le courriel à la boîte de l'utilisateur. Les courriels
+        sont triés selon `timestamp`, l'instant de livraison en secondes
+        depuis l'époque, l'instant présent par défaut.
+
+        Lève une exception UnknownUserError si le compte n'existe pas et
+        QuotaExceededError si le courriel ferait dépasser le quota.
+        """
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     timestamp: Optional[float] = None) -> dict[str, Optional[StorageError]]:
+        """
+        Ajoute le courriel à la boîte de chacun des utilisateurs, avec le
+        même instant de livraison, et retourne pour chacun None ou
+        l'exception qui a empêché la livraison.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        results = {}
+        for username in usernames:
+            try:
+                self.deliver(username, payload, timestamp)
+                results[username] = None
+            except StorageError as ex:
+                results[username] = ex
+        return results
+
+    @abc.abstractmethod
+    def list_emails(self, username: str, offset: int = 0, limit: Optional[int] = None
+                    ) -> tuple[list[EmailSummary], int]:
+        """
+        Retourne au plus `limit` courriels à partir du rang `offset`
+        (à partir de 0, du plus récent au plus ancien) et le nombre
+        total de courriels.
+        """
+
+    @abc.abstractmethod
+    def fetch(self, username: str, number: int) -> Optional[gloutils.EmailContentPayload]:
+        """
+        Retourne le courriel affiché au rang `number` (à partir de 1, du
+        plus récent au plus ancien) ou None s'il n'existe pas.
+        """
+
+    @abc.abstractmethod
+    def search(self, username: str, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, EmailSummary]], int]:
+        """
+        Retourne au plus `limit` courriels contenant tous les termes de
+        `query`, du plus pertinent au moins pertinent, avec leur rang
+        d'affichage (comme pour `fetch`), et le nombre total de courriels
+        trouvés.
+        """
+
+    @abc.abstractmethod
+    def stats(self, username: str) -> tuple[int, int]:
+        """Retourne le nombre de courriels et leur taille totale en octets."""
+
+    @abc.abstractmethod
+    def iter_emails(self, username: str) -> Iterator[tuple[float, gloutils.EmailContentPayload]]:
+        """
+        Parcourt les courriels du plus ancien au plus récent, avec leur
+        instant de livraison.
+        """
+
+    def close(self) -> None:
+        """Libère les ressources du stockage."""
+
+
+class FileSystemStorage(MailStorage):
+    """Stockage d'un dossier par utilisateur, un fichier par courriel."""
+    name = "fs"
+    _mailbox_class = glomailbox.MailboxIndex
+
+    def __init__(self, data_dir: str = gloutils.SERVER_DATA_DIR) -> None:
+        """Utilise les dossiers utilisateurs de `data_dir`."""
+        self._data_dir = data_dir
+        self._mailboxes: dict[str, glomailbox.MailboxIndex] = {}
+        self._mailboxes_lock = threading.Lock()
+
+    def users(self) -> list[str]:
+        return sorted(name for name in os.listdir(self._data_dir)
+                      if os.path.exists(self._password_path(name)))
+
+    def user_exists(self, username: str) -> bool:
+        # Seul un dossier avec un mot de passe est un compte, pas SPOOL ou LOST.
+        return os.path.exists(self._password_path(username))
+
+    def create_user(self, username: str, hashed_password: str,
+                    quota: Optional[int] = None) -> None:
+        if username.upper() in _RESERVED_DIRS:
+            raise UserExistsError(username)
+        try:
+            os.makedirs(self._user_dir(username))
+        except FileExistsError as ex:
+            raise UserExistsError(username) from ex
+        self.set_password(username, hashed_password)
+        if quota is not None:
+            self.set_quota(username, quota)
+
+    def get_password(self, username: str) -> Optional[str]:
+        try:
+            with open(self._password_path(username), "r") as password_file:
+                return password_file.read()
+        except FileNotFoundError:
+            return None
+
+    def set_password(self, username: str, hashed_password: str) -> None:
+        gloutils.save_file(self._password_path(username), hashed_password)
+
+    def get_quota(self, username: str) -> Optional[int]:
+        return self._get_mailbox(username).quota
+
+    def set_quota(self, username: str, quota: Optional[int]) -> None:
+        self._get_mailbox(username).set_quota(quota)
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> None:
+        if not self.user_exists(username):
+            raise UnknownUserError(username)
+        try:
+            self._get_mailbox(username).deliver(payload, timestamp)
+        except glomailbox.QuotaExceededError as ex:
+            raise QuotaExceededError(str(ex)) from ex
+
+    def list_emails(self, username: str, offset: int = 0, limit: Optional[int] = None
+                    ) -> tuple[list[EmailSummary], int]:
+        mailbox = self._get_mailbox(username)
+        summaries = [EmailSummary(sender=entry["sender"], subject=entry["subject"],
+                                  date=entry["date"], size=entry["size"])
+                     for entry in mailbox.page(offset, limit)]
+        return summaries, len(mailbox)
+
+    def fetch(self, username: str, number: int) -> Optional[gloutils.EmailContentPayload]:
+        mailbox = self._get_mailbox(username)
+        entry = mailbox.get(number)
+        if entry is None:
+            return None
+        return _email_payload(mailbox.read(entry))
+
+    def search(self, username: str, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, EmailSummary]], int]:
+        results, total = self._get_mailbox(username).search(query, limit)
+        return [(number, EmailSummary(sender=entry["sender"], subject=entry["subject"],
+                                      date=entry["date"], size=entry["size"]))
+                for number, entry in results], total
+
+    def stats(self, username: str) -> tuple[int, int]:
+        mailbox = self._get_mailbox(username)
+        return mailbox.count, mailbox.size
+
+    def iter_emails(self, username: str) -> Iterator[tuple[float, gloutils.EmailContentPayload]]:
+        mailbox = self._get_mailbox(username)
+        for entry in reversed(mailbox.entries()):
+            yield entry["timestamp"], _email_payload(mailbox.read(entry))
+
+    def _get_mailbox(self, username: str):
+        """
+        Retourne l'index de la boîte de l'utilisateur, chargé une seule
+        fois puis mis à jour avec les entrées ajoutées depuis.
+        """
+        key = username.upper()
+        with self._mailboxes_lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                mailbox = self._mailbox_class(os.path.join(self._data_dir, key))
+                self._mailboxes[key] = mailbox
+                return mailbox
+        mailbox.refresh()
+        return mailbox
+
+    def _user_dir(self, username: str) -> str:
+        return os.path.join(self._data_dir, username.upper())
+
+    def _password_path(self, username: str) -> str:
+        return os.path.join(self._user_dir(username), gloutils.PASSWORD_FILENAME)
+
+
+class LogStorage(FileSystemStorage):
+    """
+    Stockage d'un dossier par utilisateur, les courriels étant ajoutés
+    à un fichier segment.
+
+    Si une durée de rétention est donnée, un fil compacte régulièrement
+    les segments pour retirer les courriels expirés.
+    """
+    name = "log"
+    _mailbox_class = glolog.LogMailbox
+
+    def __init__(self, data_dir: str = gloutils.SERVER_DATA_DIR,
+                 retention: Optional[float] = None) -> None:
+        """
+        Utilise les dossiers utilisateurs de `data_dir`. Les courriels
+        sont conservés `retention` secondes, indéfiniment si None.
+        """
+        super().__init__(data_dir)
+        self._retention = retention
+        self._stopping = threading.Event()
+        self._compactor = None
+        if retention is not None:
+            self._compactor = threading.Thread(target=self._run_compaction, daemon=True)
+            self._compactor.start()
+
+    def compact(self) -> int:
+        """Compacte toutes les boîtes et retourne le nombre de courriels retirés."""
+        return sum(self._get_mailbox(username).compact(self._retention)
+                   for username in self.users())
+
+    def close(self) -> None:
+        self._stopping.set()
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._mailboxes_lock:
+            for mailbox in self._mailboxes.values():
+                mailbox.close()
+
+    def _run_compaction(self) -> None:
+        while not self._stopping.wait(COMPACTION_INTERVAL):
+            try:
+                self.compact()
+            except (OSError, ValueError) as ex:
+                print(f"compaction failed: {ex}")
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    quota INTEGER,
+    count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS emails (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL REFERENCES users(name),
+    timestamp REAL NOT NULL,
+    sender TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date TEXT NOT NULL,
+    content TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS emails_user_date ON emails (user, timestamp, id);
+CREATE TABLE IF NOT EXISTS terms (
+    user TEXT NOT NULL,
+    term TEXT NOT NULL,
+    email INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (user, term, email)
+) WITHOUT ROWID;
+"""
+# Version 1: les courriels sont numérotés par `seq` (rang du plus ancien au
+# plus récent dans la boîte) et leurs termes sont indexés dans `terms`.
+_SQLITE_SCHEMA_VERSION = 1
+
+_EMAIL_FIELDS = ("sender", "destination", "subject", "date", "content")
+_EMAIL_COLUMNS = ", ".join(_EMAIL_FIELDS)
+
+
+class SQLiteStorage(MailStorage):
+    """
+    Stockage dans une base SQLite partagée par les fils et les processus.
+
+    Chaque fil utilise sa propre connexion. Le mode WAL permet de lire
+    pendant une livraison; les livraisons sont sérialisées par SQLite.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str) -> None:
+        """Ouvre la base `path`, créée au besoin."""
+        self._path = path
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SQLITE_SCHEMA)
+        self._upgrade_schema()
+
+    def users(self) -> list[str]:
+        rows = self._connection().execute("SELECT name FROM users ORDER BY name")
+        return [name for name, in rows]
+
+    def user_exists(self, username: str) -> bool:
+        return self.get_password(username) is not None
+
+    def create_user(self, username: str, hashed_password: str,
+                    quota: Optional[int] = None) -> None:
+        try:
+            self._connection().execute(
+                "INSERT INTO users (name, password, quota) VALUES (?, ?, ?)",
+                (username.upper(), hashed_password, quota))
+        except sqlite3.IntegrityError as ex:
+            raise UserExistsError(username) from ex
+
+    def get_password(self, username: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT password FROM users WHERE name = ?", (username.upper(),)).fetchone()
+        return None if row is None else row[0]
+
+    def set_password(self, username: str, hashed_password: str) -> None:
+        self._connection().execute(
+            "UPDATE users SET password = ? WHERE name = ?", (hashed_password, username.upper()))
+
+    def get_quota(self, username: str) -> Optional[int]:
+        row = self._connection().execute(
+            "SELECT quota FROM users WHERE name = ?", (username.upper(),)).fetchone()
+        return None if row is None else row[0]
+
+    def set_quota(self, username: str, quota: Optional[int]) -> None:
+        self._connection().execute(
+            "UPDATE users SET quota = ? WHERE name = ?", (quota, username.upper()))
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> None:
+        error = self.deliver_many([username], payload, timestamp)[username]
+        if error is not None:
+            raise error
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     timestamp: Optional[float] = None) -> dict[str, Optional[StorageError]]:
+        # Toutes les copies sont ajoutées dans une seule transaction.
+        size = len(json.dumps(payload).encode("utf-8"))
+        terms = glosearch.document_terms(payload)
+        timestamp = time.time() if timestamp is None else timestamp
+        results = {}
+        connection = self._connection()
+        # BEGIN IMMEDIATE réserve l'écriture avant de vérifier les quotas.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for username in usernames:
+                key = username.upper()
+                row = connection.execute(
+                    "SELECT quota, size, count FROM users WHERE name = ?", (key,)).fetchone()
+                if row is None:
+                    results[username] = UnknownUserError(username)
+                    continue
+                quota, used, count = row
+                if quota is not None and used + size > quota:
+                    results[username] = QuotaExceededError(f"{used + size} > {quota}")
+                    continue
+
+                seq = count + 1
+                newest, = connection.execute(
+                    "SELECT MAX(timestamp) FROM emails WHERE user = ?", (key,)).fetchone()
+                if newest is not None and timestamp < newest:
+                    # Courriel plus ancien que le plus récent: les suivants reculent d'un rang.
+                    seq -= connection.execute(
+                        "UPDATE emails SET seq = seq + 1 WHERE user = ? AND timestamp > ?",
+                        (key, timestamp)).rowcount
+                cursor = connection.execute(
+                    f"INSERT INTO emails (user, timestamp, size, seq, {_EMAIL_COLUMNS})"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, timestamp, size, seq, payload["sender"], payload["destination"],
+                     payload["subject"], payload["date"], payload["content"]))
+                connection.executemany(
+                    "INSERT INTO terms (user, term, email, weight) VALUES (?, ?, ?, ?)",
+                    [(key, term, cursor.lastrowid, weight) for term, weight in terms.items()])
+                connection.execute(
+                    "UPDATE users SET count = count + 1, size = size + ? WHERE name = ?", (size, key))
+                results[username] = None
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return results
+
+    def list_emails(self, username: str, offset: int = 0, limit: Optional[int] = None
+                    ) -> tuple[list[EmailSummary], int]:
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT sender, subject, date, size FROM emails WHERE user = ?"
+            " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (username.upper(), -1 if limit is None else limit, offset))
+        summaries = [EmailSummary(sender=sender, subject=subject, date=date, size=size)
+                     for sender, subject, date, size in rows]
+        count, _ = self.stats(username)
+        return summaries, count
+
+    def fetch(self, username: str, number: int) -> Optional[gloutils.EmailContentPayload]:
+        if number < 1:
+            return None
+        row = self._connection().execute(
+            f"SELECT {_EMAIL_COLUMNS} FROM emails WHERE user = ?"
+            " ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?",
+            (username.upper(), number - 1)).fetchone()
+        return None if row is None else _email_payload(dict(zip(_EMAIL_FIELDS, row)))
+
+    def search(self, username: str, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, EmailSummary]], int]:
+        key = username.upper()
+        connection = self._connection()
+        # Une seule transaction de lecture: les rangs et le total viennent du même état.
+        connection.execute("BEGIN")
+        try:
+            postings = []
+            for term in glosearch.query_terms(query):
+                rows = connection.execute(
+                    "SELECT email, weight FROM terms WHERE user = ? AND term = ? ORDER BY email",
+                    (key, term)).fetchall()
+                postings.append(([email for email, _ in rows], [weight for _, weight in rows]))
+            count, _ = self.stats(username)
+            email_ids, total = glosearch.rank(postings, count, limit)
+
+            rows = connection.execute(
+                "SELECT id, seq, sender, subject, date, size FROM emails"
+                f" WHERE id IN ({', '.join('?' * len(email_ids))})", email_ids)
+            summaries = {email_id: (seq, EmailSummary(sender=sender, subject=subject, date=date, size=size))
+                         for email_id, seq, sender, subject, date, size in rows}
+        finally:
+            connection.execute("COMMIT")
+        results = []
+        for email_id in email_ids:
+            if email_id in summaries:
+                seq, summary = summaries[email_id]
+                results.append((count - seq + 1, summary))
+        return results, total
+
+    def stats(self, username: str) -> tuple[int, int]:
+        row = self._connection().execute(
+            "SELECT count, size FROM users WHERE name = ?", (username.upper(),)).fetchone()
+        return (0, 0) if row is None else row
+
+    def iter_emails(self, username: str) -> Iterator[tuple[float, gloutils.EmailContentPayload]]:
+        rows = self._connection().execute(
+            f"SELECT timestamp, {_EMAIL_COLUMNS} FROM emails WHERE user = ? ORDER BY timestamp, id",
+            (username.upper(),))
+        for timestamp, *columns in rows:
+            yield timestamp, _email_payload(dict(zip(_EMAIL_FIELDS, columns)))
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def _upgrade_schema(self) -> None:
+        """
+        Met à jour une base créée avant la version _SQLITE_SCHEMA_VERSION:
+        numérote les courriels existants et indexe leurs termes.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version, = connection.execute("PRAGMA user_version").fetchone()
+            if version < _SQLITE_SCHEMA_VERSION:
+                columns = [column for _, column, *_ in connection.execute("PRAGMA table_info(emails)")]
+                if "seq" not in columns:
+                    connection.execute("ALTER TABLE emails ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+                rows = connection.execute(
+                    f"SELECT id, user, {_EMAIL_COLUMNS} FROM emails ORDER BY user, timestamp, id").fetchall()
+                seq, previous_user = 0, None
+                for email_id, user, *columns in rows:
+                    seq = seq + 1 if user == previous_user else 1
+                    previous_user = user
+                    connection.execute("UPDATE emails SET seq = ? WHERE id = ?", (seq, email_id))
+                    terms = glosearch.document_terms(dict(zip(_EMAIL_FIELDS, columns)))
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO terms (user, term, email, weight) VALUES (?, ?, ?, ?)",
+                        [(user, term, email_id, weight) for term, weight in terms.items()])
+                connection.execute(f"PRAGMA user_version = {_SQLITE_SCHEMA_VERSION}")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Retourne la connexion du fil courant, ouverte au besoin."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # isolation_level=None: chaque requête est validée seule, sauf
+            # dans une transaction ouverte explicitement.
+            connection = sqlite3.connect(self._path, timeout=SQLITE_TIMEOUT,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+
+class CachedStorage(MailStorage):
+    """
+    Stockage gardant en mémoire les listes et les courriels décodés
+    d'un autre stockage, dans la limite d'un budget en octets.
+
+    Les entrées les moins récemment utilisées sont retirées d'abord.
+    Une livraison par ce serveur retire les entrées du destinataire.
+    Les entrées sont aussi associées au nombre et à la taille des
+    courriels de la boîte, pour ne jamais servir une entrée antérieure
+    à une livraison d'un autre processus.
+
+    Les valeurs retournées sont partagées et ne doivent pas être modifiées.
+    """
+
+    def __init__(self, storage: MailStorage, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        """Garde au plus environ `max_bytes` octets de courriels de `storage`."""
+        self.name = storage.name
+        self._storage = storage
+        self._max_bytes = max_bytes
+        self._entries: collections.OrderedDict[tuple, tuple[object, int]] = collections.OrderedDict()
+        self._user_keys: dict[str, set[tuple]] = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def counters(self) -> dict[str, int]:
+        """Retourne les compteurs d'utilisation du cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.size}
+
+    def invalidate(self, username: str) -> None:
+        """Retire les entrées de l'utilisateur."""
+        with self._lock:
+            for key in self._user_keys.pop(username.upper(), ()):
+                _, size = self._entries.pop(key)
+                self.size -= size
+
+    def users(self) -> list[str]:
+        return self._storage.users()
+
+    def user_exists(self, username: str) -> bool:
+        return self._storage.user_exists(username)
+
+    def create_user(self, username: str, hashed_password: str,
+                    quota: Optional[int] = None) -> None:
+        self._storage.create_user(username, hashed_password, quota)
+
+    def get_password(self, username: str) -> Optional[str]:
+        return self._storage.get_password(username)
+
+    def set_password(self, username: str, hashed_password: str) -> None:
+        self._storage.set_password(username, hashed_password)
+
+    def get_quota(self, username: str) -> Optional[int]:
+        return self._storage.get_quota(username)
+
+    def set_quota(self, username: str, quota: Optional[int]) -> None:
+        self._storage.set_quota(username, quota)
+
+    def deliver(self, username: str, payload: gloutils.EmailContentPayload,
+                timestamp: Optional[float] = None) -> None:
+        try:
+            self._storage.deliver(username, payload, timestamp)
+        finally:
+            self.invalidate(username)
+
+    def deliver_many(self, usernames: list[str], payload: gloutils.EmailContentPayload,
+                     timestamp: Optional[float] = None) -> dict[str, Optional[StorageError]]:
+        try:
+            return self._storage.deliver_many(usernames, payload, timestamp)
+        finally:
+            for username in usernames:
+                self.invalidate(username)
+
+    def list_emails(self, username: str, offset: int = 0, limit: Optional[int] = None
+                    ) -> tuple[list[EmailSummary], int]:
+        key = (username.upper(), self._storage.stats(username), "list", offset, limit)
+        return self._cached(key, lambda: self._storage.list_emails(username, offset, limit))
+
+    def fetch(self, username: str, number: int) -> Optional[gloutils.EmailContentPayload]:
+        key = (username.upper(), self._storage.stats(username), "email", number)
+        return self._cached(key, lambda: self._storage.fetch(username, number))
+
+    def search(self, username: str, query: str, limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, EmailSummary]], int]:
+        return self._storage.search(username, query, limit)
+
+    def stats(self, username: str) -> tuple[int, int]:
+        return self._storage.stats(username)
+
+    def iter_emails(self, username: str) -> Iterator[tuple[float, gloutils.EmailContentPayload]]:
+        return self._storage.iter_emails(username)
+
+    def close(self) -> None:
+        self._storage.close()
+
+    def _cached(self, key: tuple, load):
+        """Retourne la valeur de `key`, chargée par `load` au besoin."""
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        value = load()
+        size = _size_of(value)
+        if size > self._max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self._user_keys.setdefault(key[0], set()).add(key)
+                self.size += size
+            while self.size > self._max_bytes:
+                old_key, (_, old_size) = self._entries.popitem(last=False)
+                user_keys = self._user_keys[old_key[0]]
+                user_keys.discard(old_key)
+                if not user_keys:
+                    del self._user_keys[old_key[0]]
+                self.size -= old_size
+                self.evictions += 1
+        return value
+
+
+STORAGES = {storage.name: storage for storage in (FileSystemStorage, LogStorage, SQLiteStorage)}
+
+
+def open_storage(name: str, data_dir: str = gloutils.SERVER_DATA_DIR,
+                 retention: Optional[float] = None) -> MailStorage:
+    """
+    Ouvre le stockage `name` ("fs", "log" ou "sqlite") dans le dossier
+    `data_dir`. `retention` est la durée de conservation des courriels
+    du stockage "log", en secondes.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    if name == SQLiteStorage.name:
+        return SQLiteStorage(os.path.join(data_dir, gloutils.SQLITE_FILENAME))
+    if name == LogStorage.name:
+        return LogStorage(data_dir, retention)
+    return FileSystemStorage(data_dir)
+
+
+def migrate(source: MailStorage, destination: MailStorage) -> int:
+    """
+    Copie les comptes et les courriels de `source` vers `destination`,
+    dans l'ordre de livraison, et retourne le nombre de comptes copiés
+    ou complétés.
+
+    Un compte qui existe déjà dans `destination` est considéré comme
+    une copie interrompue: seuls les courriels qui suivent ceux qu'il
+    contient déjà y sont copiés, ce qui permet de relancer la copie.
+    """
+    migrated = 0
+    for username in source.users():
+        password = source.get_password(username)
+        try:
+            destination.create_user(username, password)
+        except UserExistsError:
+            if destination.get_password(username) is None:
+                destination.set_password(username, password)
+        copied, _ = destination.stats(username)
+        quota = source.get_quota(username)
+        if copied >= source.stats(username)[0] and destination.get_quota(username) == quota:
+            continue
+        for index, (timestamp, payload) in enumerate(source.iter_emails(username)):
+            if index >= copied:
+                destination.deliver(username, payload, timestamp)
+        # Le quota est appliqué après la copie pour ne refuser aucun courriel existant.
+        if quota is not None:
+            destination.set_quota(username, quota)
+        migrated += 1
+    return migrated
+
+
+def _size_of(value) -> int:
+    """Estime la taille en octets d'une valeur décodée."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size_of(key) + _size_of(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_size_of(item) for item in value) + 8 * len(value)
+    return 8
+
+
+def _email_payload(email: dict) -> gloutils.EmailContentPayload:
+    """Retourne le courriel sans les champs propres au stockage."""
+    return gloutils.EmailContentPayload(
+        sender=email["sender"],
+        destination=email["destination"],
+        subject=email["subject"],
+        date=email["date"],
+        content=email["content"]
+    )
@@ -0,0 +1,135 @@
+"""\
+Module fournissant la transmission en morceaux des gros courriels.
+
+Si les deux côtés l'ont accepté avec l'entête HELLO, un message dont le
+contenu (`content` du payload) dépasse STREAM_THRESHOLD octets est
+transmis en deux temps:
+- le message lui-même, avec un contenu vide et la taille du contenu en
+    octets UTF-8 dans `stream_size` (StreamedContentPayload);
+- le contenu, en trames brutes d'au plus CHUNK_SIZE octets, sans
+    encodage, qui suivent immédiatement le message.
+
+Le récepteur écrit les morceaux dans un fichier temporaire au fur et à
+mesure de leur arrivée: aucune trame ne dépasse la taille maximale
+qu'il accepte et le contenu n'est jamais gardé en mémoire morceau par
+morceau.
+"""
+import codecs
+import tempfile
+from typing import IO, Optional
+
+import gloutils
+
+STREAM_THRESHOLD = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+MAX_CONTENT_SIZE = 64 * 1024 * 1024
+
+
+class StreamError(Exception):
+    """Erreur levée quand un contenu transmis en morceaux est invalide."""
+
+
+def is_streamed(message: gloutils.GloMessage) -> bool:
+    """Indique si le contenu du message suit en morceaux."""
+    payload = message.get("payload")
+    return isinstance(payload, dict) and "stream_size" in payload
+
+
+def split_message(message: gloutils.GloMessage, chunk_size: int = CHUNK_SIZE
+                  ) -> tuple[gloutils.GloMessage, list[memoryview]]:
+    """
+    Retourne le message à transmettre et les morceaux de son contenu,
+    ou le message tel quel et une liste vide si son contenu est petit.
+    """
+    payload = message.get("payload")
+    content = payload.get("content") if isinstance(payload, dict) else None
+    # Un caractère occupe au plus 4 octets en UTF-8.
+    if not isinstance(content, str) or len(content) * 4 < STREAM_THRESHOLD:
+        return message, []
+    data = content.encode("utf-8")
+    if len(data) < STREAM_THRESHOLD:
+        return message, []
+
+    head = gloutils.GloMessage(message)
+    head["payload"] = gloutils.StreamedContentPayload(payload, content="", stream_size=len(data))
+    view = memoryview(data)
+    return head, [view[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+
+class IncomingStream:
+    """Contenu d'un message reçu en morceaux, écrit dans un fichier temporaire."""
+
+    def __init__(self, message: gloutils.GloMessage,
+                 max_size: Optional[int] = MAX_CONTENT_SIZE) -> None:
+        """
+        Prépare la réception du contenu annoncé par `message`.
+
+        Un contenu de plus de `max_size` octets est refusé: ses morceaux
+        sont lus mais pas conservés et `rejected` en donne la raison.
+
+        Lève une exception StreamError si la taille annoncée est invalide.
+        """
+        size = message["payload"]["stream_size"]
+        if not isinstance(size, int) or size < 0:
+            raise StreamError(f"Invalid stream size {size!r}")
+        self.message = message
+        self.remaining = size
+        self.rejected: Optional[str] = None
+        self._file: Optional[IO[bytes]] = None
+        if max_size is not None and size > max_size:
+            self.rejected = f"le contenu dépasse la taille maximale de {max_size} octets"
+        else:
+            self._file = tempfile.TemporaryFile()
+
+    @property
+    def done(self) -> bool:
+        """Indique si tout le contenu a été reçu."""
+        return self.remaining == 0
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Écrit le morceau à la suite du contenu et indique si celui-ci
+        est complet.
+
+        Lève une exception StreamError si le morceau dépasse la taille
+        annoncée.
+        """
+        if len(chunk) > self.remaining:
+            raise StreamError("The received chunk exceeds the announced size")
+        self.remaining -= len(chunk)
+        if self._file is not None:
+            self._file.write(chunk)
+        return self.done
+
+    def complete(self) -> gloutils.GloMessage:
+        """
+        Retourne le message avec son contenu, relu du fichier, et ferme
+        le fichier.
+
+        Lève une exception StreamError si le contenu n'est pas de l'UTF-8.
+        """
+        self._file.seek(0)
+        try:
+            content = self._file.read().decode("utf-8")
+        except UnicodeDecodeError as ex:
+            raise StreamError("The received content is not valid UTF-8") from ex
+        finally:
+            self.close()
+        payload = dict(self.message["payload"], content=content)
+        del payload["stream_size"]
+        return gloutils.GloMessage(self.message, payload=payload)
+
+    def copy_to(self, output: IO[str], chunk_size: int = CHUNK_SIZE) -> None:
+        """Écrit le contenu reçu dans le flux texte `output`, morceau par morceau."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._file.seek(0)
+        while chunk := self._file.read(chunk_size):
+            output.write(decoder.decode(chunk))
+        output.write(decoder.decode(b"", final=True))
+
+    def close(self) -> None:
+        """Supprime le fichier temporaire."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
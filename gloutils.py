@@ -5,13 +5,21 @@ protocoles et gabarits à utiliser pour le TP4.
 import enum
 from typing import TypedDict, Union
 import datetime
+import os
+import threading
 
 APP_PORT = 5321
 SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
+SERVER_SPOOL_DIR = "SPOOL"
 SERVER_DOMAIN = "glo2000.ca"
 SMTP_SERVER = "smtp.ulaval.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INDEX_FILENAME = "index"
+STATS_FILENAME = "stats"
+SEARCH_INDEX_FILENAME = "search.index"
+SQLITE_FILENAME = "mail.sqlite3"
+LISTS_FILENAME = "lists.json"
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -21,9 +29,14 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Recherche de courriels
+5. Se déconnecter"""
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
+INBOX_PAGE_SIZE = 20
+INBOX_PAGE_DISPLAY = """Courriels {first} à {last} sur {total}
+(n: page suivante, p: page précédente)"""
+NEW_MAIL_DISPLAY = "Nouveau courriel de {sender} : {subject}"
 
 EMAIL_DISPLAY = """De : {sender}
 À : {to}
@@ -56,6 +69,18 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    HELLO = enum.auto()
+
+    DELIVERY_STATUS_REQUEST = enum.auto()
+
+    SUBSCRIBE = enum.auto()
+    NEW_MAIL = enum.auto()
+
+    SEARCH_REQUEST = enum.auto()
+
+    METRICS_REQUEST = enum.auto()
+    PROFILE_REQUEST = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -69,7 +94,12 @@ class AuthPayload(TypedDict, total=True):
 
 
 class EmailContentPayload(TypedDict, total=True):
-    """Payload pour les transferts de courriels."""
+    """
+    Payload pour les transferts de courriels.
+
+    `destination` peut contenir plusieurs adresses séparées par des
+    virgules, dont des listes de distribution du serveur.
+    """
     sender: str
     destination: str
     subject: str
@@ -77,9 +107,43 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class StreamedContentPayload(EmailContentPayload, total=False):
+    """
+    Payload d'un courriel dont le contenu suit le message en morceaux
+    (voir glostream): `content` est vide et `stream_size` est la taille
+    du contenu en octets.
+    """
+    stream_size: int
+
+
+class InboxRequestPayload(TypedDict, total=False):
+    """
+    Payload pour demander une page de la liste des courriels.
+
+    Sans payload, la liste complète est retournée.
+    """
+    offset: int
+    limit: int
+
+
 class EmailListPayload(TypedDict, total=True):
     """Payload pour les consulation de courriel."""
     email_list: list[str]
+    offset: int
+    total: int
+
+
+class SearchPayload(TypedDict, total=False):
+    """
+    Payload pour rechercher des courriels contenant tous les mots de
+    `query` dans l'expéditeur, le sujet ou le contenu.
+
+    Au plus `limit` résultats sont retournés, INBOX_PAGE_SIZE par défaut,
+    dans un EmailListPayload où le numéro de chaque courriel est celui
+    à utiliser avec INBOX_READING_CHOICE.
+    """
+    query: str
+    limit: int
 
 
 class EmailChoicePayload(TypedDict, total=True):
@@ -93,19 +157,158 @@ class StatsPayload(TypedDict, total=True):
     size: int
 
 
+class DeliveryStatusPayload(TypedDict, total=False):
+    """
+    Payload pour le suivi d'un courriel externe mis en file d'envoi.
+
+    La requête ne contient que `id`, retourné lors de l'envoi.
+    """
+    id: str
+    status: str
+    attempts: int
+    error: str
+
+
+class RecipientStatusPayload(TypedDict, total=False):
+    """
+    État de l'envoi à un destinataire: "delivered" (livré dans une boîte
+    du serveur), "queued" (mis en file d'envoi externe, `id` permettant
+    d'en suivre la livraison) ou "failed" (raison dans `error`).
+    """
+    address: str
+    status: str
+    error: str
+    id: str
+
+
+class SendingReportPayload(TypedDict, total=True):
+    """
+    Payload de la réponse à un envoi à plusieurs destinataires ou à une
+    liste de distribution: l'état de chaque destinataire, une fois les
+    listes remplacées par leurs membres.
+    """
+    recipients: list[RecipientStatusPayload]
+
+
+class HelloPayload(TypedDict, total=False):
+    """
+    Payload pour la négociation de l'encodage des messages.
+
+    Le client propose `encodings` par ordre de préférence et le serveur
+    répond avec l'encodage retenu dans `encoding`.
+
+    `compress` indique, dans la requête, que le client accepte les
+    messages compressés et, dans la réponse, que le serveur les accepte.
+
+    `stream` indique de même que les gros contenus peuvent être transmis
+    en morceaux. La réponse donne dans `max_frame_size` la taille
+    maximale d'une trame acceptée par le serveur.
+    """
+    encodings: list[str]
+    encoding: str
+    compress: bool
+    stream: bool
+    max_frame_size: int
+
+
+class SubscribePayload(TypedDict, total=False):
+    """
+    Payload pour l'abonnement aux avis de nouveaux courriels.
+
+    Sans payload ou avec `enabled` vrai, la session est abonnée;
+    avec `enabled` faux, elle est désabonnée.
+    """
+    enabled: bool
+
+
+class NewMailPayload(TypedDict, total=True):
+    """
+    Payload des avis NEW_MAIL envoyés sans requête aux sessions abonnées
+    lors de la livraison d'un courriel. Ces messages n'ont pas d'`id`.
+    """
+    sender: str
+    subject: str
+    date: str
+
+
+class HistogramPayload(TypedDict, total=True):
+    """
+    Histogramme de durées en secondes: `buckets[i]` compte les durées
+    d'au plus la i-ème borne de MetricsPayload (et plus grandes que la
+    précédente), la dernière classe celles qui dépassent toutes les
+    bornes. `p50`, `p95` et `p99` sont estimés à partir des classes.
+    """
+    count: int
+    sum: float
+    buckets: list[int]
+    p50: float
+    p95: float
+    p99: float
+
+
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload de la réponse à METRICS_REQUEST, réservée aux
+    administrateurs du serveur.
+
+    `requests`, `errors` et `latencies` sont indexés par le nom de
+    l'entête des requêtes; `phases` donne le temps passé dans le
+    stockage (`disk`) et avec le serveur SMTP (`smtp`).
+    """
+    uptime: float
+    buckets: list[float]
+    requests: dict[str, int]
+    errors: dict[str, int]
+    latencies: dict[str, HistogramPayload]
+    phases: dict[str, HistogramPayload]
+    bytes_received: int
+    bytes_sent: int
+    connections: int
+    active_connections: int
+    gauges: dict[str, float]
+
+
+class ProfilePayload(TypedDict, total=False):
+    """
+    Payload de PROFILE_REQUEST, réservée aux administrateurs: profile le
+    serveur pendant `seconds` secondes. La réponse, immédiate, donne le
+    chemin `path` du fichier pstats écrit sur le serveur à la fin.
+    """
+    seconds: float
+    path: str
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    `id` est un identifiant optionnel de requête, recopié par le serveur
+    dans la réponse pour permettre d'envoyer plusieurs requêtes à la suite.
     """
+    id: int
     header: Headers
-    payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+    payload: Union[ErrorPayload, AuthPayload, EmailContentPayload, StreamedContentPayload,
+                   InboxRequestPayload, SearchPayload, EmailListPayload,
+                   EmailChoicePayload, StatsPayload, HelloPayload,
+                   DeliveryStatusPayload, SubscribePayload, NewMailPayload,
+                   SendingReportPayload, MetricsPayload, ProfilePayload]
 
 
 def get_current_utc_time() -> str:
     """Récupère l'heure courante au fuseau UTC et la formatte en string."""
     current_time = datetime.datetime.now(datetime.timezone.utc)
     return current_time.strftime("%a, %d %b %Y %H:%M:%S %z")
+
+
+def save_file(path: str, data: str) -> None:
+    """
+    Écrit le fichier dans un fichier temporaire puis le renomme, pour
+    qu'un autre processus ne lise jamais un fichier à moitié écrit.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,57 @@
+"""\
+Copie les comptes et les courriels d'un stockage du serveur vers un autre.
+
+Par défaut, copie les dossiers utilisateurs de glo_server_data (stockage
+"fs") vers la base SQLite du même dossier. Le serveur doit être arrêté
+pendant la copie. Une copie interrompue peut être relancée: les
+comptes déjà présents dans la destination sont complétés avec les
+courriels qui leur manquent.
+
+Les stockages "fs" et "log" partagent les dossiers utilisateurs: une
+copie de l'un vers l'autre doit utiliser deux dossiers différents.
+
+Usage: python migrate_storage.py [--from fs] [--to sqlite] [-d DOSSIER] [-o DOSSIER]
+"""
+import argparse
+import os
+import sys
+
+import glostorage
+import gloutils
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from", action="store", dest="source",
+                        choices=list(glostorage.STORAGES), default="fs",
+                        help="Stockage à copier.")
+    parser.add_argument("--to", action="store", dest="destination",
+                        choices=list(glostorage.STORAGES), default="sqlite",
+                        help="Stockage de destination.")
+    parser.add_argument("-d", "--data-dir", action="store", dest="data_dir",
+                        default=gloutils.SERVER_DATA_DIR,
+                        help="Dossier des données du serveur.")
+    parser.add_argument("-o", "--output-dir", action="store", dest="output_dir",
+                        default=None,
+                        help="Dossier de la destination, le dossier des données par défaut.")
+    args = parser.parse_args(sys.argv[1:])
+    output_dir = args.data_dir if args.output_dir is None else args.output_dir
+    same_dir = os.path.abspath(output_dir) == os.path.abspath(args.data_dir)
+    if same_dir and (args.source == args.destination
+                     or glostorage.SQLiteStorage.name not in (args.source, args.destination)):
+        print("La source et la destination doivent utiliser des stockages ou des dossiers différents.")
+        return -1
+
+    source = glostorage.open_storage(args.source, args.data_dir)
+    destination = glostorage.open_storage(args.destination, output_dir)
+    try:
+        migrated = glostorage.migrate(source, destination)
+    finally:
+        source.close()
+        destination.close()
+    print(f"{migrated} compte(s) copié(s) de {args.source} vers {args.destination}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,137 @@
+"""Outils communs aux tests qui lancent un serveur (du TP ou SMTP)."""
+import contextlib
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Iterator, Optional
+
+import gloutils
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 10.0
+
+
+class ServerProcess:
+    """Serveur lancé dans un sous-processus, dans un dossier temporaire."""
+
+    def __init__(self, work_dir: str, process: subprocess.Popen) -> None:
+        self.work_dir = work_dir
+        self.process = process
+
+    def output(self) -> str:
+        """Retourne ce que le serveur a écrit jusqu'ici."""
+        with open(os.path.join(self.work_dir, "server.log"), encoding="utf-8") as log_file:
+            return log_file.read()
+
+    def data_path(self, *parts: str) -> str:
+        return os.path.join(self.work_dir, gloutils.SERVER_DATA_DIR, *parts)
+
+
+@contextlib.contextmanager
+def running_server(*args: str, files: Optional[dict[str, str]] = None) -> Iterator[ServerProcess]:
+    """
+    Lance TP4_server.py avec `args` sur APP_PORT, attend qu'il accepte
+    les connexions, puis l'arrête à la sortie du bloc.
+
+    `files` associe des chemins, relatifs à SERVER_DATA_DIR, au contenu
+    à y écrire avant le lancement.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        for path, content in (files or {}).items():
+            path = os.path.join(work_dir, gloutils.SERVER_DATA_DIR, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as data_file:
+                data_file.write(content)
+        with open(os.path.join(work_dir, "server.log"), "w", encoding="utf-8") as log_file:
+            process = subprocess.Popen(
+                [sys.executable, "-u", os.path.join(ROOT_DIR, "TP4_server.py"), "--scrypt-n", "1024", *args],
+                cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            _wait_for_port(process)
+            yield ServerProcess(work_dir, process)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def _wait_for_port(process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class FakeSMTPServer:
+    """
+    Serveur SMTP minimal, dans un fil, qui garde les courriels reçus.
+
+    `replies` remplace la réponse à une commande (`"EHLO"`, `"RCPT"`...)
+    par une ligne comme `"554 go away"`.
+    """
+
+    def __init__(self, replies: Optional[dict[str, str]] = None) -> None:
+        self.replies = replies or {}
+        self.messages: list[str] = []
+        self.connections = 0
+        self._server = _ThreadingServer(("127.0.0.1", 0), _SMTPHandler)
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def __enter__(self) -> "FakeSMTPServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        owner = self.server.owner
+        owner.connections += 1
+        self._reply(owner.replies.get("CONNECT", "220 fake"))
+        data: Optional[list[str]] = None
+        for raw_line in self.rfile:
+            line = raw_line.decode("utf-8", "replace").rstrip("\r\n")
+            if data is not None:
+                if line == ".":
+                    owner.messages.append("\n".join(data))
+                    data = None
+                    self._reply(owner.replies.get("DATA_END", "250 ok"))
+                else:
+                    data.append(line)
+                continue
+            command = line.split(" ", 1)[0].split(":", 1)[0].upper()
+            reply = owner.replies.get(command)
+            if reply is None:
+                reply = {"DATA": "354 go ahead", "QUIT": "221 bye"}.get(command, "250 ok")
+            self._reply(reply)
+            if command == "DATA" and reply.startswith("354"):
+                data = []
+            elif command == "QUIT" or reply.startswith("421"):
+                return
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
@@ -0,0 +1,39 @@
+"""Tests du générateur de charge (bench_server)."""
+import asyncio
+import time
+import unittest
+
+import bench_server
+import gloclient
+import gloutils
+from tests.support import running_server
+
+
+class SessionTestCase(unittest.TestCase):
+    """Sessions des utilisateurs simulés."""
+
+    def test_push_is_not_a_response(self) -> None:
+        async def scenario() -> gloutils.GloMessage:
+            session = bench_server.Session(bench_server.Recorder(), "json", compress=False)
+            await session.connect("127.0.0.1")
+            try:
+                await session.request(gloutils.Headers.AUTH_REGISTER,
+                                      gloutils.AuthPayload(username="alice", password="Password123"))
+                await session.request(gloutils.Headers.SUBSCRIBE, gloutils.SubscribePayload(enabled=True))
+                with gloclient.MailClient("127.0.0.1", timeout=5) as bob:
+                    bob.register("bob", "Password123")
+                    bob.send(f"alice@{gloutils.SERVER_DOMAIN}", "Bonjour", "Contenu")
+                # L'avis NEW_MAIL, sans identifiant, précède la réponse.
+                time.sleep(0.2)
+                return await session.request(gloutils.Headers.STATS_REQUEST)
+            finally:
+                await session.close()
+
+        with running_server():
+            response = asyncio.run(scenario())
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        self.assertEqual(response["payload"]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests du hachage des mots de passe et du cache de vérification (gloauth)."""
+import hashlib
+import os
+import time
+import unittest
+
+import gloauth
+import gloclient
+import gloutils
+from tests.support import running_server
+
+# Coût réduit pour des tests rapides.
+N = 1024
+
+
+class PasswordHashTestCase(unittest.TestCase):
+    """Hachage scrypt salé et ancien format sha3_512."""
+
+    def test_hash_and_verify(self) -> None:
+        stored = gloauth.hash_password("Password123", n=N)
+        self.assertTrue(stored.startswith(f"scrypt${N}$"))
+        self.assertTrue(gloauth.verify_password("Password123", stored))
+        self.assertFalse(gloauth.verify_password("Password124", stored))
+
+    def test_salt_is_random(self) -> None:
+        self.assertNotEqual(gloauth.hash_password("Password123", n=N), gloauth.hash_password("Password123", n=N))
+
+    def test_legacy_hash(self) -> None:
+        legacy = hashlib.sha3_512(b"Password123").hexdigest()
+        self.assertTrue(gloauth.verify_password("Password123", legacy + "\n"))
+        self.assertFalse(gloauth.verify_password("Password124", legacy))
+        self.assertTrue(gloauth.needs_rehash(legacy, n=N))
+        self.assertTrue(gloauth.needs_rehash(gloauth.hash_password("Password123", n=N)))
+        self.assertFalse(gloauth.needs_rehash(gloauth.hash_password("Password123", n=N), n=N))
+
+    def test_malformed_hash_is_refused(self) -> None:
+        for stored in ("scrypt$", "scrypt$x$8$1$00$00", "scrypt$1024$8$1$zz$00"):
+            with self.subTest(stored=stored):
+                self.assertFalse(gloauth.verify_password("Password123", stored))
+
+
+class AuthenticatorTestCase(unittest.TestCase):
+    """Bassin de processus et cache des vérifications réussies."""
+
+    def make_authenticator(self, **kwargs) -> gloauth.Authenticator:
+        authenticator = gloauth.Authenticator(workers=1, n=N, **kwargs)
+        self.addCleanup(authenticator.shutdown)
+        return authenticator
+
+    def test_hash_and_verify_in_pool(self) -> None:
+        authenticator = self.make_authenticator()
+        stored = authenticator.hash("Password123").result(timeout=30)
+        self.assertTrue(authenticator.verify("Password123", stored).result(timeout=30))
+        self.assertFalse(authenticator.verify("Password124", stored).result(timeout=30))
+        self.assertFalse(authenticator.needs_rehash(stored))
+
+    def test_cache_matches_password(self) -> None:
+        authenticator = self.make_authenticator()
+        self.assertFalse(authenticator.is_cached("ALICE", "Password123"))
+        authenticator.remember("ALICE", "Password123")
+        self.assertTrue(authenticator.is_cached("ALICE", "Password123"))
+        self.assertFalse(authenticator.is_cached("ALICE", "Password124"))
+        self.assertFalse(authenticator.is_cached("BOB", "Password123"))
+
+    def test_cache_expires(self) -> None:
+        authenticator = self.make_authenticator(cache_ttl=0.05)
+        authenticator.remember("ALICE", "Password123")
+        time.sleep(0.1)
+        self.assertFalse(authenticator.is_cached("ALICE", "Password123"))
+
+    def test_cache_is_bounded(self) -> None:
+        authenticator = self.make_authenticator(cache_max_entries=2)
+        for username in ("ALICE", "BOB"):
+            authenticator.remember(username, "Password123")
+        # La dernière vérification d'ALICE la garde dans le cache.
+        self.assertTrue(authenticator.is_cached("ALICE", "Password123"))
+        authenticator.remember("CAROL", "Password123")
+        self.assertFalse(authenticator.is_cached("BOB", "Password123"))
+        self.assertTrue(authenticator.is_cached("ALICE", "Password123"))
+        self.assertTrue(authenticator.is_cached("CAROL", "Password123"))
+
+
+class LegacyLoginTestCase(unittest.TestCase):
+    """Un ancien hachage est remplacé à la connexion."""
+
+    def test_legacy_hash_is_replaced(self) -> None:
+        password_path = os.path.join("ALICE", gloutils.PASSWORD_FILENAME)
+        legacy = hashlib.sha3_512(b"Password123").hexdigest()
+        with running_server("-s", "fs", files={password_path: legacy}) as server:
+            with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+                client.login("alice", "Password123")
+            # Le nouveau hachage est enregistré après la réponse.
+            deadline = time.monotonic() + 5
+            while True:
+                with open(server.data_path(password_path)) as password_file:
+                    stored = password_file.read()
+                if stored != legacy or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            self.assertFalse(gloauth.needs_rehash(stored, n=N))
+            self.assertTrue(gloauth.verify_password("Password123", stored))
+            with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+                with self.assertRaises(gloclient.MailClientError):
+                    client.login("alice", "Password124")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+"""Tests de l'interface programmatique du serveur (gloclient)."""
+import asyncio
+import contextlib
+import threading
+import time
+import unittest
+
+import glocodec
+import gloclient
+import glosocket
+import gloutils
+from tests.support import running_server
+
+PASSWORD = "Password123"
+# Dépasse glostream.STREAM_THRESHOLD: le contenu est transmis en morceaux.
+LARGE_CONTENT = "é" * (200 * 1024)
+
+
+def _address(username: str) -> str:
+    return f"{username}@{gloutils.SERVER_DOMAIN}"
+
+
+class ClientTestCase(unittest.TestCase):
+    """Base des tests: un serveur partagé par les tests de la classe."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        stack = contextlib.ExitStack()
+        cls.addClassCleanup(stack.close)
+        cls.server = stack.enter_context(running_server())
+        cls._next_user = 0
+
+    def new_username(self) -> str:
+        type(self)._next_user += 1
+        return f"user{self._next_user}"
+
+
+class MailClientTestCase(ClientTestCase):
+    """Client synchrone."""
+
+    def test_operations(self) -> None:
+        for encoding in glocodec.CODECS:
+            for compress in (False, True):
+                with self.subTest(encoding=encoding, compress=compress), \
+                        gloclient.MailClient("127.0.0.1", encoding=encoding, compress=compress,
+                                             timeout=5) as client:
+                    username = self.new_username()
+                    client.register(username, PASSWORD)
+                    self.assertIsNone(client.send(_address(username), "Premier", "budget du mois"))
+                    client.send(_address(username), "Second", LARGE_CONTENT)
+                    inbox = client.list_inbox()
+                    self.assertEqual(inbox["total"], 2)
+                    self.assertEqual(len(client.list_inbox(offset=1, limit=5)["email_list"]), 1)
+                    self.assertEqual(client.fetch(1)["content"], LARGE_CONTENT)
+                    self.assertEqual(client.fetch(2)["subject"], "Premier")
+                    self.assertEqual(client.search("budget")["total"], 1)
+                    self.assertEqual(client.stats()["count"], 2)
+                    client.logout()
+                    with self.assertRaises(gloclient.MailClientError):
+                        client.stats()
+                    client.login(username, PASSWORD)
+                    self.assertEqual(client.stats()["count"], 2)
+
+    def test_errors(self) -> None:
+        with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            with self.assertRaises(gloclient.MailClientError):
+                client.login("personne", PASSWORD)
+            with self.assertRaises(gloclient.MailClientError):
+                client.register(self.new_username(), "court")
+            client.register(self.new_username(), PASSWORD)
+            with self.assertRaises(gloclient.MailClientError):
+                client.fetch(1)
+            # La connexion reste utilisable après une erreur.
+            self.assertEqual(client.stats()["count"], 0)
+
+    def test_pipeline_keeps_order(self) -> None:
+        with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            username = self.new_username()
+            client.register(username, PASSWORD)
+            responses = client.pipeline(
+                [(gloutils.Headers.EMAIL_SENDING, client._email_payload(_address(username), f"n{index}", "x"))
+                 for index in range(5)]
+                + [(gloutils.Headers.STATS_REQUEST, None), (gloutils.Headers.INBOX_READING_CHOICE,
+                                                            gloutils.EmailChoicePayload(choice=9))])
+            self.assertEqual([response["header"] for response in responses],
+                             [gloutils.Headers.OK] * 6 + [gloutils.Headers.ERROR])
+            self.assertEqual(responses[5]["payload"]["count"], 5)
+
+    def test_fetch_streamed(self) -> None:
+        with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            username = self.new_username()
+            client.register(username, PASSWORD)
+            client.send(_address(username), "Gros", LARGE_CONTENT)
+            payload, stream = client.fetch_streamed(1)
+            self.assertIsNotNone(stream)
+            self.addCleanup(stream.close)
+            self.assertEqual(payload["subject"], "Gros")
+            self.assertEqual(stream.complete()["payload"]["content"], LARGE_CONTENT)
+
+    def test_session_pool(self) -> None:
+        username = self.new_username()
+        with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            client.register(username, PASSWORD)
+        pool = gloclient.SessionPool("127.0.0.1", username, PASSWORD, size=2, timeout=5)
+        self.addCleanup(pool.close)
+        clients = set()
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def use_session() -> None:
+            with pool.session() as session:
+                with lock:
+                    clients.add(session)
+                    active.append(session)
+                    peak.append(len(active))
+                session.send(_address(username), "Bonjour", "x")
+                time.sleep(0.05)
+                with lock:
+                    active.remove(session)
+
+        threads = [threading.Thread(target=use_session) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(peak), 2)
+        self.assertLessEqual(len(clients), 2)
+        with pool.session() as session:
+            self.assertEqual(session.stats()["count"], 6)
+        pool.close()
+        with self.assertRaises(gloclient.MailClientError):
+            with pool.session():
+                pass
+
+
+class AsyncMailClientTestCase(ClientTestCase):
+    """Client asyncio, partagé par plusieurs tâches."""
+
+    def test_concurrent_requests(self) -> None:
+        async def scenario() -> None:
+            async with await gloclient.AsyncMailClient.connect("127.0.0.1") as client:
+                username = self.new_username()
+                await client.register(username, PASSWORD)
+                await asyncio.gather(*(client.send(_address(username), f"n{index}", "x" * index)
+                                       for index in range(20)))
+                await client.send(_address(username), "Gros", LARGE_CONTENT)
+                results = await asyncio.gather(client.stats(), client.fetch(1), client.search("n7"))
+                self.assertEqual(results[0]["count"], 21)
+                self.assertEqual(results[1]["content"], LARGE_CONTENT)
+                self.assertEqual(results[2]["total"], 1)
+                with self.assertRaises(gloclient.MailClientError):
+                    await client.fetch(100)
+
+        asyncio.run(scenario())
+
+    def test_notifications(self) -> None:
+        async def scenario() -> list:
+            notifications = []
+            received = asyncio.Event()
+
+            def on_new_mail(payload: gloutils.NewMailPayload) -> None:
+                notifications.append(payload)
+                received.set()
+
+            username = self.new_username()
+            async with await gloclient.AsyncMailClient.connect("127.0.0.1", on_new_mail=on_new_mail) as client:
+                await client.register(username, PASSWORD)
+                await client.subscribe()
+                await client.send(_address(username), "Pour moi", "x")
+                await asyncio.wait_for(received.wait(), 5)
+                self.assertEqual((await client.stats())["count"], 1)
+            return notifications
+
+        notifications = asyncio.run(scenario())
+        self.assertEqual([notification["subject"] for notification in notifications], ["Pour moi"])
+
+    def test_session_pool(self) -> None:
+        async def scenario() -> None:
+            username = self.new_username()
+            async with await gloclient.AsyncMailClient.connect("127.0.0.1") as client:
+                await client.register(username, PASSWORD)
+            pool = gloclient.AsyncSessionPool("127.0.0.1", username, PASSWORD, size=2)
+            clients = set()
+
+            async def use_session() -> None:
+                async with pool.session() as session:
+                    clients.add(session)
+                    await session.send(_address(username), "Bonjour", "x")
+
+            try:
+                await asyncio.gather(*(use_session() for _ in range(6)))
+                self.assertLessEqual(len(clients), 2)
+                async with pool.session() as session:
+                    self.assertEqual((await session.stats())["count"], 6)
+            finally:
+                await pool.close()
+
+        asyncio.run(scenario())
+
+
+class ClosedConnectionTestCase(unittest.TestCase):
+    """Une connexion fermée par le serveur fait échouer les requêtes."""
+
+    def test_pending_requests_fail(self) -> None:
+        async def scenario() -> None:
+            with running_server() as server:
+                client = await gloclient.AsyncMailClient.connect("127.0.0.1")
+                await client.register("alice", PASSWORD)
+                server.process.kill()
+                server.process.wait()
+                with self.assertRaises((glosocket.GLOSocketError, OSError)):
+                    await asyncio.wait_for(client.stats(), 5)
+                with self.assertRaises((glosocket.GLOSocketError, OSError)):
+                    await client.stats()
+                await client.close()
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
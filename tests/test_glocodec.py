@@ -0,0 +1,59 @@
+"""Tests des encodages des messages (glocodec)."""
+import unittest
+
+import glocodec
+import gloutils
+
+
+class CodecTestCase(unittest.TestCase):
+    """Aller-retour des messages par chaque encodage."""
+
+    MESSAGES = [
+        gloutils.GloMessage(header=gloutils.Headers.BYE),
+        gloutils.GloMessage(header=gloutils.Headers.OK, id=7),
+        gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST, id=2 ** 31,
+                            payload=gloutils.InboxRequestPayload(offset=0, limit=20)),
+        gloutils.GloMessage(header=gloutils.Headers.OK, payload={
+            "email_list": ["1 a@glo2000.ca sujet é", "2 b@glo2000.ca 🙂"],
+            "total": 2,
+            "nested": {"values": [1.5, -3, True, False, None, ""], "empty": {}},
+        }),
+    ]
+
+    def test_round_trip(self) -> None:
+        for codec in glocodec.CODECS.values():
+            for message in self.MESSAGES:
+                with self.subTest(codec=codec.name, message=message):
+                    self.assertEqual(codec.decode(codec.encode(message)), message)
+
+    def test_invalid_data_raises_codec_error(self) -> None:
+        for codec in glocodec.CODECS.values():
+            encoded = codec.encode(self.MESSAGES[-1])
+            for data in (b"", encoded[:len(encoded) // 2]):
+                with self.subTest(codec=codec.name, data=data[:8]):
+                    with self.assertRaises(glocodec.CodecError):
+                        codec.decode(data)
+
+    def test_binary_rejects_unhashable_keys(self) -> None:
+        # {[]: 1}: un dictionnaire d'une entrée dont la clé est une liste vide.
+        data = glocodec._MESSAGE_HEADER.pack(gloutils.Headers.OK, glocodec._HAS_PAYLOAD, 0) + b"\x81\x90\x01"
+        with self.assertRaises(glocodec.CodecError):
+            glocodec.BinaryCodec.decode(data)
+
+    def test_binary_limits_nesting(self) -> None:
+        header = glocodec._MESSAGE_HEADER.pack(gloutils.Headers.OK, glocodec._HAS_PAYLOAD, 0)
+        for depth in (glocodec.MAX_DEPTH + 1, 100000):
+            with self.subTest(depth=depth):
+                # Listes d'un élément imbriquées, terminées par None.
+                with self.assertRaises(glocodec.CodecError):
+                    glocodec.BinaryCodec.decode(header + b"\x91" * depth + b"\xc0")
+        payload = glocodec.BinaryCodec.decode(header + b"\x91" * (glocodec.MAX_DEPTH - 1) + b"\xc0")["payload"]
+        self.assertIsInstance(payload, list)
+
+    def test_negotiate(self) -> None:
+        self.assertIs(glocodec.negotiate(["binary", "json"]), glocodec.BinaryCodec)
+        self.assertIs(glocodec.negotiate(["unknown"]), glocodec.DEFAULT_CODEC)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests des listes de distribution (glolists)."""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import glolists
+
+
+class DistributionListsTestCase(unittest.TestCase):
+    """Lecture et développement des listes."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._path = os.path.join(tmp.name, "lists.json")
+        self._lists = glolists.DistributionLists(self._path)
+        self._mtime = 1000.0
+
+    def _write(self, content: str) -> None:
+        with open(self._path, "w", encoding="utf-8") as lists_file:
+            lists_file.write(content)
+        # Chaque version du fichier a sa propre date de modification.
+        self._mtime += 1
+        os.utime(self._path, (self._mtime, self._mtime))
+
+    def test_missing_file(self) -> None:
+        self.assertFalse(self._lists.is_list("equipe"))
+        self.assertEqual(self._lists.expand(["a@glo2000.ca"]), ["a@glo2000.ca"])
+
+    def test_expand_nested_lists(self) -> None:
+        self._write(json.dumps({
+            "equipe": ["alice@glo2000.ca", "dev@glo2000.ca", "bob@exemple.com"],
+            "dev": ["Carol@glo2000.ca", "ALICE@glo2000.ca", "equipe@glo2000.ca"],
+        }))
+        self.assertTrue(self._lists.is_list("Equipe"))
+        self.assertTrue(self._lists.is_list_address("EQUIPE@glo2000.ca"))
+        self.assertFalse(self._lists.is_list_address("equipe@exemple.com"))
+        # Les doublons et les cycles sont ignorés, dans l'ordre d'apparition.
+        self.assertEqual(self._lists.expand(["equipe@glo2000.ca", " bob@exemple.com"]),
+                         ["alice@glo2000.ca", "Carol@glo2000.ca", "bob@exemple.com"])
+
+    def test_file_is_reloaded(self) -> None:
+        self._write(json.dumps({"equipe": ["alice@glo2000.ca"]}))
+        self.assertEqual(self._lists.expand(["equipe@glo2000.ca"]), ["alice@glo2000.ca"])
+        self._write(json.dumps({"equipe": ["bob@glo2000.ca"]}))
+        self.assertEqual(self._lists.expand(["equipe@glo2000.ca"]), ["bob@glo2000.ca"])
+        os.remove(self._path)
+        self.assertEqual(self._lists.expand(["equipe@glo2000.ca"]), ["equipe@glo2000.ca"])
+
+    def test_invalid_file_keeps_previous_lists(self) -> None:
+        self._write(json.dumps({"equipe": ["alice@glo2000.ca"]}))
+        self.assertTrue(self._lists.is_list("equipe"))
+        for content in ("{", "[]", '{"equipe": "alice@glo2000.ca"}', '{"equipe": [1]}'):
+            with self.subTest(content=content), contextlib.redirect_stdout(io.StringIO()) as output:
+                self._write(content)
+                self.assertEqual(self._lists.expand(["equipe@glo2000.ca"]), ["alice@glo2000.ca"])
+                self.assertIn("invalid distribution lists", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Tests de la boîte de courriels en journal à ajout seul (glolog)."""
+import os
+import tempfile
+import time
+import unittest
+
+import glolog
+import gloutils
+
+
+def _email(index: int) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender=f"sender{index}@glo2000.ca",
+        destination="alice@glo2000.ca",
+        subject=f"courriel {index}",
+        date="Mon, 01 Jan 2024 00:00:00 +0000",
+        content=f"contenu numero{index}"
+    )
+
+
+_EMAILS = [_email(index) for index in range(5)]
+
+
+class LogMailboxTestCase(unittest.TestCase):
+    """Lecture, compactage et reprise d'une boîte en journal."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._dir_path = tmp.name
+        mailbox = glolog.LogMailbox(self._dir_path)
+        for index, payload in enumerate(_EMAILS):
+            mailbox.deliver(payload, timestamp=1000.0 + index)
+        mailbox.close()
+        self._segment_path = os.path.join(self._dir_path, glolog.SEGMENT_FILENAME)
+
+    def _open(self) -> glolog.LogMailbox:
+        mailbox = glolog.LogMailbox(self._dir_path)
+        self.addCleanup(mailbox.close)
+        return mailbox
+
+    def _read(self, mailbox: glolog.LogMailbox, number: int) -> gloutils.EmailContentPayload:
+        record = mailbox.read(mailbox.get(number))
+        del record["timestamp"]
+        return record
+
+    def _subjects(self, mailbox: glolog.LogMailbox) -> list[str]:
+        return [entry["subject"] for entry in mailbox.entries()]
+
+    def test_read_back(self) -> None:
+        mailbox = self._open()
+        self.assertEqual(len(mailbox), len(_EMAILS))
+        self.assertEqual(self._subjects(mailbox), [payload["subject"] for payload in reversed(_EMAILS)])
+        self.assertEqual(self._read(mailbox, 1), _EMAILS[-1])
+        self.assertIsNone(mailbox.get(len(_EMAILS) + 1))
+
+    def test_other_instance_sees_new_emails(self) -> None:
+        reader = self._open()
+        self._open().deliver(_email(5), timestamp=2000.0)
+        reader.refresh()
+        self.assertEqual(len(reader), len(_EMAILS) + 1)
+        self.assertEqual(self._read(reader, 1), _email(5))
+
+    def test_compact_removes_expired_emails(self) -> None:
+        mailbox = self._open()
+        mailbox.deliver(_email(5))
+        reader = self._open()
+        self.assertEqual(mailbox.compact(max_age=60.0), len(_EMAILS))
+        self.assertEqual(self._subjects(mailbox), [_email(5)["subject"]])
+        self.assertEqual(self._read(mailbox, 1), _email(5))
+        self.assertEqual([number for number, _ in mailbox.search("numero5")[0]], [1])
+        # Une autre instance relit l'index remplacé.
+        reader.refresh()
+        self.assertEqual(self._read(reader, 1), _email(5))
+        self.assertEqual(mailbox.compact(max_age=60.0), 0)
+
+    def test_truncated_last_email_is_dropped(self) -> None:
+        # L'index mentionne le dernier courriel, dont la ligne a été coupée.
+        with open(self._segment_path, "rb+") as segment_file:
+            segment_file.truncate(os.path.getsize(self._segment_path) - 10)
+        mailbox = self._open()
+        self.assertEqual(len(mailbox), len(_EMAILS) - 1)
+        self.assertEqual(self._read(mailbox, 1), _EMAILS[-2])
+
+        mailbox.deliver(_EMAILS[-1], timestamp=time.time())
+        self.assertEqual(len(mailbox), len(_EMAILS))
+        self.assertEqual(self._read(mailbox, 1), _EMAILS[-1])
+        self.assertEqual(len(self._open()), len(_EMAILS))
+
+    def test_partial_line_without_entry_is_removed(self) -> None:
+        # Une livraison interrompue avant l'écriture de son entrée d'index.
+        size = os.path.getsize(self._segment_path)
+        with open(self._segment_path, "ab") as segment_file:
+            segment_file.write(b'{"sender": "x@glo2000.ca", "subj')
+        mailbox = self._open()
+        self.assertEqual(len(mailbox), len(_EMAILS))
+        self.assertEqual(os.path.getsize(self._segment_path), size)
+        self.assertEqual(self._subjects(mailbox)[0], _EMAILS[-1]["subject"])
+
+    def test_email_without_entry_is_indexed(self) -> None:
+        # Une livraison interrompue entre le segment et l'index.
+        index_path = os.path.join(self._dir_path, glolog.SEGMENT_INDEX_FILENAME)
+        with open(index_path, "rb") as index_file:
+            lines = index_file.readlines()
+        with open(index_path, "wb") as index_file:
+            index_file.writelines(lines[:-1])
+        mailbox = self._open()
+        self.assertEqual(len(mailbox), len(_EMAILS))
+        self.assertEqual(self._read(mailbox, 1), _EMAILS[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
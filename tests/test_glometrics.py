@@ -0,0 +1,120 @@
+"""Tests des métriques de fonctionnement du serveur (glometrics)."""
+import os
+import tempfile
+import threading
+import unittest
+
+import gloclient
+import glometrics
+import gloutils
+from tests.support import running_server
+
+
+class HistogramTestCase(unittest.TestCase):
+    """Histogrammes à bornes fixes."""
+
+    def test_buckets_and_quantiles(self) -> None:
+        histogram = glometrics.Histogram(bounds=(1.0, 2.0, 4.0))
+        for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertAlmostEqual(histogram.sum, 16.5)
+        # Le rang 2.5 tombe au milieu des deux valeurs de la classe ]1, 2].
+        self.assertAlmostEqual(histogram.quantile(0.5), 1.75)
+        # Au-delà de la dernière borne, la borne est retournée.
+        self.assertEqual(histogram.quantile(0.99), 4.0)
+        self.assertEqual(glometrics.Histogram().quantile(0.5), 0.0)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Compteurs, phases et format Prometheus."""
+
+    def test_requests_and_errors(self) -> None:
+        metrics = glometrics.Metrics()
+        metrics.observe_request("STATS_REQUEST", 0.002, ok=True)
+        metrics.observe_request("STATS_REQUEST", 0.003, ok=False)
+        metrics.add_bytes(received=10, sent=20)
+        metrics.connection_opened()
+        metrics.connection_opened()
+        metrics.connection_closed()
+        metrics.add_gauge("users", lambda: 3)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["requests"], {"STATS_REQUEST": 2})
+        self.assertEqual(snapshot["errors"], {"STATS_REQUEST": 1})
+        self.assertEqual(snapshot["latencies"]["STATS_REQUEST"]["count"], 2)
+        self.assertEqual((snapshot["bytes_received"], snapshot["bytes_sent"]), (10, 20))
+        self.assertEqual((snapshot["connections"], snapshot["active_connections"]), (2, 1))
+        self.assertEqual(snapshot["gauges"], {"users": 3})
+
+    def test_phases_are_tracked_per_thread(self) -> None:
+        metrics = glometrics.Metrics()
+        other_phases = {}
+
+        def other_thread() -> None:
+            with metrics.tracking() as phases:
+                metrics.observe_phase("disk", 5.0)
+            other_phases.update(phases)
+
+        with metrics.tracking() as phases:
+            metrics.observe_phase("disk", 0.25)
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            with metrics.timed("smtp"):
+                pass
+        # Hors d'un bloc `tracking`, seul l'histogramme de la phase est mis à jour.
+        metrics.observe_phase("disk", 1.0)
+        self.assertEqual(phases["disk"], 0.25)
+        self.assertIn("smtp", phases)
+        self.assertEqual(other_phases, {"disk": 5.0})
+        self.assertEqual(metrics.snapshot()["phases"]["disk"]["count"], 3)
+
+    def test_timed_proxy(self) -> None:
+        metrics = glometrics.Metrics()
+        proxy = glometrics.TimedProxy([3, 1, 2], metrics, "disk", exclude=("copy",))
+        self.assertEqual(proxy.index(1), 1)
+        self.assertEqual(proxy.copy(), [3, 1, 2])
+        self.assertEqual(metrics.snapshot()["phases"]["disk"]["count"], 1)
+
+    def test_prometheus_export(self) -> None:
+        metrics = glometrics.Metrics()
+        metrics.observe_request("AUTH_LOGIN", 0.002, ok=True)
+        metrics.observe_request("AUTH_LOGIN", 20.0, ok=False)
+        metrics.add_gauge("users", lambda: 1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics.prom")
+            glometrics.MetricsExporter(metrics, path).export()
+            with open(path, encoding="utf-8") as metrics_file:
+                lines = metrics_file.read().splitlines()
+        self.assertIn('glo_requests_total{header="AUTH_LOGIN"} 2', lines)
+        self.assertIn('glo_request_errors_total{header="AUTH_LOGIN"} 1', lines)
+        self.assertIn('glo_request_duration_seconds_bucket{header="AUTH_LOGIN",le="0.0025"} 1', lines)
+        self.assertIn('glo_request_duration_seconds_bucket{header="AUTH_LOGIN",le="10.0"} 1', lines)
+        self.assertIn('glo_request_duration_seconds_bucket{header="AUTH_LOGIN",le="+Inf"} 2', lines)
+        self.assertIn("glo_users 1", lines)
+
+
+class MetricsRequestTestCase(unittest.TestCase):
+    """Requête METRICS_REQUEST, réservée aux administrateurs."""
+
+    def test_admin_only(self) -> None:
+        with running_server("--admin", "root") as server, \
+                gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            client.register("alice", "Password123")
+            with self.assertRaises(gloclient.MailClientError):
+                client.metrics()
+            client.logout()
+            client.register("root", "Password123")
+            client.stats()
+            metrics = client.metrics()
+            self.assertEqual(metrics["requests"]["STATS_REQUEST"], 1)
+            self.assertEqual(metrics["errors"]["METRICS_REQUEST"], 1)
+            self.assertGreaterEqual(metrics["connections"], 1)
+            self.assertEqual(metrics["gauges"]["logged_in_users"], 1)
+            self.assertIn("disk", metrics["phases"])
+            self.assertIsNone(server.process.poll())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests du journal des requêtes lentes et du profileur (gloprofile)."""
+import contextlib
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+import unittest
+
+import gloclient
+import gloprofile
+from tests.support import running_server
+
+WAIT_TIMEOUT = 10.0
+
+
+def _busy(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def _wait_for_file(path: str) -> None:
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+
+class SlowRequestLogTestCase(unittest.TestCase):
+    """Journal des requêtes qui dépassent le seuil."""
+
+    def test_threshold_and_phases(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "slow.log")
+            slow_log = gloprofile.SlowRequestLog(threshold=0.1, path=path)
+            slow_log.record("STATS_REQUEST", "alice", 10, 0.05, {})
+            slow_log.record("AUTH_LOGIN", "alice", 20, 0.5, {"disk": 0.2, "smtp": 0.1})
+            with open(path, encoding="utf-8") as log_file:
+                lines = log_file.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual((entry["header"], entry["user"], entry["size"], entry["ms"]),
+                         ("AUTH_LOGIN", "alice", 20, 500.0))
+        self.assertEqual(entry["phases_ms"], {"disk": 200.0, "smtp": 100.0, "other": 200.0})
+
+    def test_standard_output(self) -> None:
+        slow_log = gloprofile.SlowRequestLog(threshold=0.0)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            slow_log.record("STATS_REQUEST", None, 0, 0.01, {})
+        self.assertTrue(output.getvalue().startswith("slow request: "))
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    """Profils pstats écrits en arrière-plan."""
+
+    def test_writes_pstats_file(self) -> None:
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy, args=(stop,))
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stop.set)
+        profiler = gloprofile.SamplingProfiler(interval=0.001)
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            path = os.path.join(tmp_dir, "server.pstats")
+            profiler.start(0.2, path)
+            self.assertTrue(profiler.running)
+            with self.assertRaises(gloprofile.ProfileError):
+                profiler.start(0.2, path)
+            profiler._thread.join(WAIT_TIMEOUT)
+            self.assertFalse(profiler.running)
+            functions = {function[2] for function in pstats.Stats(path).stats}
+        self.assertIn("_busy", functions)
+        self.assertIn(f"profile written to {path}", output.getvalue())
+
+
+class ProfileRequestTestCase(unittest.TestCase):
+    """Requête PROFILE_REQUEST, réservée aux administrateurs."""
+
+    def test_admin_profile(self) -> None:
+        with tempfile.TemporaryDirectory() as profile_dir, \
+                running_server("--admin", "root", "--profile-dir", profile_dir), \
+                gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            client.register("alice", "Password123")
+            with self.assertRaises(gloclient.MailClientError):
+                client.profile(0.2)
+            client.logout()
+            client.register("root", "Password123")
+            for seconds in (0, gloprofile.MAX_PROFILE_SECONDS + 1):
+                with self.assertRaises(gloclient.MailClientError):
+                    client.profile(seconds)
+            path = client.profile(0.2)
+            self.assertEqual(os.path.dirname(path), profile_dir)
+            with self.assertRaises(gloclient.MailClientError):
+                client.profile(0.2)
+            _wait_for_file(path)
+            self.assertTrue(pstats.Stats(path).stats)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+"""Tests de la file d'envoi des courriels externes (glorelay)."""
+import contextlib
+import io
+import tempfile
+import os
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import glorelay
+import gloutils
+from tests.support import FakeSMTPServer
+
+WAIT_TIMEOUT = 5.0
+
+
+def _payload(subject: str = "Bonjour", destination: str = "bob@example.com") -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(sender=f"alice@{gloutils.SERVER_DOMAIN}", destination=destination,
+                                        subject=subject, date=gloutils.get_current_utc_time(),
+                                        content="Contenu")
+
+
+class RelayTestCase(unittest.TestCase):
+    """Base des tests: une file dans un dossier temporaire."""
+
+    def setUp(self) -> None:
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+
+    def make_queue(self, smtp: FakeSMTPServer, **kwargs) -> glorelay.RelayQueue:
+        return glorelay.RelayQueue(self.spool_dir, "127.0.0.1", smtp.port, **kwargs)
+
+    def write_pending(self, queue: glorelay.RelayQueue, payload: gloutils.EmailContentPayload) -> str:
+        """Écrit une entrée sans passer par `enqueue`, comme une ancienne version."""
+        entry = glorelay.SpoolEntry(id=uuid.uuid4().hex, recipients=[payload["destination"]],
+                                    status=glorelay.QUEUED, attempts=0, next_attempt=time.time(),
+                                    error="", payload=payload)
+        glorelay._write_entry(queue._pending_path(entry["id"]), entry)
+        return entry["id"]
+
+    def wait_for_status(self, queue: glorelay.RelayQueue, relay_id: str) -> glorelay.SpoolEntry:
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            entry = queue.status(relay_id)
+            if entry["status"] in (glorelay.SENT, glorelay.FAILED) or time.monotonic() > deadline:
+                return entry
+            time.sleep(0.02)
+
+
+class PoisonEntryTestCase(RelayTestCase):
+    """Un courriel impossible à envoyer ne bloque pas la file."""
+
+    def test_enqueue_rejects_linefeed(self) -> None:
+        with FakeSMTPServer() as smtp:
+            queue = self.make_queue(smtp)
+            for payload in (_payload(subject="Salut\nBcc: eve@example.com"),
+                            _payload(destination="bob@example.com\r\nBcc: eve@example.com")):
+                with self.assertRaises(glorelay.RelayError):
+                    queue.enqueue(payload)
+
+    def test_invalid_entry_fails_permanently(self) -> None:
+        with FakeSMTPServer() as smtp:
+            queue = self.make_queue(smtp)
+            poison_id = self.write_pending(queue, _payload(subject="Salut\nBcc: eve@example.com"))
+            entry = queue.enqueue(_payload())
+            queue._deliver_due()
+            self.assertEqual(queue.status(poison_id)["status"], glorelay.FAILED)
+            self.assertEqual(queue.status(entry["id"])["status"], glorelay.SENT)
+            self.assertEqual(len(smtp.messages), 1)
+
+    def test_worker_survives_unexpected_errors(self) -> None:
+        with FakeSMTPServer() as smtp, contextlib.redirect_stdout(io.StringIO()) as output:
+            queue = self.make_queue(smtp)
+            deliver_due = queue._deliver_due
+            calls = []
+
+            def failing_once():
+                calls.append(None)
+                if len(calls) == 1:
+                    raise RuntimeError("boom")
+                return deliver_due()
+
+            queue._deliver_due = failing_once
+            queue.start()
+            self.addCleanup(queue.stop)
+            entry = queue.enqueue(_payload())
+            self.assertEqual(self.wait_for_status(queue, entry["id"])["status"], glorelay.SENT)
+        self.assertIn("relay failed", output.getvalue())
+
+
+class PoolTestCase(RelayTestCase):
+    """Envoi par lots sur les sessions du bassin."""
+
+    def test_batch_reuses_session(self) -> None:
+        with FakeSMTPServer() as smtp:
+            queue = self.make_queue(smtp, max_messages=2)
+            entries = [queue.enqueue(_payload(subject=f"Courriel {index}")) for index in range(5)]
+            queue._deliver_due()
+            queue._pool.close()
+            for entry in entries:
+                self.assertEqual(queue.status(entry["id"])["status"], glorelay.SENT)
+            self.assertEqual(len(smtp.messages), 5)
+            self.assertEqual(smtp.connections, 3)
+
+    def test_refused_greeting_reschedules_batch(self) -> None:
+        for code in ("421", "554"):
+            with self.subTest(code=code), \
+                    FakeSMTPServer({"EHLO": f"{code} go away", "HELO": f"{code} go away"}) as smtp:
+                queue = self.make_queue(smtp)
+                entries = [queue.enqueue(_payload()) for _ in range(3)]
+                queue._deliver_due()
+                for entry in entries:
+                    entry = queue.status(entry["id"])
+                    # Le refus concerne la session: les courriels seront réessayés.
+                    self.assertEqual(entry["status"], glorelay.QUEUED)
+                    self.assertEqual(entry["attempts"], 1)
+                    self.assertTrue(entry["error"])
+                self.assertEqual(smtp.connections, 1)
+                self.assertEqual(smtp.messages, [])
+
+    def test_refused_recipient_fails_permanently(self) -> None:
+        with FakeSMTPServer({"RCPT": "550 no such user"}) as smtp:
+            queue = self.make_queue(smtp)
+            entry = queue.enqueue(_payload())
+            queue._deliver_due()
+            self.assertEqual(queue.status(entry["id"])["status"], glorelay.FAILED)
+
+    def test_temporary_error_is_retried_later(self) -> None:
+        with FakeSMTPServer({"DATA_END": "451 try again"}) as smtp:
+            queue = self.make_queue(smtp)
+            entry = queue.enqueue(_payload())
+            before = time.time()
+            queue._deliver_due()
+            entry = queue.status(entry["id"])
+            self.assertEqual(entry["status"], glorelay.QUEUED)
+            self.assertGreaterEqual(entry["next_attempt"], before + glorelay.RETRY_BASE_DELAY)
+            # L'entrée n'est pas encore due: un nouveau passage ne l'envoie pas.
+            self.assertEqual(queue._deliver_due(), entry["next_attempt"])
+
+
+class StaleClaimTestCase(RelayTestCase):
+    """Les réservations d'un lot en cours ne sont pas reprises."""
+
+    def claim(self, queue: glorelay.RelayQueue, entry: glorelay.SpoolEntry) -> None:
+        self.assertTrue(queue._claim(entry["id"]))
+        # Réservé depuis plus longtemps que STALE_SENDING_DELAY.
+        old = time.time() - 2 * glorelay.STALE_SENDING_DELAY
+        os.utime(queue._sending_path(entry["id"]), (old, old))
+
+    def test_long_batch_is_not_recovered(self) -> None:
+        with FakeSMTPServer() as smtp:
+            queue = self.make_queue(smtp)
+            entries = [queue.enqueue(_payload()) for _ in range(2)]
+            for entry in entries:
+                self.claim(queue, entry)
+            make_email_message = glorelay.make_email_message
+
+            def recovering(payload):
+                # Un autre fil reprend les envois interrompus pendant le lot.
+                queue._last_recovery = 0.0
+                queue._recover_stale()
+                return make_email_message(payload)
+
+            with mock.patch.object(glorelay, "make_email_message", recovering):
+                queue._deliver_batch(entries)
+            queue._deliver_due()
+            for entry in entries:
+                self.assertEqual(queue.status(entry["id"])["status"], glorelay.SENT)
+            self.assertEqual(len(smtp.messages), 2)
+
+    def test_lost_claim_is_skipped(self) -> None:
+        with FakeSMTPServer() as smtp:
+            queue = self.make_queue(smtp)
+            entry = queue.enqueue(_payload())
+            self.claim(queue, entry)
+            os.remove(queue._sending_path(entry["id"]))
+            queue._deliver_batch([entry])
+            self.assertEqual(smtp.messages, [])
+            entry["status"] = glorelay.SENT
+            queue._record(entry)
+
+
+if __name__ == "__main__":
+    unittest.main()
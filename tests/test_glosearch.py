@@ -0,0 +1,112 @@
+"""Tests de la recherche plein texte (glosearch)."""
+import os
+import tempfile
+import unittest
+
+import glosearch
+import gloutils
+
+
+def _email(subject: str, content: str, sender: str = "alice@glo2000.ca") -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(sender=sender, destination="bob@glo2000.ca", subject=subject,
+                                        date="Mon, 01 Jan 2024 00:00:00 +0000", content=content)
+
+
+class TermsTestCase(unittest.TestCase):
+    """Découpage en termes et pondération par champ."""
+
+    def test_tokenize(self) -> None:
+        self.assertEqual(glosearch.tokenize("Réunion d'ÉQUIPE à 10h, café!"),
+                         ["reunion", "equipe", "10h", "cafe"])
+
+    def test_query_terms_are_distinct(self) -> None:
+        self.assertEqual(glosearch.query_terms("Budget budget BUDGÉT lunch"), ["budget", "lunch"])
+
+    def test_document_terms_are_weighted(self) -> None:
+        weights = glosearch.document_terms(_email("budget", "budget lunch", sender="budget@glo2000.ca"))
+        self.assertEqual(weights["budget"], sum(glosearch.FIELD_WEIGHTS.values()))
+        self.assertEqual(weights["lunch"], glosearch.FIELD_WEIGHTS["content"])
+        self.assertEqual(weights["glo2000"], glosearch.FIELD_WEIGHTS["sender"])
+
+
+class RankTestCase(unittest.TestCase):
+    """Classement des documents contenant tous les termes."""
+
+    def test_intersection(self) -> None:
+        postings = [([0, 2, 4, 6], [1, 1, 1, 1]), ([1, 2, 3, 6], [1, 1, 1, 1])]
+        docs, total = glosearch.rank(postings, 8)
+        self.assertEqual(total, 2)
+        self.assertEqual(sorted(docs), [2, 6])
+        self.assertEqual(glosearch.rank(postings + [([], [])], 8), ([], 0))
+        self.assertEqual(glosearch.rank([], 8), ([], 0))
+
+    def test_weights_then_most_recent(self) -> None:
+        docs, total = glosearch.rank([([0, 1, 2, 3], [1, 3, 1, 1])], 4)
+        self.assertEqual(total, 4)
+        # Le poids le plus élevé d'abord, puis les plus récents.
+        self.assertEqual(docs, [1, 3, 2, 0])
+
+    def test_rare_terms_weigh_more(self) -> None:
+        common = ([0, 1, 2, 3, 4, 5], [1, 2, 1, 1, 1, 1])
+        rare = ([0, 1], [2, 1])
+        # Même somme des poids: sans la rareté, le plus récent (1) passerait d'abord.
+        docs, total = glosearch.rank([common, rare], 6)
+        self.assertEqual((docs, total), ([0, 1], 2))
+
+    def test_limit(self) -> None:
+        posting = (list(range(100)), [1] * 100)
+        docs, total = glosearch.rank([posting], 100, limit=3)
+        self.assertEqual((docs, total), ([99, 98, 97], 100))
+
+    def test_long_posting_is_probed(self) -> None:
+        # Une liste beaucoup plus longue est sondée par bisection, au même résultat.
+        short = ([5, 500, 999], [1, 2, 1])
+        long = (list(range(0, 1000, 5)), [1] * 200)
+        docs, total = glosearch.rank([short, long], 1000)
+        self.assertEqual(total, 2)
+        self.assertEqual(docs, [500, 5])
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    """Index inversé persistant d'une boîte."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._path = os.path.join(tmp.name, gloutils.SEARCH_INDEX_FILENAME)
+
+    def _index(self) -> glosearch.SearchIndex:
+        index = glosearch.SearchIndex(self._path)
+        index.refresh()
+        return index
+
+    def test_search_and_reload(self) -> None:
+        index = self._index()
+        index.add("a", _email("budget meeting", "the quarterly budget"))
+        index.add("b", _email("lunch", "lunch at noon, bring the budget"))
+        index.add("c", _email("holidays", "no work next week"))
+        index.refresh()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.search("budget"), (["a", "b"], 2))
+        self.assertEqual(index.search("BUDGET lunch"), (["b"], 1))
+        self.assertEqual(index.search("budget unknown"), ([], 0))
+        self.assertEqual(index.search("budget", limit=1), (["a"], 2))
+        # Une autre instance, comme un autre processus, lit le même fichier.
+        other = self._index()
+        self.assertEqual(other.search("work"), (["c"], 1))
+        index.add("d", _email("work", "more work"))
+        other.refresh()
+        self.assertEqual(other.search("work"), (["d", "c"], 2))
+
+    def test_rebuild_and_remap(self) -> None:
+        index = self._index()
+        index.rebuild([(1, _email("budget", "x")), (2, _email("lunch", "x")), (3, _email("budget", "y"))])
+        self.assertEqual(index.search("budget"), ([3, 1], 2))
+        index.remap({1: 10, 2: 20})
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search("budget"), ([10], 1))
+        self.assertEqual(self._index().search("lunch"), ([20], 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
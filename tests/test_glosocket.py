@@ -0,0 +1,142 @@
+"""Tests du découpage des messages en trames (glosocket)."""
+import select
+import socket
+import struct
+import threading
+import unittest
+import zlib
+
+import glosocket
+
+
+def _frames(data: bytes, compress: bool = False) -> bytes:
+    return b"".join(glosocket._frame(data, compress))
+
+
+class FrameDecoderTestCase(unittest.TestCase):
+    """Décodage incrémental des trames."""
+
+    def test_messages_split_across_reads(self) -> None:
+        messages = [b"first", b"x" * 5000, "é".encode("utf-8")]
+        stream = b"".join(_frames(message) for message in messages)
+        decoder = glosocket.FrameDecoder()
+        received = []
+        for start in range(0, len(stream), 7):
+            received += decoder.feed(stream[start:start + 7])
+        self.assertEqual(received, messages)
+
+    def test_several_messages_in_one_read(self) -> None:
+        messages = [b"a", b"", b"b" * 100]
+        stream = b"".join(_frames(message) for message in messages)
+        decoder = glosocket.FrameDecoder()
+        self.assertEqual(decoder.feed(stream + stream[:3]), messages)
+        self.assertEqual(decoder.feed(stream[3:]), messages)
+
+    def test_messages_outlive_the_buffer(self) -> None:
+        stream = _frames(b"un") + _frames(b"deux")
+        decoder = glosocket.FrameDecoder()
+        first = decoder.feed(stream[:3])
+        received = decoder.feed(stream[3:] + stream[:5])
+        # Le tampon compacté est ensuite réutilisé pour la suite.
+        received += decoder.feed(stream[5:])
+        self.assertEqual(first, [])
+        self.assertEqual(received, [b"un", b"deux", b"un", b"deux"])
+        self.assertTrue(all(type(message) is bytes for message in received))
+
+    def test_announced_size_is_limited(self) -> None:
+        decoder = glosocket.FrameDecoder(max_size=100)
+        self.assertEqual(decoder.feed(_frames(b"z" * 100)), [b"z" * 100])
+        # Refusé dès la longueur reçue, sans attendre le contenu.
+        with self.assertRaises(glosocket.GLOSocketError):
+            decoder.feed(struct.pack("!I", 101))
+
+    def test_recv_from_closed_socket(self) -> None:
+        first, second = socket.socketpair()
+        self.addCleanup(second.close)
+        second.setblocking(False)
+        decoder = glosocket.FrameDecoder()
+        self.assertEqual(decoder.recv_from(second), [])
+        glosocket.send_data(first, b"dernier")
+        first.close()
+        self.assertEqual(decoder.recv_from(second), [b"dernier"])
+        with self.assertRaises(glosocket.GLOSocketError):
+            decoder.recv_from(second)
+
+
+class FrameWriterTestCase(unittest.TestCase):
+    """Envoi des trames sur un socket non bloquant."""
+
+    def test_buffered_until_flushed(self) -> None:
+        first, second = socket.socketpair()
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        first.setblocking(False)
+        writer = glosocket.FrameWriter(first)
+        writer.write(b"x" * 10 ** 6)
+        writer.write("fin")
+        writer.flush()
+        # Le socket n'accepte pas tout d'un coup.
+        self.assertTrue(writer.pending)
+        received = []
+        reader = threading.Thread(target=lambda: received.extend(
+            bytes(glosocket.recv_data(second)) for _ in range(2)))
+        reader.start()
+        while writer.pending:
+            select.select([], [first], [], 5)
+            writer.flush()
+        reader.join(5)
+        self.assertEqual(received, [b"x" * 10 ** 6, b"fin"])
+
+class CompressionTestCase(unittest.TestCase):
+    """Compression négociée des trames et limites de décompression."""
+
+    def test_compressed_only_when_asked_and_large(self) -> None:
+        data = b"y" * (2 * glosocket.COMPRESSION_THRESHOLD)
+        length, = struct.unpack_from("!I", _frames(data, compress=True))
+        self.assertTrue(length & glosocket.COMPRESSED_FLAG)
+        length, = struct.unpack_from("!I", _frames(data, compress=False))
+        self.assertEqual(length, len(data))
+        small = b"y" * (glosocket.COMPRESSION_THRESHOLD - 1)
+        length, = struct.unpack_from("!I", _frames(small, compress=True))
+        self.assertEqual(length, len(small))
+
+    def test_decoder_decompresses(self) -> None:
+        messages = [b"z" * 5000, b"court", b"w" * 3000]
+        stream = b"".join(_frames(message, compress=True) for message in messages)
+        decoder = glosocket.FrameDecoder()
+        received = []
+        for start in range(0, len(stream), 100):
+            received += decoder.feed(stream[start:start + 100])
+        self.assertEqual(received, messages)
+
+    def test_decompressed_size_is_limited(self) -> None:
+        data = zlib.compress(b"a" * 1000)
+        self.assertEqual(glosocket._unframe(data, True, max_size=1000), b"a" * 1000)
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket._unframe(data, True, max_size=999)
+
+    def test_compression_bomb_is_refused(self) -> None:
+        data = zlib.compress(b"\0" * (64 * 1024 * 1024))
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket._unframe(data, True, max_size=1024 * 1024)
+
+    def test_invalid_or_truncated_data_is_refused(self) -> None:
+        data = zlib.compress(b"a" * 1000)
+        for invalid in (b"not zlib", data[:-4]):
+            with self.subTest(data=invalid[:8]):
+                with self.assertRaises(glosocket.GLOSocketError):
+                    glosocket._unframe(invalid, True)
+
+    def test_recv_data_limit(self) -> None:
+        first, second = socket.socketpair()
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        glosocket.send_data(first, b"w" * 5000, compress=True)
+        self.assertEqual(bytes(glosocket.recv_data(second, max_size=5000)), b"w" * 5000)
+        glosocket.send_data(first, b"w" * 5001, compress=True)
+        with self.assertRaises(glosocket.GLOSocketError):
+            glosocket.recv_data(second, max_size=5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
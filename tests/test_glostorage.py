@@ -0,0 +1,283 @@
+"""Tests des stockages de comptes et de courriels (glostorage)."""
+import os
+import tempfile
+import unittest
+
+import glostorage
+import gloutils
+
+
+def _email(index: int, subject: str, content: str) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender=f"sender{index}@glo2000.ca",
+        destination="alice@glo2000.ca",
+        subject=subject,
+        date="Mon, 01 Jan 2024 00:00:00 +0000",
+        content=content
+    )
+
+
+_EMAILS = [
+    _email(0, "budget meeting", "the quarterly budget is attached"),
+    _email(1, "lunch", "lunch at noon, bring the budget"),
+    _email(2, "holidays", "no work next week"),
+    _email(3, "budget review", "budget budget budget"),
+    _email(4, "re: lunch", "see you at lunch"),
+]
+
+
+class StorageTestCase(unittest.TestCase):
+    """Comportements communs à tous les stockages."""
+
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+
+    def _open(self, name: str, sub_dir: str = "data") -> glostorage.MailStorage:
+        storage = glostorage.open_storage(name, os.path.join(self._tmp.name, sub_dir))
+        self.addCleanup(storage.close)
+        return storage
+
+    def _fill(self, storage: glostorage.MailStorage, username: str = "alice") -> None:
+        storage.create_user(username, "hash")
+        for index, payload in enumerate(_EMAILS):
+            storage.deliver(username, payload, timestamp=1000.0 + index)
+
+    def test_accounts(self) -> None:
+        for name in glostorage.STORAGES:
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                self.assertFalse(storage.user_exists("alice"))
+                storage.create_user("alice", "hash", quota=1000)
+                self.assertTrue(storage.user_exists("ALICE"))
+                with self.assertRaises(glostorage.UserExistsError):
+                    storage.create_user("Alice", "other")
+                self.assertEqual(storage.get_password("alice"), "hash")
+                storage.set_password("alice", "new hash")
+                self.assertEqual(storage.get_password("ALICE"), "new hash")
+                self.assertIsNone(storage.get_password("bob"))
+                self.assertEqual(storage.get_quota("alice"), 1000)
+                storage.set_quota("alice", None)
+                self.assertIsNone(storage.get_quota("alice"))
+                self.assertEqual(storage.users(), ["ALICE"])
+
+    def test_list_is_most_recent_first(self) -> None:
+        for name in glostorage.STORAGES:
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                self._fill(storage)
+                summaries, total = storage.list_emails("alice")
+                self.assertEqual(total, len(_EMAILS))
+                self.assertEqual([summary["subject"] for summary in summaries],
+                                 [payload["subject"] for payload in reversed(_EMAILS)])
+                summaries, total = storage.list_emails("alice", offset=1, limit=2)
+                self.assertEqual(total, len(_EMAILS))
+                self.assertEqual([summary["subject"] for summary in summaries],
+                                 [_EMAILS[3]["subject"], _EMAILS[2]["subject"]])
+                self.assertEqual(storage.fetch("alice", 1), _EMAILS[-1])
+                self.assertIsNone(storage.fetch("alice", len(_EMAILS) + 1))
+                self.assertEqual([payload for _, payload in storage.iter_emails("alice")], _EMAILS)
+
+    def test_quota_and_stats(self) -> None:
+        for name in glostorage.STORAGES:
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                storage.create_user("alice", "hash")
+                storage.deliver("alice", _EMAILS[0])
+                count, size = storage.stats("alice")
+                self.assertEqual(count, 1)
+                storage.set_quota("alice", size + 1)
+                with self.assertRaises(glostorage.QuotaExceededError):
+                    storage.deliver("alice", _EMAILS[0])
+                self.assertEqual(storage.stats("alice"), (count, size))
+
+    def test_unknown_user(self) -> None:
+        for name in glostorage.STORAGES:
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                storage.create_user("alice", "hash")
+                with self.assertRaises(glostorage.UnknownUserError):
+                    storage.deliver("bob", _EMAILS[0])
+                errors = storage.deliver_many(["alice", "bob"], _EMAILS[0])
+                self.assertIsNone(errors["alice"])
+                self.assertIsInstance(errors["bob"], glostorage.UnknownUserError)
+                self.assertEqual(storage.stats("alice")[0], 1)
+
+    def test_search_numbers_match_fetch(self) -> None:
+        for name in glostorage.STORAGES:
+            for cached in (False, True):
+                with self.subTest(storage=name, cached=cached):
+                    storage = self._open(name, f"{name}-{cached}")
+                    if cached:
+                        storage = glostorage.CachedStorage(storage)
+                    self._fill(storage)
+                    for query in ("budget", "lunch", "work", "budget lunch"):
+                        results, total = storage.search("alice", query)
+                        self.assertEqual(total, len(results))
+                        self.assertTrue(results)
+                        for number, summary in results:
+                            email = storage.fetch("alice", number)
+                            self.assertEqual(email["subject"], summary["subject"])
+                            self.assertEqual(email["sender"], summary["sender"])
+
+    def test_search_ranking(self) -> None:
+        for name in glostorage.STORAGES:
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                self._fill(storage)
+                results, total = storage.search("alice", "budget", limit=2)
+                self.assertEqual(total, 3)
+                # Le terme dans le sujet et répété dans le contenu d'abord.
+                self.assertEqual([summary["subject"] for _, summary in results],
+                                 ["budget review", "budget meeting"])
+                results, total = storage.search("alice", "budget lunch")
+                self.assertEqual(total, 1)
+                self.assertEqual(results[0][1]["subject"], "lunch")
+                self.assertEqual(storage.search("alice", "budget nothing"), ([], 0))
+
+    def test_server_folders_are_not_accounts(self) -> None:
+        for name in (glostorage.FileSystemStorage.name, glostorage.LogStorage.name):
+            with self.subTest(storage=name):
+                storage = self._open(name, name)
+                for folder in (gloutils.SERVER_SPOOL_DIR, gloutils.SERVER_LOST_DIR):
+                    os.makedirs(os.path.join(self._tmp.name, name, folder, "done"))
+                    self.assertFalse(storage.user_exists(folder))
+                    with self.assertRaises(glostorage.UnknownUserError):
+                        storage.deliver(folder, _EMAILS[0])
+                    with self.assertRaises(glostorage.UserExistsError):
+                        storage.create_user(folder.lower(), "hash")
+                self.assertEqual(storage.users(), [])
+
+    def test_incomplete_storage_cannot_be_created(self) -> None:
+        class IncompleteStorage(glostorage.MailStorage):
+            def users(self) -> list[str]:
+                return []
+
+        with self.assertRaises(TypeError):
+            IncompleteStorage()
+
+
+class CachedStorageTestCase(unittest.TestCase):
+    """Cache LRU des listes et des courriels (glostorage.CachedStorage)."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._data_dir = tmp.name
+
+    def _open(self, max_bytes: int = glostorage.CACHE_MAX_BYTES) -> glostorage.CachedStorage:
+        storage = glostorage.CachedStorage(glostorage.FileSystemStorage(self._data_dir), max_bytes)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_hits_and_misses(self) -> None:
+        storage = self._open()
+        storage.create_user("alice", "hash")
+        storage.deliver("alice", _EMAILS[0])
+        for _ in range(3):
+            self.assertEqual(storage.fetch("alice", 1), _EMAILS[0])
+            self.assertEqual(storage.list_emails("alice")[1], 1)
+        counters = storage.counters()
+        self.assertEqual((counters["hits"], counters["misses"], counters["entries"]), (4, 2, 2))
+        self.assertGreater(counters["bytes"], 0)
+
+    def test_delivery_invalidates_recipient(self) -> None:
+        storage = self._open()
+        for username in ("alice", "bob"):
+            storage.create_user(username, "hash")
+            storage.deliver(username, _EMAILS[0], timestamp=1000.0)
+        storage.fetch("alice", 1)
+        storage.fetch("bob", 1)
+        storage.deliver_many(["alice"], _EMAILS[1], timestamp=2000.0)
+        self.assertEqual(storage.counters()["entries"], 1)
+        self.assertEqual(storage.fetch("alice", 1), _EMAILS[1])
+
+    def test_delivery_by_another_process(self) -> None:
+        storage = self._open()
+        storage.create_user("alice", "hash")
+        storage.deliver("alice", _EMAILS[0], timestamp=1000.0)
+        self.assertEqual(storage.list_emails("alice")[1], 1)
+        self.assertEqual(storage.fetch("alice", 1), _EMAILS[0])
+        # Livraison par un autre serveur, sans passer par ce cache.
+        other = glostorage.FileSystemStorage(self._data_dir)
+        self.addCleanup(other.close)
+        other.deliver("alice", _EMAILS[1], timestamp=2000.0)
+        self.assertEqual(storage.list_emails("alice")[1], 2)
+        self.assertEqual(storage.fetch("alice", 1), _EMAILS[1])
+
+    def test_least_recently_used_is_evicted(self) -> None:
+        storage = self._open()
+        storage.create_user("alice", "hash")
+        for index in range(3):
+            storage.deliver("alice", _EMAILS[0], timestamp=1000.0 + index)
+        # Budget juste suffisant pour deux courriels.
+        size = 2 * glostorage._size_of(_EMAILS[0])
+        storage = self._open(max_bytes=size)
+        storage.fetch("alice", 1)
+        storage.fetch("alice", 2)
+        storage.fetch("alice", 1)
+        storage.fetch("alice", 3)
+        counters = storage.counters()
+        self.assertEqual(counters["evictions"], 1)
+        self.assertLessEqual(counters["bytes"], size)
+        hits = counters["hits"]
+        storage.fetch("alice", 1)
+        self.assertEqual(storage.counters()["hits"], hits + 1)
+        storage.fetch("alice", 2)
+        self.assertEqual(storage.counters()["hits"], hits + 1)
+
+
+class MigrateTestCase(unittest.TestCase):
+    """Copie des comptes d'un stockage à un autre (glostorage.migrate)."""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self._tmp_dir = tmp.name
+
+    def _open(self, name: str, sub_dir: str) -> glostorage.MailStorage:
+        storage = glostorage.open_storage(name, os.path.join(self._tmp_dir, sub_dir))
+        self.addCleanup(storage.close)
+        return storage
+
+    def _assert_same(self, first: glostorage.MailStorage, second: glostorage.MailStorage) -> None:
+        self.assertEqual(first.users(), second.users())
+        for username in first.users():
+            self.assertEqual(first.get_password(username), second.get_password(username))
+            self.assertEqual(first.get_quota(username), second.get_quota(username))
+            self.assertEqual(list(first.iter_emails(username)), list(second.iter_emails(username)))
+
+    def _fill(self, storage: glostorage.MailStorage) -> None:
+        for username in ("alice", "bob"):
+            storage.create_user(username, f"hash-{username}")
+            for index, payload in enumerate(_EMAILS):
+                storage.deliver(username, payload, timestamp=1000.0 + index)
+        storage.set_quota("bob", 10 ** 6)
+
+    def test_round_trip(self) -> None:
+        source = self._open("fs", "fs")
+        self._fill(source)
+        previous = source
+        for name in ("sqlite", "log", "fs"):
+            destination = self._open(name, f"copy-{name}")
+            self.assertEqual(glostorage.migrate(previous, destination), 2)
+            self._assert_same(source, destination)
+            previous = destination
+
+    def test_rerun_completes_interrupted_copy(self) -> None:
+        source = self._open("fs", "fs")
+        self._fill(source)
+        destination = self._open("sqlite", "sqlite")
+        # Copie interrompue après deux courriels du premier compte.
+        destination.create_user("alice", "hash-alice")
+        for timestamp, payload in list(source.iter_emails("ALICE"))[:2]:
+            destination.deliver("alice", payload, timestamp)
+
+        self.assertEqual(glostorage.migrate(source, destination), 2)
+        self._assert_same(source, destination)
+        self.assertEqual(glostorage.migrate(source, destination), 0)
+        self._assert_same(source, destination)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Tests de la transmission des contenus en morceaux (glostream)."""
+import io
+import unittest
+
+import glostream
+import gloutils
+
+
+def _message(content: str) -> gloutils.GloMessage:
+    return gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING, id=3, payload=gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca", subject="gros",
+        date="Mon, 01 Jan 2024 00:00:00 +0000", content=content))
+
+
+class StreamTestCase(unittest.TestCase):
+    """Découpage et réassemblage d'un contenu."""
+
+    def _receive(self, message: gloutils.GloMessage, chunk_size: int = 1000,
+                 max_size: int = glostream.MAX_CONTENT_SIZE) -> glostream.IncomingStream:
+        head, chunks = glostream.split_message(message, chunk_size)
+        self.assertTrue(glostream.is_streamed(head))
+        stream = glostream.IncomingStream(head, max_size)
+        self.addCleanup(stream.close)
+        for chunk in chunks:
+            self.assertFalse(stream.done)
+            stream.feed(bytes(chunk))
+        self.assertTrue(stream.done)
+        return stream
+
+    def test_small_content_is_not_split(self) -> None:
+        message = _message("court")
+        self.assertEqual(glostream.split_message(message), (message, []))
+
+    def test_round_trip(self) -> None:
+        message = _message("é🙂" * glostream.STREAM_THRESHOLD)
+        stream = self._receive(message)
+        self.assertEqual(stream.complete(), message)
+
+    def test_copy_to(self) -> None:
+        content = "ligne\n" * glostream.STREAM_THRESHOLD
+        output = io.StringIO()
+        self._receive(_message(content)).copy_to(output)
+        self.assertEqual(output.getvalue(), content)
+
+    def test_oversize_content_is_rejected(self) -> None:
+        stream = self._receive(_message("x" * glostream.STREAM_THRESHOLD), max_size=100)
+        self.assertIsNotNone(stream.rejected)
+
+    def test_chunk_beyond_announced_size(self) -> None:
+        head, chunks = glostream.split_message(_message("x" * glostream.STREAM_THRESHOLD))
+        stream = glostream.IncomingStream(head)
+        self.addCleanup(stream.close)
+        with self.assertRaises(glostream.StreamError):
+            stream.feed(bytes(chunks[0]) + b"extra")
+
+    def test_invalid_size_and_utf8(self) -> None:
+        head, _ = glostream.split_message(_message("x" * glostream.STREAM_THRESHOLD))
+        with self.assertRaises(glostream.StreamError):
+            glostream.IncomingStream(dict(head, payload=dict(head["payload"], stream_size=-1)))
+        stream = glostream.IncomingStream(dict(head, payload=dict(head["payload"], stream_size=2)))
+        self.addCleanup(stream.close)
+        stream.feed(b"\xff\xfe")
+        with self.assertRaises(glostream.StreamError):
+            stream.complete()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Tests du serveur lancé dans un sous-processus (TP4_server)."""
+import contextlib
+import json
+import os
+import socket
+import time
+import unittest
+
+import glocodec
+import gloclient
+import glosocket
+import gloutils
+from tests.support import FakeSMTPServer, running_server
+
+ENGINES = ("select", "asyncio")
+
+
+class MalformedFrameTestCase(unittest.TestCase):
+    """Un client qui envoie autre chose qu'un message ne fait pas tomber le serveur."""
+
+    def test_non_object_frames(self) -> None:
+        for engine in ENGINES:
+            with self.subTest(engine=engine), running_server("-e", engine):
+                for frame in (b"[]", b"42", b'"x"', b'{"header": "1"}'):
+                    with socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=5) as sock:
+                        glosocket.send_data(sock, frame)
+                        # Le serveur ferme la connexion du client fautif.
+                        with self.assertRaises(glosocket.GLOSocketError):
+                            glosocket.recv_data(sock)
+                with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+                    client.register("alice", "Password123")
+                    self.assertEqual(client.stats()["count"], 0)
+
+    def test_malformed_binary_frames(self) -> None:
+        header = glocodec._MESSAGE_HEADER.pack(gloutils.Headers.OK, glocodec._HAS_PAYLOAD, 0)
+        frames = (header + b"\x81\x90\x01", header + b"\x91" * 100000 + b"\xc0")
+        for engine in ENGINES:
+            with self.subTest(engine=engine), running_server("-e", engine):
+                for frame in frames:
+                    with socket.create_connection(("127.0.0.1", gloutils.APP_PORT), timeout=5) as sock:
+                        hello = gloutils.GloMessage(header=gloutils.Headers.HELLO,
+                                                    payload=gloutils.HelloPayload(encodings=["binary"]))
+                        glosocket.send_data(sock, glocodec.JSONCodec.encode(hello))
+                        glosocket.recv_data(sock)
+                        glosocket.send_data(sock, frame)
+                        with self.assertRaises(glosocket.GLOSocketError):
+                            glosocket.recv_data(sock)
+                with gloclient.MailClient("127.0.0.1", timeout=5) as client:
+                    client.register("alice", "Password123")
+
+
+class ExternalEmailTestCase(unittest.TestCase):
+    """Un courriel externe qui ne peut pas devenir un message SMTP est refusé."""
+
+    def test_invalid_headers_are_refused(self) -> None:
+        with running_server() as server, gloclient.MailClient("127.0.0.1", timeout=5) as client:
+            client.register("alice", "Password123")
+            for destination in ("bob@example.com", [f"alice@{gloutils.SERVER_DOMAIN}", "bob@example.com"]):
+                with self.assertRaises(gloclient.MailClientError):
+                    client.send(destination, "Salut\nBcc: eve@example.com", "Contenu")
+            # Rien n'a été livré, pas même au destinataire du serveur.
+            self.assertEqual(client.stats()["count"], 0)
+            self.assertIsNone(server.process.poll())
+
+
+class PushTestCase(unittest.TestCase):
+    """Avis NEW_MAIL envoyés aux sessions abonnées."""
+
+    def wait_for(self, client: gloclient.MailClient, notifications: list, count: int) -> None:
+        deadline = time.monotonic() + 5
+        while len(notifications) < count and time.monotonic() < deadline:
+            client.poll_notifications()
+            time.sleep(0.02)
+
+    def test_subscribed_sessions_are_notified(self) -> None:
+        address = f"alice@{gloutils.SERVER_DOMAIN}"
+        for engine in ENGINES:
+            with self.subTest(engine=engine), running_server("-e", engine):
+                subscribed, other = [], []
+                with gloclient.MailClient("127.0.0.1", timeout=5, on_new_mail=subscribed.append) as alice, \
+                        gloclient.MailClient("127.0.0.1", timeout=5, on_new_mail=other.append) as alice2, \
+                        gloclient.MailClient("127.0.0.1", timeout=5) as bob:
+                    alice.register("alice", "Password123")
+                    alice2.login("alice", "Password123")
+                    bob.register("bob", "Password123")
+                    alice.subscribe()
+                    bob.send(address, "Premier", "Contenu")
+                    self.wait_for(alice, subscribed, 1)
+                    self.assertEqual([(notification["sender"], notification["subject"])
+                                      for notification in subscribed],
+                                     [(f"bob@{gloutils.SERVER_DOMAIN}", "Premier")])
+
+                    alice.subscribe(False)
+                    alice2.subscribe()
+                    bob.send(address, "Second", "Contenu")
+                    self.wait_for(alice2, other, 1)
+                    alice.poll_notifications()
+                    self.assertEqual(len(subscribed), 1)
+                    self.assertEqual([notification["subject"] for notification in other], ["Second"])
+                    # Un avis reçu entre deux requêtes n'en trouble pas les réponses.
+                    self.assertEqual(alice2.stats()["count"], 2)
+
+
+class FanOutTestCase(unittest.TestCase):
+    """Envoi à plusieurs destinataires et aux listes de distribution."""
+
+    def test_send_to_list_and_addresses(self) -> None:
+        domain = gloutils.SERVER_DOMAIN
+        lists = {"equipe": [f"bob@{domain}", f"carol@{domain}", "dave@exemple.com",
+                            f"inconnu@{domain}", f"externes@{domain}"],
+                 "externes": ["erin@exemple.com", f"equipe@{domain}"]}
+        with FakeSMTPServer() as smtp, \
+                running_server("--smtp-server", "127.0.0.1", "--smtp-port", str(smtp.port),
+                               files={gloutils.LISTS_FILENAME: json.dumps(lists)}), \
+                contextlib.ExitStack() as stack:
+            clients = {}
+            for username in ("alice", "bob", "carol"):
+                clients[username] = stack.enter_context(gloclient.MailClient("127.0.0.1", timeout=5))
+                clients[username].register(username, "Password123")
+            report = clients["alice"].send([f"equipe@{domain}", f"BOB@{domain}", "pas une adresse"],
+                                           "Réunion", "Demain")
+            statuses = {status["address"]: status for status in report["recipients"]}
+            self.assertEqual(list(statuses), [f"bob@{domain}", f"carol@{domain}", "dave@exemple.com",
+                                              f"inconnu@{domain}", "erin@exemple.com", "pas une adresse"])
+            self.assertEqual(statuses[f"bob@{domain}"]["status"], "delivered")
+            self.assertEqual(statuses[f"carol@{domain}"]["status"], "delivered")
+            self.assertEqual(statuses[f"inconnu@{domain}"]["status"], "failed")
+            self.assertEqual(statuses["pas une adresse"]["status"], "failed")
+            # Les destinataires externes partagent une seule entrée de la file.
+            self.assertEqual(statuses["dave@exemple.com"]["id"], statuses["erin@exemple.com"]["id"])
+            for username in ("bob", "carol"):
+                self.assertEqual(clients[username].stats()["count"], 1)
+                self.assertEqual(clients[username].fetch(1)["subject"], "Réunion")
+
+            deadline = time.monotonic() + 5
+            while True:
+                delivery = clients["alice"].delivery_status(statuses["dave@exemple.com"]["id"])
+                if delivery["status"] not in ("queued", "sending") or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(delivery["status"], "sent")
+            self.assertEqual(len(smtp.messages), 1)
+
+
+class StreamedResponseTestCase(unittest.TestCase):
+    """Un avis de nouveau courriel ne coupe pas un contenu envoyé en morceaux."""
+
+    def test_push_during_streamed_fetch(self) -> None:
+        content = os.urandom(6 * 1024 * 1024).hex()
+        for engine in ENGINES:
+            with self.subTest(engine=engine), running_server("-e", engine):
+                notifications = []
+                with gloclient.MailClient("127.0.0.1", compress=False, timeout=30,
+                                          on_new_mail=notifications.append) as alice, \
+                        gloclient.MailClient("127.0.0.1", timeout=5) as bob:
+                    alice.register("alice", "Password123")
+                    bob.register("bob", "Password123")
+                    alice.send(f"alice@{gloutils.SERVER_DOMAIN}", "Gros", content)
+                    alice.subscribe()
+                    # La réponse remplit les tampons pendant que l'avis arrive.
+                    request_id = alice._send(gloutils.Headers.INBOX_READING_CHOICE,
+                                             gloutils.EmailChoicePayload(choice=1))
+                    time.sleep(0.2)
+                    bob.send(f"alice@{gloutils.SERVER_DOMAIN}", "Petit", "Bonjour")
+                    time.sleep(0.2)
+                    response = alice._receive(request_id)
+                    self.assertEqual(alice._complete(response)["content"], content)
+                    alice.poll_notifications()
+                    self.assertEqual([notification["subject"] for notification in notifications], ["Petit"])
+
+
+    def test_content_size_limit(self) -> None:
+        for engine in ENGINES:
+            with self.subTest(engine=engine), running_server("-e", engine, "--max-content-size", "100000"), \
+                    gloclient.MailClient("127.0.0.1", timeout=5) as client:
+                client.register("alice", "Password123")
+                address = f"alice@{gloutils.SERVER_DOMAIN}"
+                with self.assertRaises(gloclient.MailClientError):
+                    client.send(address, "Trop gros", "x" * 200000)
+                # Le contenu refusé a été lu en entier: la connexion reste utilisable.
+                client.send(address, "Correct", "x" * 90000)
+                self.assertEqual(client.fetch(1)["content"], "x" * 90000)
+                self.assertEqual(client.stats()["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()